@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 from decouple import config
+from corsheaders.defaults import default_headers
 from datetime import timedelta
 import environ
 
@@ -79,6 +80,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'store.media.MediaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -163,9 +166,63 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']  # If you have static files
 STATIC_ROOT = BASE_DIR / 'staticfiles'    # For production
 
+# collectstatic writes content-hashed names plus .gz/.br copies; WhiteNoise
+# serves the hashed names as immutable
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
 # Media files (Uploaded files - product images, user uploads)
 MEDIA_URL = 'https://api.kerithofficetechnologyltd.co.ke/media/'  # URL to access media files
 MEDIA_ROOT = BASE_DIR / 'media'  # Directory where media files are stored
+MEDIA_MAX_AGE = 3600  # Non content-addressed media; hashed names are cached forever
+MEDIA_ACCEL_REDIRECT = config('MEDIA_ACCEL_REDIRECT', default='')  # e.g. /protected-media/ behind nginx
+
+# Caches. Guest carts, M-Pesa tokens and catalog versions need a store shared by
+# every worker and management command. Each of those aliases reads its backend and location
+# from the environment (e.g. GUEST_CART_CACHE_BACKEND=
+# django.core.cache.backends.redis.RedisCache, GUEST_CART_CACHE_LOCATION=redis://...);
+# the file cache defaults are only shared by processes on one host. The M-Pesa
+# alias locks token refreshes, so it must be the database (the default; create its
+# table once with `manage.py createcachetable`), Redis or Memcached backend.
+GUEST_CART_CACHE_BACKEND = config(
+    'GUEST_CART_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'
+)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': config('CATALOG_CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CATALOG_CACHE_LOCATION', default=str(BASE_DIR / '.cache' / 'catalog')),
+    },
+    'carts': {
+        'BACKEND': GUEST_CART_CACHE_BACKEND,
+        'LOCATION': config('GUEST_CART_CACHE_LOCATION', default=str(BASE_DIR / '.cache' / 'carts')),
+        # Culling limit of the file and local-memory backends; Redis and Memcached
+        # evict by their own policy and reject unknown options
+        'OPTIONS': (
+            {'MAX_ENTRIES': 100000}
+            if GUEST_CART_CACHE_BACKEND.endswith(('FileBasedCache', 'LocMemCache')) else {}
+        ),
+    },
+    'mpesa': {
+        'BACKEND': config('MPESA_TOKEN_CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('MPESA_TOKEN_CACHE_LOCATION', default='mpesa_token_cache'),
+    },
+}
+CATALOG_CACHE = 'catalog'  # Version keys of the per-process catalog snapshots (store.catalog)
+GUEST_CART_CACHE = 'carts'
+MPESA_TOKEN_CACHE = 'mpesa'  # OAuth tokens and their hit/miss counters
+GUEST_CART_TIMEOUT = 60 * 60 * 24 * 30  # 30 days without changes
+
+# How long checkout holds stock for an order awaiting M-Pesa payment (seconds).
+# Run the release_expired_reservations command every minute or so.
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Order numbers each process reserves from the daily counter at a time
+ORDER_NUMBER_BLOCK_SIZE = 20
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -202,6 +259,8 @@ SIMPLE_JWT = {
 }
 
 CORS_ALLOW_CREDENTIALS = True
+CORS_ALLOW_HEADERS = (*default_headers, 'x-cart-token')
+CORS_EXPOSE_HEADERS = ['X-Cart-Token']
 
 # Email configuration (for production)
 # EMAIL_BACKEND = config('EMAIL_BACKEND', default='django.core.mail.backends.console.EmailBackend')
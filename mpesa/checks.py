@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.checks import Error, register
+
+# Backends whose add() is atomic across processes, so the token refresh lock
+# really is single-flight. Their incr() need not be: the hit/miss totals are
+# approximate by design
+ATOMIC_CACHE_BACKENDS = {
+    'django.core.cache.backends.db.DatabaseCache',
+    'django.core.cache.backends.redis.RedisCache',
+    'django.core.cache.backends.memcached.PyMemcacheCache',
+    'django.core.cache.backends.memcached.PyLibMCCache',
+    'django_redis.cache.RedisCache',
+}
+
+
+@register()
+def check_token_cache(app_configs, **kwargs):
+    alias = getattr(settings, 'MPESA_TOKEN_CACHE', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend in ATOMIC_CACHE_BACKENDS:
+        return []
+    return [Error(
+        f"The M-Pesa token cache '{alias}' uses {backend}, which cannot lock across workers.",
+        hint='Set MPESA_TOKEN_CACHE_BACKEND to the database, Redis or Memcached cache backend.',
+        obj='MPESA_TOKEN_CACHE',
+        id='mpesa.E001',
+    )]
@@ -1,8 +1,12 @@
 import requests
 import base64
+import hashlib
 import json
+import threading
+import time
 from datetime import datetime
 from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -12,6 +16,187 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Treat a token as expired this long before Daraja does, and start refreshing
+# it this long before that
+TOKEN_EXPIRY_MARGIN = 5 * 60
+TOKEN_REFRESH_AHEAD = 5 * 60
+# Longer than the OAuth request timeout, so a crashed refresher's lock lapses
+TOKEN_LOCK_TIMEOUT = 35
+TOKEN_WAIT_INTERVAL = 0.1
+
+TOKEN_STATS = ('hits', 'misses', 'refreshes', 'errors')
+# Counts are kept per process and added to the shared totals in batches
+STATS_FLUSH_EVERY = 100
+STATS_FLUSH_INTERVAL = 60
+
+
+class AccessTokenCache:
+    """
+    OAuth tokens shared by every gateway in the process and, through the
+    ``MPESA_TOKEN_CACHE`` cache alias, by every worker.
+
+    Tokens are served from process memory, then from the shared cache. Only
+    one caller fetches a new one: threads queue on a per-credential lock and
+    workers on a lock key taken with an atomic ``add()`` (see mpesa.checks for
+    the backends that provide one), and the rest wait for its result. Once a
+    token is within TOKEN_REFRESH_AHEAD of expiring, callers keep using it
+    while one background thread fetches the next.
+
+    Hit and miss counts stay in process memory and reach the shared totals
+    every STATS_FLUSH_EVERY counts or STATS_FLUSH_INTERVAL seconds, and on
+    every refresh, so serving a token never writes to the cache. The totals
+    are approximate: incr() is a read and a write on the database cache, so
+    two workers flushing the same counter at once can lose one batch. They
+    are for monitoring only.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+        self._locks = {}
+        self._refreshing = set()
+        self._guard = threading.Lock()
+        self._pending = dict.fromkeys(TOKEN_STATS, 0)
+        self._flushed_at = time.time()
+
+    @staticmethod
+    def shared_cache():
+        return caches[getattr(settings, 'MPESA_TOKEN_CACHE', 'default')]
+
+    @staticmethod
+    def cache_key(gateway):
+        credentials = f"{gateway.base_url}:{gateway.config.consumer_key}:{gateway.config.consumer_secret}"
+        return f"mpesa:token:{hashlib.sha256(credentials.encode()).hexdigest()[:32]}"
+
+    def count(self, stat):
+        with self._guard:
+            self._pending[stat] += 1
+            due = (
+                sum(self._pending.values()) >= STATS_FLUSH_EVERY
+                or time.time() - self._flushed_at >= STATS_FLUSH_INTERVAL
+            )
+        if due:
+            self.flush_stats()
+
+    def flush_stats(self):
+        """Add this process's pending counts to the shared totals (best effort, see above)"""
+        with self._guard:
+            pending, self._pending = self._pending, dict.fromkeys(TOKEN_STATS, 0)
+            self._flushed_at = time.time()
+        cache = self.shared_cache()
+        for stat, count in pending.items():
+            if not count:
+                continue
+            key = f"mpesa:token-stats:{stat}"
+            try:
+                cache.incr(key, count)
+            except ValueError:
+                # First count, or evicted
+                if not cache.add(key, count, timeout=None):
+                    cache.incr(key, count)
+
+    def stats(self):
+        self.flush_stats()
+        cache = self.shared_cache()
+        values = cache.get_many([f"mpesa:token-stats:{stat}" for stat in TOKEN_STATS])
+        return {stat: values.get(f"mpesa:token-stats:{stat}", 0) for stat in TOKEN_STATS}
+
+    def lock_for(self, key):
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def cached(self, key):
+        """The freshest entry this process or the shared cache has for ``key``"""
+        entry = self._tokens.get(key)
+        if entry is None or time.time() >= entry['refresh_at']:
+            shared = self.shared_cache().get(key)
+            if shared and (entry is None or shared['expires_at'] > entry['expires_at']):
+                entry = self._tokens[key] = shared
+        return entry
+
+    def get(self, gateway):
+        key = self.cache_key(gateway)
+        entry = self.cached(key)
+        now = time.time()
+        if entry and now < entry['expires_at']:
+            self.count('hits')
+            if now >= entry['refresh_at']:
+                self.refresh_in_background(gateway, key)
+            return entry['token']
+        self.count('misses')
+        return self.refresh(gateway, key)
+
+    def refresh_in_background(self, gateway, key):
+        with self._guard:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(gateway, key, ahead=True)
+            except Exception as e:
+                logger.error(f"Background M-Pesa token refresh failed: {str(e)}")
+            finally:
+                with self._guard:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def refresh(self, gateway, key, ahead=False):
+        """
+        Fetch a new token unless another thread or worker already has: with
+        ``ahead`` that means one not yet due for refresh, otherwise any
+        unexpired one.
+        """
+        def fresh(entry):
+            return entry and time.time() < entry['refresh_at' if ahead else 'expires_at']
+
+        with self.lock_for(key):
+            entry = self.cached(key)
+            if fresh(entry):
+                return entry['token']
+
+            cache = self.shared_cache()
+            lock_key = f"{key}:lock"
+            locked = cache.add(lock_key, 1, TOKEN_LOCK_TIMEOUT)
+            if not locked:
+                # Another worker is fetching; wait for its token
+                deadline = time.time() + TOKEN_LOCK_TIMEOUT
+                while time.time() < deadline and cache.get(lock_key) is not None:
+                    time.sleep(TOKEN_WAIT_INTERVAL)
+                    entry = self.cached(key)
+                    if fresh(entry):
+                        return entry['token']
+                # It failed or died: fetch ourselves rather than fail
+                locked = cache.add(lock_key, 1, TOKEN_LOCK_TIMEOUT)
+
+            try:
+                try:
+                    token, expires_in = gateway.fetch_access_token()
+                except Exception:
+                    self.count('errors')
+                    self.flush_stats()
+                    raise
+                self.count('refreshes')
+                self.flush_stats()
+                fetched_at = time.time()
+                expires_at = fetched_at + max(expires_in - TOKEN_EXPIRY_MARGIN, 0)
+                entry = {
+                    'token': token,
+                    'expires_at': expires_at,
+                    'refresh_at': max(expires_at - TOKEN_REFRESH_AHEAD, fetched_at),
+                }
+                self._tokens[key] = entry
+                cache.set(key, entry, timeout=max(int(expires_at - fetched_at), 1))
+                return token
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+
+
+token_cache = AccessTokenCache()
+
+
 class MpesaGateway:
     def __init__(self, config=None):
         self.config = config
@@ -27,14 +212,13 @@ class MpesaGateway:
             if self.config.is_live 
             else "https://sandbox.safaricom.co.ke"
         )
-        self.access_token = None
-        self.token_expiry = None
     
     def get_access_token(self):
-        """Get M-Pesa OAuth access token"""
-        if self.access_token and self.token_expiry and timezone.now() < self.token_expiry:
-            return self.access_token
-        
+        """Get M-Pesa OAuth access token, shared across requests and workers (see AccessTokenCache)"""
+        return token_cache.get(self)
+    
+    def fetch_access_token(self):
+        """Request a new OAuth access token; returns it with its lifetime in seconds"""
         url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
         
         # Create authentication string
@@ -51,12 +235,11 @@ class MpesaGateway:
             response.raise_for_status()
             
             data = response.json()
-            self.access_token = data['access_token']
-            # Token expires in 1 hour, set expiry to 55 minutes for safety
-            self.token_expiry = timezone.now() + timezone.timedelta(minutes=55)
+            # Tokens last an hour
+            expires_in = int(data.get('expires_in') or 3600)
             
             logger.info("Successfully obtained M-Pesa access token")
-            return self.access_token
+            return data['access_token'], expires_in
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Failed to get M-Pesa access token: {str(e)}")
@@ -186,7 +369,10 @@ class MpesaCallbackHandler:
         """
         Handle STK push callback from M-Pesa
         """
+        from django.db import transaction as db_transaction
         from .models import MpesaTransaction
+        from store.inventory import confirm_reservations, release_reservations
+        from store.models import Order
         
         try:
             body = callback_data.get('Body', {})
@@ -234,14 +420,26 @@ class MpesaCallbackHandler:
                 transaction.status = 'success'
                 transaction.is_complete = True
                 
-                # Update order status
-                transaction.order.payment_status = 'paid'
-                transaction.order.status = 'confirmed'
-                transaction.order.paid_at = timezone.now()
-                transaction.order.transaction_id = transaction.mpesa_receipt_number
-                transaction.order.save()
+                # Update order status, with the row locked so the expiry sweep
+                # cannot cancel the order in between
+                with db_transaction.atomic():
+                    order = Order.objects.select_for_update().get(pk=transaction.order_id)
+                    order.payment_status = 'paid'
+                    order.paid_at = timezone.now()
+                    order.transaction_id = transaction.mpesa_receipt_number
+                    if order.status == 'cancelled':
+                        # Paid after its holds lapsed and it was cancelled: the
+                        # units may be sold, so it stays cancelled for a refund
+                        order.save()
+                        logger.warning(f"Payment received for cancelled order {order.order_number}; refund it")
+                    else:
+                        order.status = 'confirmed'
+                        order.save()
+                        # The held stock is now sold
+                        confirm_reservations(order)
+                transaction.order = order
                 
-                logger.info(f"Payment successful for order {transaction.order.order_number}")
+                logger.info(f"Payment successful for order {order.order_number}")
                 
             else:
                 # Payment failed
@@ -252,6 +450,9 @@ class MpesaCallbackHandler:
                 transaction.order.payment_status = 'failed'
                 transaction.order.save()
                 
+                # Give the held stock back to other buyers
+                release_reservations(transaction.order.reservations.all())
+                
                 logger.warning(f"Payment failed for order {transaction.order.order_number}: {result_description}")
             
             transaction.save()
@@ -1,3 +1,125 @@
-from django.test import TestCase
+import threading
+import time
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from rest_framework.test import APIClient
+
+from users.models import User
+from .checks import check_token_cache
+from .services import STATS_FLUSH_EVERY, TOKEN_EXPIRY_MARGIN, AccessTokenCache, MpesaGateway
+
+TOKEN_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'mpesa': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'mpesa-tokens'},
+}
+
+
+class FakeGateway(MpesaGateway):
+    """A gateway whose OAuth round trip is slow and counted instead of sent"""
+
+    def __init__(self, expires_in=3600, delay=0.2):
+        super().__init__(config=SimpleNamespace(is_live=False, consumer_key='key', consumer_secret='secret'))
+        self.expires_in = expires_in
+        self.delay = delay
+        self.calls = 0
+
+    def fetch_access_token(self):
+        self.calls += 1
+        time.sleep(self.delay)
+        return f'token-{self.calls}', self.expires_in
+
+
+@override_settings(CACHES=TOKEN_CACHES, MPESA_TOKEN_CACHE='mpesa')
+class AccessTokenCacheTests(TestCase):
+    def setUp(self):
+        caches['mpesa'].clear()
+
+    def test_concurrent_requests_fetch_one_token(self):
+        gateway = FakeGateway()
+        tokens = AccessTokenCache()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(tokens.get(gateway))) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(gateway.calls, 1)
+        self.assertEqual(results, ['token-1'] * 20)
+        self.assertEqual(tokens.stats()['refreshes'], 1)
+        self.assertEqual(tokens.stats()['hits'] + tokens.stats()['misses'], 20)
+
+    def test_workers_share_tokens_through_the_cache(self):
+        gateway = FakeGateway(delay=0)
+        # Separate instances stand in for separate worker processes
+        self.assertEqual(AccessTokenCache().get(gateway), 'token-1')
+        other_worker = AccessTokenCache()
+        self.assertEqual(other_worker.get(gateway), 'token-1')
+        self.assertEqual(other_worker.get(gateway), 'token-1')
+        self.assertEqual(gateway.calls, 1)
+        self.assertEqual(other_worker.stats(), {'hits': 2, 'misses': 1, 'refreshes': 1, 'errors': 0})
+
+    def test_serving_tokens_does_not_write_counts_every_time(self):
+        gateway = FakeGateway(delay=0)
+        tokens = AccessTokenCache()
+        tokens.get(gateway)
+        for _ in range(STATS_FLUSH_EVERY - 1):
+            tokens.get(gateway)
+        # The refresh flushed the first miss; the hits since are still in memory
+        self.assertEqual(caches['mpesa'].get('mpesa:token-stats:misses'), 1)
+        self.assertIsNone(caches['mpesa'].get('mpesa:token-stats:hits'))
+        tokens.get(gateway)
+        self.assertEqual(caches['mpesa'].get('mpesa:token-stats:hits'), STATS_FLUSH_EVERY)
+
+    def test_refreshes_ahead_of_expiry_without_blocking(self):
+        # Usable for two seconds and due for refresh straight away
+        gateway = FakeGateway(expires_in=TOKEN_EXPIRY_MARGIN + 2, delay=0.3)
+        tokens = AccessTokenCache()
+        self.assertEqual(tokens.get(gateway), 'token-1')
+
+        started = time.time()
+        self.assertEqual(tokens.get(gateway), 'token-1')
+        self.assertLess(time.time() - started, 0.2)
+
+        deadline = time.time() + 2
+        while gateway.calls < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.4)
+        self.assertEqual(gateway.calls, 2)
+        self.assertEqual(tokens.get(gateway), 'token-2')
+        # That token is due at once too; let its refresh finish while the test cache is in place
+        deadline = time.time() + 2
+        while tokens._refreshing and time.time() < deadline:
+            time.sleep(0.05)
+
+    def test_failed_fetches_are_counted_and_raised(self):
+        class FailingGateway(FakeGateway):
+            def fetch_access_token(self):
+                raise Exception('Failed to get access token: timed out')
+
+        tokens = AccessTokenCache()
+        with self.assertRaises(Exception):
+            tokens.get(FailingGateway())
+        self.assertEqual(tokens.stats()['errors'], 1)
+
+    def test_stats_endpoint_is_staff_only(self):
+        client = APIClient()
+        user = User.objects.create_user(username='cashier', email='cashier@example.com', password='secret')
+        client.force_authenticate(user)
+        self.assertEqual(client.get('/api/mpesa/configurations/token_cache/').status_code, 403)
+        user.is_staff = True
+        user.save()
+        response = client.get('/api/mpesa/configurations/token_cache/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'hits', 'misses', 'refreshes', 'errors'})
+
+
+class TokenCacheCheckTests(SimpleTestCase):
+    def test_backends_without_an_atomic_add_are_rejected(self):
+        self.assertEqual(check_token_cache(None), [])
+        for backend in ('filebased.FileBasedCache', 'locmem.LocMemCache'):
+            caches_setting = {'mpesa': {'BACKEND': f'django.core.cache.backends.{backend}'}}
+            with self.subTest(backend=backend), override_settings(CACHES=caches_setting):
+                self.assertEqual([error.id for error in check_token_cache(None)], ['mpesa.E001'])
@@ -15,8 +15,9 @@ from .serializers import (
     MpesaPaymentRequestSerializer,
     MpesaConfigurationSerializer
 )
-from .services import MpesaGateway, MpesaCallbackHandler
+from .services import MpesaGateway, MpesaCallbackHandler, token_cache
 from store.models import Order
+from store.pagination import KeysetPagination
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +25,7 @@ logger = logging.getLogger(__name__)
 class MpesaTransactionViewSet(viewsets.ModelViewSet):
     serializer_class = MpesaTransactionSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
 
     def get_permissions(self):
         """
@@ -121,10 +123,15 @@ class MpesaConfigurationViewSet(viewsets.ModelViewSet):
         return MpesaConfiguration.objects.all()
     
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'token_cache']:
             from rest_framework.permissions import IsAdminUser
             return [IsAdminUser()]
         return [IsAuthenticated()]
+    
+    @action(detail=False, methods=['get'])
+    def token_cache(self, request):
+        """Approximate OAuth token cache hits, misses, refreshes and errors across all workers (up to a minute behind)"""
+        return Response(token_cache.stats())
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
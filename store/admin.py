@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Category, Brand, Product, ProductImage, ProductAttribute, ProductReview, Cart, CartItem, Order, OrderItem, Wishlist, ShippingAddress
+from django.db import transaction
+from django.utils import timezone
+from .inventory import restore_orders_stock
+from .models import Category, Brand, Product, ProductImage, ProductAttribute, ProductReview, Cart, CartItem, Order, OrderItem, StockAdjustment, StockReservation, Wishlist, ShippingAddress
 
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -116,6 +119,26 @@ class OrderItemInline(admin.TabularInline):
     extra = 0
     readonly_fields = ['total_price']
 
+class StockReservationInline(admin.TabularInline):
+    model = StockReservation
+    extra = 0
+    can_delete = False
+    fields = ['product', 'quantity', 'status', 'expires_at', 'updated_at']
+    readonly_fields = fields
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+class StockAdjustmentInline(admin.TabularInline):
+    model = StockAdjustment
+    extra = 0
+    can_delete = False
+    fields = ['product', 'quantity', 'reason', 'created_at']
+    readonly_fields = fields
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = [
@@ -128,8 +151,9 @@ class OrderAdmin(admin.ModelAdmin):
         'order_number', 'created_at', 'updated_at', 
         'paid_at', 'delivered_at', 'cancelled_at'
     ]
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, StockReservationInline, StockAdjustmentInline]
     list_editable = ['status', 'payment_status']
+    actions = ['cancel_orders']
     
     fieldsets = (
         ('Order Information', {
@@ -154,6 +178,29 @@ class OrderAdmin(admin.ModelAdmin):
             'fields': ('created_at', 'updated_at', 'paid_at', 'delivered_at', 'cancelled_at')
         }),
     )
+    
+    def save_model(self, request, obj, form, change):
+        """Moving an order to cancelled or refunded (form or list edit) gives its stock back"""
+        restock = change and 'status' in form.changed_data and obj.status in ('cancelled', 'refunded')
+        with transaction.atomic():
+            if obj.status == 'cancelled' and not obj.cancelled_at:
+                obj.cancelled_at = timezone.now()
+            super().save_model(request, obj, form, change)
+            if restock:
+                restore_orders_stock([obj], obj.status)
+    
+    @admin.action(description='Cancel selected orders and restore their stock')
+    def cancel_orders(self, request, queryset):
+        with transaction.atomic():
+            orders = list(queryset.select_for_update().filter(status__in=['pending', 'confirmed']))
+            now = timezone.now()
+            Order.objects.filter(id__in=[order.id for order in orders]).update(
+                status='cancelled', cancelled_at=now, updated_at=now
+            )
+            quantities = restore_orders_stock(orders, 'cancelled')
+        self.message_user(
+            request, f"Cancelled {len(orders)} orders and restored {sum(quantities.values())} units of stock"
+        )
 
 @admin.register(Wishlist)
 class WishlistAdmin(admin.ModelAdmin):
@@ -0,0 +1,159 @@
+"""
+Guest carts, kept in a cache instead of django_session and carts rows.
+
+A guest has no cart until their first add. That issues a random token, which
+is returned as the cart's ``session_key``, in an ``X-Cart-Token`` header and in
+a cookie. The lines live in the ``GUEST_CART_CACHE`` alias as
+``{product_id: quantity}`` and expire after ``GUEST_CART_TIMEOUT`` without
+changes. They reach the database only when the guest logs in (or sends the
+token while authenticated) and are merged into the user's own Cart, which is
+the cart checkout reads.
+"""
+import re
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .inventory import available_stock
+from .models import Cart, CartItem, Product, sum_cart_items
+
+CART_TOKEN_HEADER = 'X-Cart-Token'
+CART_TOKEN_COOKIE = 'cart_token'
+TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+def guest_cache():
+    return caches[getattr(settings, 'GUEST_CART_CACHE', 'default')]
+
+
+def guest_token(request):
+    """The guest cart token a request carries, header first, or None"""
+    token = request.headers.get(CART_TOKEN_HEADER) or request.COOKIES.get(CART_TOKEN_COOKIE)
+    if token and TOKEN_PATTERN.match(token):
+        return token
+    return None
+
+
+class GuestCart:
+    """A guest's cart, shaped like Cart so CartSerializer can render it"""
+    id = None
+    user = None
+
+    def __init__(self, token=None, lines=None, created_at=None, updated_at=None):
+        now = timezone.now()
+        self.session_key = token
+        self.lines = dict(lines or {})
+        self.created_at = created_at or now
+        self.updated_at = updated_at or now
+        self._items = None
+
+    @staticmethod
+    def cache_key(token):
+        return f'store:guest-cart:{token}'
+
+    @classmethod
+    def load(cls, token):
+        state = guest_cache().get(cls.cache_key(token)) if token else None
+        if state is None:
+            return cls()
+        return cls(token, **state)
+
+    def save(self):
+        """Store the lines, issuing a token the first time there is something to keep"""
+        self._items = None
+        if not self.session_key:
+            if not self.lines:
+                return
+            self.session_key = secrets.token_urlsafe(24)
+        if not self.lines:
+            self.delete()
+            return
+        self.updated_at = timezone.now()
+        guest_cache().set(
+            self.cache_key(self.session_key),
+            {'lines': self.lines, 'created_at': self.created_at, 'updated_at': self.updated_at},
+            getattr(settings, 'GUEST_CART_TIMEOUT', 60 * 60 * 24 * 30)
+        )
+
+    def delete(self):
+        self.lines = {}
+        self._items = None
+        if self.session_key:
+            guest_cache().delete(self.cache_key(self.session_key))
+
+    def add(self, product_id, quantity):
+        # Re-inserted so the line sorts as the newest
+        self.lines[product_id] = self.lines.pop(product_id, 0) + quantity
+
+    @property
+    def items(self):
+        """Unsaved CartItems with their products, newest first, from one query"""
+        if self._items is None:
+            products = Product.objects.filter(
+                id__in=self.lines, active=True
+            ).select_related('rating_summary').in_bulk()
+            self._items = [
+                CartItem(product=products[product_id], quantity=quantity)
+                for product_id, quantity in reversed(self.lines.items())
+                if product_id in products
+            ]
+        return self._items
+
+    def get_totals(self):
+        return sum_cart_items(self.items)
+
+    @property
+    def total_price(self):
+        return self.get_totals()['total_price']
+
+    @property
+    def total_quantity(self):
+        return self.get_totals()['total_quantity']
+
+    @property
+    def is_empty(self):
+        return self.get_totals()['item_count'] == 0
+
+
+def merge_guest_cart(request, user):
+    """
+    Fold the request's guest cart into ``user``'s cart, adding quantities and
+    capping each line at the product's available stock. Returns True if one was merged.
+    """
+    guest = GuestCart.load(guest_token(request))
+    if not guest.lines:
+        return False
+
+    with transaction.atomic():
+        cart, created = Cart.objects.get_or_create(user=user)
+        products = Product.objects.filter(id__in=guest.lines, active=True).only('id', 'stock').in_bulk()
+        available = available_stock(products.values())
+        existing = {
+            item.product_id: item
+            for item in CartItem.objects.select_for_update().filter(cart=cart, product_id__in=products)
+        }
+
+        now = timezone.now()
+        to_create, to_update = [], []
+        for product_id, quantity in guest.lines.items():
+            product = products.get(product_id)
+            if product is None:
+                continue
+            item = existing.get(product_id)
+            quantity = min((item.quantity if item else 0) + quantity, available[product_id])
+            if item:
+                if quantity > item.quantity:
+                    item.quantity = quantity
+                    item.updated_at = now
+                    to_update.append(item)
+            elif quantity > 0:
+                to_create.append(CartItem(cart=cart, product=product, quantity=quantity))
+
+        CartItem.objects.bulk_update(to_update, ['quantity', 'updated_at'])
+        CartItem.objects.bulk_create(to_create)
+
+    guest.delete()
+    return True
@@ -0,0 +1,204 @@
+"""
+In-process read models for the storefront catalog.
+
+Each snapshot is built lazily from the database and kept per process. Writes
+(see store.signals) and batch commands only bump the snapshot's version key in
+the ``CATALOG_CACHE`` alias, which every worker and management command must
+share, so each worker rebuilds on its next read instead of on every request.
+"""
+import hashlib
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Max
+from django.utils import timezone
+
+
+def version_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE', 'default')]
+
+
+def get_version(key):
+    """Current version token for ``key``, created on first use or after eviction"""
+    versions = version_cache()
+    version = versions.get(key)
+    if version is None:
+        versions.add(key, uuid.uuid4().hex, timeout=None)
+        version = versions.get(key)
+    return version
+
+
+def bump_version(key):
+    # Random tokens rather than a counter: an evicted key can never come back
+    # as a version some process has already built
+    version_cache().set(key, uuid.uuid4().hex, timeout=None)
+
+
+class VersionedSnapshot:
+    """Process-local value rebuilt whenever its version key changes"""
+
+    def __init__(self, version_key, builder):
+        self.version_key = version_key
+        self.builder = builder
+        self._value = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def current_version(self):
+        return get_version(self.version_key)
+
+    def get(self):
+        version = self.current_version()
+        if self._version != version:
+            with self._lock:
+                if self._version != version:
+                    self._value = self.builder()
+                    self._version = version
+        return self._value
+
+    def invalidate(self):
+        bump_version(self.version_key)
+
+
+CATALOG_STATE_KEY = 'store:catalog:state'
+
+
+def get_catalog_state():
+    """
+    ``(last_modified, token)`` for everything the catalog endpoints render,
+    shared by every worker through the ``CATALOG_CACHE`` alias. Only scans the
+    tables when the cache has lost the value; writes keep it current through
+    touch_catalog().
+    """
+    states = version_cache()
+    state = states.get(CATALOG_STATE_KEY)
+    if state is None:
+        from .models import Brand, Category, Product, ProductImage
+
+        stamps = [
+            model.objects.aggregate(last=Max('updated_at'))['last']
+            for model in (Product, Category, Brand, ProductImage)
+        ]
+        last_modified = max((stamp for stamp in stamps if stamp), default=None) or timezone.now()
+        # A fresh token, so an ETag issued before the value was lost never matches
+        state = (last_modified, uuid.uuid4().hex)
+        states.add(CATALOG_STATE_KEY, state, timeout=None)
+        state = states.get(CATALOG_STATE_KEY, state)
+    return state
+
+
+def touch_catalog():
+    version_cache().set(CATALOG_STATE_KEY, (timezone.now(), uuid.uuid4().hex), timeout=None)
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return get_catalog_state()[0]
+
+
+def catalog_etag(request, *args, **kwargs):
+    """Strong ETag: one representation per catalog state, URL and Accept header"""
+    token = get_catalog_state()[1]
+    key = f"{token}|{request.get_full_path()}|{request.META.get('HTTP_ACCEPT', '')}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class CategoryTree:
+    """Active categories as serialized nodes, linked into a tree"""
+
+    def __init__(self, nodes, roots):
+        self.nodes = nodes
+        self.roots = roots
+        self.by_id = {node['id']: node for node in nodes}
+        self.by_slug = {node['slug']: node for node in nodes}
+
+    def get(self, pk):
+        return self.by_id.get(pk)
+
+    @property
+    def featured(self):
+        return [node for node in self.nodes if node['featured']]
+
+
+def build_category_tree():
+    from .models import Category
+    from .serializers import CategoryNodeSerializer
+
+    categories = list(Category.objects.filter(active=True))
+
+    nodes = []
+    for category in categories:
+        node = dict(CategoryNodeSerializer(category).data)
+        node['product_count'] = category.active_product_count
+        node['subtree_product_count'] = category.active_product_count
+        node['children'] = []
+        nodes.append(node)
+
+    # Queryset is already in Meta.ordering, so children keep that order
+    by_id = {node['id']: node for node in nodes}
+    roots = []
+    for node in nodes:
+        parent = by_id.get(node['parent'])
+        if parent is not None:
+            parent['children'].append(node)
+        elif node['parent'] is None:
+            roots.append(node)
+
+    def add_subtree_counts(node):
+        for child in node['children']:
+            node['subtree_product_count'] += add_subtree_counts(child)
+        return node['subtree_product_count']
+
+    for node in nodes:
+        # Also covers subtrees hanging off an inactive parent
+        if by_id.get(node['parent']) is None:
+            add_subtree_counts(node)
+
+    return CategoryTree(nodes, roots)
+
+
+category_tree = VersionedSnapshot('store:category-tree:version', build_category_tree)
+
+
+class CatalogSnapshot(VersionedSnapshot):
+    """
+    Rebuilt whenever anything the catalog endpoints render changes, by a
+    worker or a command (see touch_catalog)
+    """
+
+    def __init__(self, builder):
+        super().__init__(CATALOG_STATE_KEY, builder)
+
+    def current_version(self):
+        return get_catalog_state()[1]
+
+    def invalidate(self):
+        touch_catalog()
+
+
+HOME_RAIL_SIZE = 12
+HOME_RAILS = ('featured', 'best_seller', 'new_arrival', 'on_sale')
+
+
+def build_home():
+    """Serialized homepage: the four product rails plus featured categories and brands"""
+    from .inventory import with_available_stock
+    from .models import Brand, Product
+    from .serializers import BrandSerializer, ProductListSerializer
+
+    products = with_available_stock(
+        Product.objects.filter(active=True).select_related('rating_summary')
+    ).order_by('-created_at')
+    home = {}
+    for flag in HOME_RAILS:
+        rail = products.filter(**{flag: True})
+        if flag == 'best_seller':
+            rail = rail.order_by('sales_rank', '-created_at')
+        home[flag] = ProductListSerializer(rail[:HOME_RAIL_SIZE], many=True).data
+    home['featured_categories'] = category_tree.get().featured
+    home['brands'] = BrandSerializer(Brand.objects.filter(active=True), many=True).data
+    return home
+
+
+home_snapshot = CatalogSnapshot(build_home)
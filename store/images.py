@@ -0,0 +1,212 @@
+"""
+Fixed-width WebP and JPEG derivatives of catalog images.
+
+Derivatives are written to the default storage under
+``derivatives/<original path>-<width>w.<ext>``. Their names depend only on the
+original name, so once a set is known to exist serializers build every URL
+without touching storage; until then they advertise none and clients use the
+original. Sets are written on a background thread after an upload commits (see
+store.signals) and by ``manage.py generate_image_derivatives`` for existing or
+interrupted ones.
+
+Dimensions, a dominant colour and a tiny inline placeholder are extracted once
+per upload and stored on the row (``<field>_width`` etc.), so neither clients
+nor server code need to open the file to lay out a page.
+"""
+import base64
+import logging
+import os
+import threading
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import ExifTags, Image, ImageOps
+
+from .catalog import category_tree, touch_catalog
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_ROOT = 'derivatives'
+DERIVATIVE_WIDTHS = (150, 430, 1024)
+DERIVATIVE_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+# (model label, ImageField name) of every catalog image
+IMAGE_FIELDS = (
+    ('store.Product', 'main_image'),
+    ('store.ProductImage', 'image'),
+    ('store.Brand', 'logo'),
+    ('store.Category', 'image'),
+)
+
+# Images whose rows carry <field>_width/_height/_color/_placeholder
+METADATA_FIELDS = (
+    ('store.Product', 'main_image'),
+    ('store.ProductImage', 'image'),
+    ('store.Brand', 'logo'),
+)
+PLACEHOLDER_SIZE = 16
+
+
+def derivative_name(name, width, fmt):
+    stem = os.path.splitext(name)[0]
+    return f"{DERIVATIVE_ROOT}/{stem}-{width}w.{EXTENSIONS[fmt]}"
+
+
+# Originals whose full derivative set exists. Content-addressed names never
+# change, so a set once found stays valid for as long as anything renders it
+_complete = set()
+
+
+def derivative_urls(name, storage=default_storage):
+    """
+    ``{'webp': {'150': url, ...}, 'jpeg': {...}}`` for an original image name,
+    or None while its derivatives have not been written
+    """
+    if not name:
+        return None
+    if name not in _complete:
+        if not has_derivatives(name, storage):
+            return None
+        _complete.add(name)
+    return {
+        fmt: {str(width): storage.url(derivative_name(name, width, fmt)) for width in DERIVATIVE_WIDTHS}
+        for fmt in DERIVATIVE_FORMATS
+    }
+
+
+def has_derivatives(name, storage=default_storage):
+    # The widest JPEG is written last, so it marks a complete set
+    return storage.exists(derivative_name(name, DERIVATIVE_WIDTHS[-1], 'jpeg'))
+
+
+def generate_derivatives(name, storage=default_storage, force=False):
+    """
+    Write every width and format of ``name``; returns the number of files
+    written. Originals narrower than a width are stored at their own size
+    rather than upscaled, so every advertised URL exists.
+    """
+    if not name or (not force and has_derivatives(name, storage)):
+        return 0
+
+    with storage.open(name, 'rb') as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        image.load()
+
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    written = 0
+    for width in DERIVATIVE_WIDTHS:
+        resized = image
+        if image.width > width:
+            resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+        for fmt, (pil_format, options) in DERIVATIVE_FORMATS.items():
+            frame = resized
+            if pil_format == 'JPEG' and has_alpha:
+                frame = Image.new('RGB', resized.size, (255, 255, 255))
+                frame.paste(resized, mask=resized.getchannel('A'))
+
+            buffer = BytesIO()
+            frame.save(buffer, pil_format, **options)
+            target = derivative_name(name, width, fmt)
+            if storage.exists(target):
+                storage.delete(target)
+            storage.save(target, ContentFile(buffer.getvalue()))
+            written += 1
+    return written
+
+
+def delete_derivatives(name, storage=default_storage):
+    _complete.discard(name)
+    # The marker goes first, so a half-deleted set never counts as complete
+    for width in reversed(DERIVATIVE_WIDTHS):
+        for fmt in reversed(DERIVATIVE_FORMATS):
+            storage.delete(derivative_name(name, width, fmt))
+
+
+# Resizing is CPU-bound: cap how many uploads a worker process resizes at once
+BUILD_THREADS = 2
+_building = set()
+_building_guard = threading.Lock()
+_build_slots = threading.BoundedSemaphore(BUILD_THREADS)
+
+
+def derivatives_changed():
+    """Cached payloads rendered without the new URLs are rebuilt on their next read"""
+    category_tree.invalidate()
+    touch_catalog()
+
+
+def ensure_derivatives(name):
+    """
+    Upload hook: build missing derivatives on a background thread, so the
+    request that saved the image never waits for them and never fails on them.
+    A set cut short by a restart is not marked complete; the management
+    command finishes it.
+    """
+    if not name:
+        return
+    with _building_guard:
+        if name in _building:
+            return
+        _building.add(name)
+
+    def run():
+        try:
+            with _build_slots:
+                # Written by name rather than through the field's content-addressed storage
+                if generate_derivatives(name):
+                    derivatives_changed()
+        except Exception as e:
+            logger.error(f"Failed to generate derivatives for {name}: {str(e)}")
+        finally:
+            with _building_guard:
+                _building.discard(name)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def flatten(image):
+    """RGB copy of ``image``, with any transparency composited onto white"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def image_metadata(file):
+    """
+    ``{'width', 'height', 'color', 'placeholder'}`` of an open image file: the
+    displayed (EXIF-rotated) size, the most common colour of a 5-colour
+    quantization as ``#rrggbb``, and a ~16px WebP data URI to blur up from.
+    """
+    image = Image.open(file)
+    width, height = image.size
+    if image.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        width, height = height, width
+    image.draft('RGB', (PLACEHOLDER_SIZE * 4, PLACEHOLDER_SIZE * 4))  # JPEG: decode at reduced scale
+    image = ImageOps.exif_transpose(image)
+
+    small = flatten(image)
+    small.thumbnail((64, 64))
+    counts = small.quantize(colors=5).convert('RGB').getcolors()
+    red, green, blue = max(counts)[1]
+
+    small.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    buffer = BytesIO()
+    small.save(buffer, 'WEBP', quality=40)
+    file.seek(0)
+    return {
+        'width': width,
+        'height': height,
+        'color': f'#{red:02x}{green:02x}{blue:02x}',
+        'placeholder': 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode(),
+    }
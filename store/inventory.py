@@ -0,0 +1,221 @@
+"""
+Stock levels and the reservation ledger.
+
+``Product.stock`` is on-hand stock. Checkout of an M-Pesa order does not take
+it straight away: it records StockReservation holds that expire after
+``STOCK_RESERVATION_TTL``. Unexpired holds count against what other buyers can
+add or order, so available stock is ``stock`` minus active holds. A successful
+payment callback confirms the holds and only then decrements ``stock``; a
+failed payment releases them, and the release_expired_reservations command
+releases abandoned ones in bulk. Orders paid on delivery take stock at checkout.
+Product listings annotate active holds (with_available_stock) so ``in_stock``
+matches what checkout will accept, and reserving or releasing touches the
+catalog so cached listings follow.
+
+Cancelled and refunded orders give their stock back through
+restore_orders_stock(), which logs each line as a StockAdjustment.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .catalog import touch_catalog
+from .models import OrderItem, Product, StockAdjustment, StockReservation
+
+logger = logging.getLogger(__name__)
+
+RESTOCK_REASONS = ('cancelled', 'refunded')
+
+
+def active_holds(now=None):
+    """Held reservations that have not expired yet"""
+    return StockReservation.objects.filter(status='held', expires_at__gt=now or timezone.now())
+
+
+def held_quantities(product_ids, now=None):
+    """``{product_id: quantity}`` held for ``product_ids``, from one grouped query"""
+    rows = (
+        active_holds(now).filter(product_id__in=product_ids)
+        .values('product_id').annotate(held=Sum('quantity'))
+        .values_list('product_id', 'held')
+    )
+    return dict(rows)
+
+
+def held_stock():
+    """Units actively held for the outer query's product, as a subquery expression"""
+    holds = (
+        active_holds().filter(product=OuterRef('pk')).order_by()
+        .values('product').annotate(held=Sum('quantity')).values('held')
+    )
+    return Coalesce(Subquery(holds), Value(0), output_field=IntegerField())
+
+
+def with_available_stock(queryset):
+    """Products annotated with ``held_stock``, which Product.in_stock subtracts"""
+    return queryset.annotate(held_stock=held_stock())
+
+
+def available_stock(products):
+    """``{product_id: available}`` for the given products: on-hand minus active holds"""
+    held = held_quantities([product.id for product in products])
+    return {product.id: product.stock - held.get(product.id, 0) for product in products}
+
+
+def reserve(order, quantities, ttl=None):
+    """Hold ``{product_id: quantity}`` for ``order`` until the TTL runs out"""
+    if ttl is None:
+        ttl = settings.STOCK_RESERVATION_TTL
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    reservations = StockReservation.objects.bulk_create([
+        StockReservation(order=order, product_id=product_id, quantity=quantity, expires_at=expires_at)
+        for product_id, quantity in quantities.items()
+    ])
+    # Listings show in_stock net of holds
+    transaction.on_commit(touch_catalog)
+    return reservations
+
+
+def take_stock(quantities, held=None):
+    """
+    Decrement ``{product_id: quantity}`` with one guarded UPDATE. A row is only
+    updated if it still has the quantity (plus anything ``held`` for others),
+    so on backends without row locks this is what stops an oversell. Returns
+    False, without rolling back, if any row fell short.
+    """
+    if not quantities:
+        return True
+    held = held or {}
+    guard = Q()
+    for product_id, quantity in quantities.items():
+        guard |= Q(id=product_id, stock__gte=quantity + held.get(product_id, 0))
+    updated = Product.objects.filter(guard).update(
+        stock=Case(
+            *[When(id=product_id, then=F('stock') - quantity) for product_id, quantity in quantities.items()],
+            default=F('stock')
+        ),
+        updated_at=timezone.now(),
+    )
+    # The UPDATE skips the save signals
+    transaction.on_commit(touch_catalog)
+    return updated == len(quantities)
+
+
+def put_back_stock(quantities):
+    """Return ``{product_id: quantity}`` to on-hand stock with one F() UPDATE"""
+    if not quantities:
+        return
+    Product.objects.filter(id__in=quantities).update(
+        stock=Case(
+            *[When(id=product_id, then=F('stock') + quantity) for product_id, quantity in quantities.items()],
+            default=F('stock')
+        ),
+        updated_at=timezone.now(),
+    )
+    transaction.on_commit(touch_catalog)
+
+
+def sum_quantities(rows):
+    totals = {}
+    for product_id, quantity in rows:
+        totals[product_id] = totals.get(product_id, 0) + quantity
+    return totals
+
+
+def confirm_reservations(order):
+    """
+    Turn ``order``'s holds into a stock decrement once it is paid. Holds that
+    lapsed or were released before the payment arrived are confirmed too while
+    the order is still open: the customer has paid, so a shortfall is logged
+    for staff rather than refused. A cancelled order takes nothing.
+    """
+    if order.status == 'cancelled':
+        return 0
+    with transaction.atomic():
+        reservations = list(
+            order.reservations.select_for_update().exclude(status='confirmed').order_by('product_id')
+        )
+        if not reservations:
+            return 0
+        quantities = sum_quantities((r.product_id, r.quantity) for r in reservations)
+        products = Product.objects.select_for_update().filter(id__in=quantities).order_by('id')
+        for product in products:
+            if product.stock < quantities[product.id]:
+                logger.warning(
+                    f"Order {order.order_number} paid for {quantities[product.id]} x {product.sku} "
+                    f"but only {product.stock} in stock"
+                )
+        Product.objects.filter(id__in=quantities).update(
+            stock=Case(
+                *[When(id=product_id, then=F('stock') - quantity) for product_id, quantity in quantities.items()],
+                default=F('stock')
+            ),
+            updated_at=timezone.now(),
+        )
+        StockReservation.objects.filter(id__in=[r.id for r in reservations]).update(
+            status='confirmed', updated_at=timezone.now()
+        )
+        transaction.on_commit(touch_catalog)
+    return len(reservations)
+
+
+def release_reservations(queryset):
+    """Release every held reservation in ``queryset`` with one UPDATE; returns the count"""
+    released = queryset.filter(status='held').update(status='released', updated_at=timezone.now())
+    if released:
+        transaction.on_commit(touch_catalog)
+    return released
+
+
+def restore_orders_stock(orders, reason):
+    """
+    Undo what ``orders`` did to stock when they are cancelled or refunded:
+    release their holds and put back only what was actually taken, i.e.
+    confirmed holds, or the items of an order that never had holds. Every
+    unit returned is logged as a StockAdjustment, and orders that already
+    have one are skipped, so a refund after a cancellation is a no-op.
+
+    However many orders and lines, this is a fixed handful of statements;
+    call it inside the transaction that changes the orders' status.
+    """
+    order_ids = [order.id for order in orders]
+    with transaction.atomic():
+        restored = set(
+            StockAdjustment.objects.filter(order_id__in=order_ids, reason__in=RESTOCK_REASONS)
+            .order_by().values_list('order_id', flat=True)
+        )
+        order_ids = [order_id for order_id in order_ids if order_id not in restored]
+        if not order_ids:
+            return {}
+
+        reservations = StockReservation.objects.filter(order_id__in=order_ids)
+        taken = {}
+        reserved = set()
+        for order_id, product_id, quantity, state in reservations.order_by().values_list(
+            'order_id', 'product_id', 'quantity', 'status'
+        ):
+            reserved.add(order_id)
+            if state == 'confirmed':
+                taken.setdefault(order_id, []).append((product_id, quantity))
+        release_reservations(reservations)
+
+        unreserved = [order_id for order_id in order_ids if order_id not in reserved]
+        if unreserved:
+            items = OrderItem.objects.filter(order_id__in=unreserved).order_by()
+            for order_id, product_id, quantity in items.values_list('order_id', 'product_id', 'quantity'):
+                taken.setdefault(order_id, []).append((product_id, quantity))
+
+        adjustments = [
+            StockAdjustment(order_id=order_id, product_id=product_id, quantity=quantity, reason=reason)
+            for order_id, lines in taken.items()
+            for product_id, quantity in sum_quantities(lines).items()
+        ]
+        quantities = sum_quantities((a.product_id, a.quantity) for a in adjustments)
+        put_back_stock(quantities)
+        StockAdjustment.objects.bulk_create(adjustments, batch_size=1000)
+    return quantities
@@ -0,0 +1,99 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from store.search import ProductSearchIndex
+
+BRANDS = ['Kyocera', 'Ricoh', 'Canon', 'HP', 'Sharp', 'Konica', 'Epson', 'Brother', 'Xerox', 'Lexmark']
+SERIES = ['TASKalfa', 'ECOSYS', 'Bizhub', 'LaserJet', 'imageRUNNER', 'Aficio', 'WorkForce', 'VersaLink']
+KINDS = ['printer', 'copier', 'toner', 'drum', 'fuser', 'roller', 'scanner', 'cartridge', 'tray', 'finisher']
+WORDS = (
+    'mono colour color laser inkjet duplex network wireless office high yield genuine compatible '
+    'black cyan magenta yellow a3 a4 multifunction print copy scan fax ppm dpi paper feeder '
+    'replacement original kit unit maintenance waste developer transfer belt lower upper pickup'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the product search index against a linear icontains scan on a synthetic catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--scan-queries', type=int, default=20,
+                            help='Queries to time for the linear scan baseline (it is slow)')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def synthetic_catalog(self, count, rng):
+        for product_id in range(1, count + 1):
+            brand = rng.choice(BRANDS)
+            kind = rng.choice(KINDS)
+            model = f"{rng.choice(SERIES)} {rng.randint(100, 9999)}{rng.choice(['', 'i', 'dn', 'idn'])}"
+            yield (
+                product_id,
+                f"{brand} {model} {kind}",
+                f"{brand[:2].upper()}-{product_id:06d}",
+                ' '.join(rng.choices(WORDS, k=12)),
+                ' '.join(rng.choices(WORDS, k=80)),
+            )
+
+    def queries(self, catalog, count, rng):
+        queries = []
+        for _ in range(count):
+            product_id, name, sku, short_description, description = rng.choice(catalog)
+            kind = rng.randrange(4)
+            if kind == 0:
+                queries.append(rng.choice(name.split()))
+            elif kind == 1:
+                queries.append(' '.join(rng.sample(name.split(), 2)))
+            elif kind == 2:
+                queries.append(name.split()[1][:3])  # search-as-you-type prefix
+            else:
+                queries.append(sku)
+        return queries
+
+    def time_queries(self, search, queries):
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            search(query)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        return statistics.median(timings), timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0]
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        catalog = list(self.synthetic_catalog(options['products'], rng))
+        queries = self.queries(catalog, options['queries'], rng)
+
+        start = time.perf_counter()
+        index = ProductSearchIndex()
+        for row in catalog:
+            index.add(*row)
+        build_seconds = time.perf_counter() - start
+        self.stdout.write(
+            f"Indexed {len(index)} products ({len(index.postings)} terms) in {build_seconds:.2f}s"
+        )
+
+        median, p95 = self.time_queries(lambda query: index.search(query, limit=500), queries)
+        self.stdout.write(f"Index search:  p50 {median:.2f} ms  p95 {p95:.2f} ms  ({len(queries)} queries)")
+
+        def scan(query):
+            needle = query.lower()
+            return [
+                row[0] for row in catalog
+                if any(needle in field.lower() for field in row[1:])
+            ]
+
+        median, p95 = self.time_queries(scan, queries[:options['scan_queries']])
+        self.stdout.write(
+            f"Linear scan:   p50 {median:.2f} ms  p95 {p95:.2f} ms  ({options['scan_queries']} queries, "
+            "icontains equivalent, unranked)"
+        )
+
+        sku_query = catalog[len(catalog) // 2][2]
+        top = index.search(sku_query, limit=1)
+        self.stdout.write(
+            self.style.SUCCESS(f"SKU '{sku_query}' ranks product {top[0][0] if top else None} first")
+        )
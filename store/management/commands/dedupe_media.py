@@ -0,0 +1,95 @@
+import os
+import shutil
+
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from store.catalog import category_tree, touch_catalog
+from store.images import DERIVATIVE_FORMATS, DERIVATIVE_WIDTHS, IMAGE_FIELDS, delete_derivatives, derivative_name
+from store.storage import content_digest, media_storage
+
+
+class Command(BaseCommand):
+    help = (
+        'Rename catalog images in media/ to their content-addressed names, collapse '
+        'byte-identical copies into one blob and repoint the rows that used them'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without touching anything')
+
+    def walk(self, directory):
+        if not media_storage.exists(directory):
+            return
+        directories, files = media_storage.listdir(directory)
+        for name in files:
+            yield f'{directory}/{name}'
+        for child in directories:
+            yield from self.walk(f'{directory}/{child}')
+
+    def link(self, source, target):
+        """Make ``target`` exist without removing ``source``, so rows stay valid until repointed"""
+        source_path, target_path = media_storage.path(source), media_storage.path(target)
+        if os.path.exists(target_path):
+            return
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        try:
+            os.link(source_path, target_path)
+        except OSError:
+            shutil.copy2(source_path, target_path)
+
+    def handle(self, *args, **options):
+        fields = [
+            (apps.get_model(label), field)
+            for label, field in IMAGE_FIELDS
+        ]
+        directories = sorted({model._meta.get_field(field).upload_to.strip('/') for model, field in fields})
+
+        renames = {}
+        blobs = set()
+        duplicate_bytes = 0
+        for directory in directories:
+            for name in self.walk(directory):
+                with media_storage.open(name, 'rb') as content:
+                    target = media_storage.addressed_name(name, content_digest(content))
+                if target in blobs and target != name:
+                    duplicate_bytes += media_storage.size(name)
+                blobs.add(target)
+                if target != name:
+                    renames[name] = target
+
+        self.stdout.write(
+            f'{len(renames)} files to rename into {len(blobs)} blobs; '
+            f'{duplicate_bytes} bytes held by duplicates'
+        )
+        if options['dry_run'] or not renames:
+            return
+
+        # 1. Every target blob exists before any row points at it
+        for name, target in renames.items():
+            self.link(name, target)
+            for width in DERIVATIVE_WIDTHS:
+                for fmt in DERIVATIVE_FORMATS:
+                    derivative, target_derivative = derivative_name(name, width, fmt), derivative_name(target, width, fmt)
+                    if default_storage.exists(derivative) and not default_storage.exists(target_derivative):
+                        os.makedirs(os.path.dirname(default_storage.path(target_derivative)), exist_ok=True)
+                        os.replace(default_storage.path(derivative), default_storage.path(target_derivative))
+
+        # 2. Repoint rows; update() skips the save signals, so invalidate by hand
+        rows = 0
+        with transaction.atomic():
+            for model, field in fields:
+                for name, target in renames.items():
+                    rows += model._default_manager.filter(**{field: name}).update(**{field: target})
+            transaction.on_commit(category_tree.invalidate)
+            transaction.on_commit(touch_catalog)
+
+        # 3. Only now drop the old names
+        for name in renames:
+            media_storage.delete(name)
+            delete_derivatives(name)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Repointed {rows} rows; freed {duplicate_bytes} bytes'
+        ))
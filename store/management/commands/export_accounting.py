@@ -0,0 +1,42 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from store.exports import BATCH_SIZE, DATASETS, FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = (
+        'Write orders, order items or M-Pesa transactions created in a date range as CSV or '
+        'NDJSON, streaming rows in batches so a year of data runs in bounded memory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(DATASETS))
+        parser.add_argument('--start', type=date.fromisoformat, help='First day, YYYY-MM-DD (default: 30 days ago)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day, YYYY-MM-DD (default: today)')
+        parser.add_argument('--output', choices=list(FORMATS), default='csv')
+        parser.add_argument('--file', help='Write here instead of stdout')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate()
+        start = options['start'] or end - timedelta(days=29)
+        if start > end:
+            raise CommandError('--start must not be after --end')
+
+        lines = export_lines(options['dataset'], start, end, options['output'], options['batch_size'])
+        if options['file']:
+            with open(options['file'], 'w', encoding='utf-8', newline='') as out:
+                count = self.write(lines, out)
+            self.stderr.write(self.style.SUCCESS(f"Wrote {count} lines to {options['file']}"))
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
+
+    def write(self, lines, out):
+        count = 0
+        for line in lines:
+            out.write(line)
+            count += 1
+        return count
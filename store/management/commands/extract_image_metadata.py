@@ -0,0 +1,77 @@
+import os
+from multiprocessing import Pool
+
+import django
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from store.catalog import touch_catalog
+from store.images import METADATA_FIELDS, image_metadata
+
+METADATA_KEYS = ('width', 'height', 'color', 'placeholder')
+
+
+def init_worker():
+    # Needed under the spawn start method; a no-op for forked workers
+    django.setup()
+
+
+def extract(name):
+    try:
+        with default_storage.open(name, 'rb') as image:
+            return name, image_metadata(image), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class Command(BaseCommand):
+    help = (
+        'Store width, height, dominant colour and placeholder for catalog images '
+        'that lack them, decoding the files across a process pool'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Re-extract images that already have metadata')
+
+    def handle(self, *args, **options):
+        pending = []
+        for label, field in METADATA_FIELDS:
+            model = apps.get_model(label)
+            rows = model.objects.exclude(**{field: ''})
+            if not options['force']:
+                rows = rows.filter(**{f'{field}_placeholder': ''})
+            pending.append((model, field, list(rows.values_list('pk', field))))
+
+        # Shared blobs are decoded once
+        names = sorted({name for model, field, rows in pending for pk, name in rows})
+        connections.close_all()
+
+        metadata = {}
+        with Pool(options['processes'], initializer=init_worker) as pool:
+            for name, result, error in pool.imap_unordered(extract, names, chunksize=4):
+                if error:
+                    self.stderr.write(f'{name}: {error}')
+                else:
+                    metadata[name] = result
+
+        updated = 0
+        with transaction.atomic():
+            for model, field, rows in pending:
+                objs = []
+                for pk, name in rows:
+                    if name in metadata:
+                        obj = model(pk=pk)
+                        for key in METADATA_KEYS:
+                            setattr(obj, f'{field}_{key}', metadata[name][key])
+                        objs.append(obj)
+                model.objects.bulk_update(objs, [f'{field}_{key}' for key in METADATA_KEYS], batch_size=500)
+                updated += len(objs)
+            # bulk_update skips the save signals
+            if updated:
+                transaction.on_commit(touch_catalog)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored metadata for {updated} rows from {len(metadata)} of {len(names)} images'
+        ))
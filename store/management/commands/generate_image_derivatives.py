@@ -0,0 +1,54 @@
+import os
+from multiprocessing import Pool
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+from store.images import IMAGE_FIELDS, derivatives_changed, generate_derivatives
+
+
+def init_worker():
+    # Needed under the spawn start method; a no-op for forked workers
+    django.setup()
+
+
+def build(job):
+    name, force = job
+    try:
+        return name, generate_derivatives(name, force=force), None
+    except Exception as e:
+        return name, 0, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Generate responsive WebP/JPEG derivatives for every catalog image, across a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Rebuild derivatives that already exist')
+
+    def handle(self, *args, **options):
+        names = set()
+        for label, field in IMAGE_FIELDS:
+            model = apps.get_model(label)
+            names.update(model.objects.exclude(**{field: ''}).values_list(field, flat=True).distinct())
+
+        # Workers only touch storage; don't hand them inherited DB connections
+        connections.close_all()
+
+        jobs = [(name, options['force']) for name in sorted(names)]
+        files = failures = 0
+        with Pool(options['processes'], initializer=init_worker) as pool:
+            for name, written, error in pool.imap_unordered(build, jobs, chunksize=4):
+                if error:
+                    failures += 1
+                    self.stderr.write(f'{name}: {error}')
+                files += written
+        if files:
+            derivatives_changed()
+
+        style = self.style.WARNING if failures else self.style.SUCCESS
+        self.stdout.write(style(
+            f'Wrote {files} derivative files for {len(jobs)} images ({failures} failed)'
+        ))
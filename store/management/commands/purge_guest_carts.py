@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from store.models import Cart
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete abandoned guest carts left in the database and expired sessions, in batches. '
+        'Cache-backed guest carts expire on their own after GUEST_CART_TIMEOUT.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Delete guest carts not updated for this many days')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def purge(self, queryset, batch_size):
+        """Delete in primary-key batches so no single statement holds long locks"""
+        deleted = 0
+        while True:
+            ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            queryset.model.objects.filter(pk__in=ids).delete()
+            deleted += len(ids)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        carts = self.purge(
+            Cart.objects.filter(user__isnull=True, updated_at__lt=now - timedelta(days=options['days'])),
+            options['batch_size']
+        )
+        sessions = self.purge(Session.objects.filter(expire_date__lt=now), options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {carts} guest carts and {sessions} expired sessions'
+        ))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from store.catalog import category_tree, touch_catalog
+from store.models import Brand, Category, Product
+
+
+def active_product_count(field):
+    """Correlated COUNT of active products pointing at the outer row through ``field``"""
+    counts = Product.objects.filter(
+        **{field: OuterRef('pk')}, active=True
+    ).order_by().values(field).annotate(total=Count('id')).values('total')
+    return Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized active product counters on brands and categories'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            brands = Brand.objects.update(active_product_count=active_product_count('brand'))
+            categories = Category.objects.update(active_product_count=active_product_count('category'))
+            transaction.on_commit(category_tree.invalidate)
+            transaction.on_commit(touch_catalog)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Rebuilt product counts for {brands} brands and {categories} categories')
+        )
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from store.reports import refresh_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the daily sales rollups for days with orders changed since the last run. '
+        'Run from cron every few minutes; --full rebuilds every day (e.g. after deleting orders).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild every day, not just changed ones')
+
+    def handle(self, *args, **options):
+        days = refresh_rollups(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(f'Rolled up {len(days)} days'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from store.inventory import release_reservations
+from store.models import Order, StockReservation
+
+
+class Command(BaseCommand):
+    help = (
+        'Release stock held for orders whose M-Pesa payment never arrived and cancel '
+        'those orders, in batches. Run it every minute or so.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = StockReservation.objects.filter(status='held', expires_at__lte=now)
+        released = cancelled = 0
+        while True:
+            # Batches in primary-key order, so no single statement holds long locks
+            ids = list(expired.order_by('pk').values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                order_ids = set(StockReservation.objects.filter(pk__in=ids).values_list('order_id', flat=True))
+                released += release_reservations(StockReservation.objects.filter(pk__in=ids))
+                cancelled += Order.objects.filter(
+                    id__in=order_ids, status='pending', payment_status__in=['pending', 'failed']
+                ).update(status='cancelled', payment_status='cancelled', cancelled_at=now, updated_at=now)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Released {released} expired reservations and cancelled {cancelled} unpaid orders'
+        ))
@@ -0,0 +1,85 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from store.catalog import touch_catalog
+from store.models import OrderItem, Product, ProductSalesRank
+
+WINDOWS = (7, 30, 90)
+
+
+def velocity(sold):
+    """
+    Mean units per day across the windows. A recent sale counts in all three
+    windows, so recent demand outweighs an old bulk order.
+    """
+    return sum(sold.get(days, 0) / days for days in WINDOWS) / len(WINDOWS)
+
+
+class Command(BaseCommand):
+    help = (
+        'Rank products by paid units over 7/30/90-day windows, then update '
+        'Product.sales_rank and the best_seller flag. Run from cron, e.g. hourly.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--best-sellers', type=int, default=12,
+                            help='Number of top-ranked products flagged as best sellers')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        paid_items = OrderItem.objects.filter(order__payment_status='paid').exclude(
+            order__status__in=['cancelled', 'refunded']
+        )
+
+        # One grouped query per window
+        units = {}
+        for days in WINDOWS:
+            rows = paid_items.filter(
+                order__paid_at__gte=now - timedelta(days=days)
+            ).values('product_id').annotate(units=Sum('quantity')).order_by()
+            for row in rows:
+                units.setdefault(row['product_id'], {})[days] = row['units']
+
+        scored = sorted(
+            (
+                (velocity(sold), product_id, sold)
+                for product_id, sold in units.items()
+            ),
+            key=lambda item: (-item[0], item[1])
+        )
+        ranks = {}
+        sales_ranks = []
+        for rank, (score, product_id, sold) in enumerate(scored, start=1):
+            ranks[product_id] = rank
+            sales_ranks.append(ProductSalesRank(
+                product_id=product_id,
+                units_7d=sold.get(7, 0),
+                units_30d=sold.get(30, 0),
+                units_90d=sold.get(90, 0),
+                score=score,
+                rank=rank,
+                computed_at=now,
+            ))
+
+        # Only write the products whose rank or flag actually moved
+        best_seller_limit = options['best_sellers']
+        changed = []
+        for product_id, sales_rank, best_seller in Product.objects.values_list('id', 'sales_rank', 'best_seller'):
+            new_rank = ranks.get(product_id, Product.UNRANKED)
+            new_best_seller = new_rank <= best_seller_limit
+            if (sales_rank, best_seller) != (new_rank, new_best_seller):
+                changed.append(Product(id=product_id, sales_rank=new_rank, best_seller=new_best_seller))
+
+        with transaction.atomic():
+            ProductSalesRank.objects.all().delete()
+            ProductSalesRank.objects.bulk_create(sales_ranks, batch_size=500)
+            Product.objects.bulk_update(changed, ['sales_rank', 'best_seller'], batch_size=500)
+            if changed:
+                transaction.on_commit(touch_catalog)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Ranked {len(sales_ranks)} products with recent sales; updated {len(changed)} products'
+        ))
@@ -0,0 +1,55 @@
+"""
+Serves MEDIA_URL from MEDIA_ROOT without reading the files in Python.
+
+Uploads appear at runtime, so each request is resolved with a stat() rather
+than whitenoise's startup scan. The response then goes through whitenoise's
+responder: conditional GETs, HEAD, byte ranges, and ``wsgi.file_wrapper``,
+which gunicorn turns into sendfile(). With ``MEDIA_ACCEL_REDIRECT`` set to an
+internal nginx location, the response only carries ``X-Accel-Redirect`` and
+nginx sends the bytes.
+
+Content-addressed images (store.storage) and their derivatives never change
+under a given URL, so they are marked immutable.
+"""
+import re
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.http import HttpResponse
+from whitenoise.base import WhiteNoise
+from whitenoise.middleware import WhiteNoiseMiddleware
+from whitenoise.string_utils import ensure_leading_trailing_slash
+
+CONTENT_ADDRESSED = re.compile(r'/[0-9a-f]{64}(-\d+w)?\.\w+$')
+
+
+class MediaMiddleware(WhiteNoise):
+    def __init__(self, get_response):
+        super().__init__(application=None, max_age=getattr(settings, 'MEDIA_MAX_AGE', 3600))
+        self.get_response = get_response
+        self.prefix = ensure_leading_trailing_slash(urlparse(settings.MEDIA_URL).path)
+        self.accel_redirect = getattr(settings, 'MEDIA_ACCEL_REDIRECT', '')
+        root = str(settings.MEDIA_ROOT).rstrip('/') + '/'
+        self.directories = [(root, self.prefix)]
+
+    def immutable_file_test(self, path, url):
+        return bool(CONTENT_ADDRESSED.search(url))
+
+    def __call__(self, request):
+        if not request.path_info.startswith(self.prefix):
+            return self.get_response(request)
+        media_file = self.find_file(request.path_info)
+        if media_file is None:
+            return self.get_response(request)
+        if self.accel_redirect:
+            return self.accel_response(media_file, request)
+        return WhiteNoiseMiddleware.serve(media_file, request)
+
+    def accel_response(self, media_file, request):
+        response = HttpResponse()
+        del response['Content-Type']
+        for key, value in media_file.get_response('HEAD', {}).headers:
+            if key.lower() in ('content-type', 'cache-control', 'access-control-allow-origin'):
+                response[key] = value
+        response['X-Accel-Redirect'] = ensure_leading_trailing_slash(self.accel_redirect) + request.path_info[len(self.prefix):]
+        return response
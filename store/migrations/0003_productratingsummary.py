@@ -0,0 +1,64 @@
+# Generated by Django 5.2.7 on 2026-10-16 23:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+STAR_FIELDS = {1: 'one_star', 2: 'two_star', 3: 'three_star', 4: 'four_star', 5: 'five_star'}
+
+
+def build_rating_summaries(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductReview = apps.get_model('store', 'ProductReview')
+    ProductRatingSummary = apps.get_model('store', 'ProductRatingSummary')
+
+    star_counts = {field: Count('id', filter=Q(rating=stars)) for stars, field in STAR_FIELDS.items()}
+    rows = {
+        row.pop('product_id'): row
+        for row in ProductReview.objects.values('product_id').annotate(
+            review_count=Count('id'), rating_total=Sum('rating'), **star_counts
+        )
+    }
+    summaries = []
+    for product_id in Product.objects.values_list('id', flat=True):
+        summary = ProductRatingSummary(product_id=product_id, **rows.get(product_id, {}))
+        if summary.review_count:
+            summary.average_rating = summary.rating_total / summary.review_count
+        summaries.append(summary)
+    ProductRatingSummary.objects.bulk_create(summaries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_cart_order_orderitem_shippingaddress_wishlist_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='short_description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.CreateModel(
+            name='ProductRatingSummary',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rating_summary', serialize=False, to='store.product')),
+                ('average_rating', models.FloatField(default=0)),
+                ('review_count', models.IntegerField(default=0)),
+                ('rating_total', models.IntegerField(default=0)),
+                ('one_star', models.IntegerField(default=0)),
+                ('two_star', models.IntegerField(default=0)),
+                ('three_star', models.IntegerField(default=0)),
+                ('four_star', models.IntegerField(default=0)),
+                ('five_star', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'product_rating_summaries',
+                'indexes': [models.Index(fields=['average_rating'], name='product_rat_average_20cfe1_idx')],
+            },
+        ),
+        migrations.RunPython(build_rating_summaries, migrations.RunPython.noop),
+    ]
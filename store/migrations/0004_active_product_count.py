@@ -0,0 +1,37 @@
+# Generated by Django 5.2.7 on 2026-10-16 23:57
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def count_active_products(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    for model_name, field in (('Brand', 'brand'), ('Category', 'category')):
+        counts = Product.objects.filter(
+            **{field: OuterRef('pk')}, active=True
+        ).order_by().values(field).annotate(total=Count('id')).values('total')
+        apps.get_model('store', model_name).objects.update(
+            active_product_count=Coalesce(Subquery(counts, output_field=IntegerField()), Value(0))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0003_productratingsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brand',
+            name='active_product_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='active_product_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_active_products, migrations.RunPython.noop),
+    ]
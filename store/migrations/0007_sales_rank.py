@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-17 00:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSalesRank',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sales', serialize=False, to='store.product')),
+                ('units_7d', models.IntegerField(default=0)),
+                ('units_30d', models.IntegerField(default=0)),
+                ('units_90d', models.IntegerField(default=0)),
+                ('score', models.FloatField(default=0)),
+                ('rank', models.PositiveIntegerField()),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'product_sales_ranks',
+                'ordering': ['rank'],
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='sales_rank',
+            field=models.PositiveIntegerField(default=2147483647, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['payment_status', 'paid_at'], name='orders_payment_14ea03_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sales_rank'], name='products_sales_r_16f73e_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.7 on 2026-10-17 00:10
+
+import store.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_sales_rank'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='brand',
+            name='logo',
+            field=models.ImageField(blank=True, storage=store.storage.ContentAddressedStorage(), upload_to='brands/'),
+        ),
+        migrations.AlterField(
+            model_name='category',
+            name='image',
+            field=models.ImageField(blank=True, storage=store.storage.ContentAddressedStorage(), upload_to='categories/'),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='main_image',
+            field=models.ImageField(storage=store.storage.ContentAddressedStorage(), upload_to='products/'),
+        ),
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(storage=store.storage.ContentAddressedStorage(), upload_to='products/'),
+        ),
+    ]
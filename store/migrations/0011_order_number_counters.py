@@ -0,0 +1,41 @@
+# Generated by Django 5.2.7 on 2026-10-17 00:29
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def seed_today(apps, schema_editor):
+    """Start today's counter past any random-suffix numbers already issued today"""
+    Order = apps.get_model('store', 'Order')
+    OrderNumberCounter = apps.get_model('store', 'OrderNumberCounter')
+    day = timezone.now().date()
+    prefix = f"ORD{day.strftime('%Y%m%d')}"
+    suffixes = [
+        int(number[len(prefix):])
+        for number in Order.objects.filter(order_number__startswith=prefix).values_list('order_number', flat=True)
+        if number[len(prefix):].isdigit()
+    ]
+    if suffixes:
+        OrderNumberCounter.objects.create(day=day, last=max(suffixes))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderNumberCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('last', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'order_number_counters',
+            },
+        ),
+        migrations.RunPython(seed_today, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-17 00:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_order_number_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockAdjustment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(help_text='Units added to stock (negative when removed)')),
+                ('reason', models.CharField(choices=[('cancelled', 'Order cancelled'), ('refunded', 'Order refunded')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_adjustments', to='store.order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_adjustments', to='store.product')),
+            ],
+            options={
+                'db_table': 'stock_adjustments',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['order', 'reason'], name='stock_adjus_order_i_973e9f_idx'), models.Index(fields=['product', 'created_at'], name='stock_adjus_product_dcec8f_idx')],
+            },
+        ),
+    ]
@@ -1,7 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.text import slugify
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
+from .storage import media_storage
 
 User = get_user_model()
 
@@ -9,12 +13,15 @@ class Category(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True, max_length=150)
     description = models.TextField(blank=True)
-    image = models.ImageField(upload_to='categories/', blank=True)
+    image = models.ImageField(upload_to='categories/', storage=media_storage, blank=True)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
     featured = models.BooleanField(default=False)
     active = models.BooleanField(default=True)
     order = models.IntegerField(default=0)
     
+    # Maintained by store.signals, rebuilt by `manage.py rebuild_product_counts`
+    active_product_count = models.IntegerField(default=0, editable=False)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -35,10 +42,19 @@ class Brand(models.Model):
     name = models.CharField(max_length=100)
     slug = models.SlugField(unique=True, max_length=150)
     description = models.TextField(blank=True)
-    logo = models.ImageField(upload_to='brands/', blank=True)
+    logo = models.ImageField(upload_to='brands/', storage=media_storage, blank=True)
     website = models.URLField(blank=True)
     active = models.BooleanField(default=True)
     
+    # Filled from the file by store.signals, backfilled by `manage.py extract_image_metadata`
+    logo_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    logo_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    logo_color = models.CharField(max_length=7, blank=True, editable=False)
+    logo_placeholder = models.TextField(blank=True, editable=False)
+    
+    # Maintained by store.signals, rebuilt by `manage.py rebuild_product_counts`
+    active_product_count = models.IntegerField(default=0, editable=False)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -97,7 +113,12 @@ class Product(models.Model):
     )
     
     # Images
-    main_image = models.ImageField(upload_to='products/')
+    main_image = models.ImageField(upload_to='products/', storage=media_storage)
+    # Filled from the file by store.signals, backfilled by `manage.py extract_image_metadata`
+    main_image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    main_image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    main_image_color = models.CharField(max_length=7, blank=True, editable=False)
+    main_image_placeholder = models.TextField(blank=True, editable=False)
     
     # Inventory
     stock = models.IntegerField(default=0, validators=[MinValueValidator(0)])
@@ -110,6 +131,10 @@ class Product(models.Model):
     on_sale = models.BooleanField(default=False)
     active = models.BooleanField(default=True)
     
+    # Sales velocity, set by `manage.py update_sales_ranks` (1 = fastest seller)
+    UNRANKED = 2147483647
+    sales_rank = models.PositiveIntegerField(default=UNRANKED, editable=False)
+    
     # Physical attributes
     weight = models.DecimalField(
         max_digits=8, 
@@ -140,7 +165,9 @@ class Product(models.Model):
             models.Index(fields=['new_arrival']),
             models.Index(fields=['active']),
             models.Index(fields=['price']),
+            models.Index(fields=['name']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['sales_rank']),
         ]
     
     def __str__(self):
@@ -170,11 +197,21 @@ class Product(models.Model):
     
     @property
     def in_stock(self):
-        return self.stock > 0
+        # Listings annotate held_stock (store.inventory.with_available_stock) so
+        # units held for unpaid orders do not count
+        return self.stock - getattr(self, 'held_stock', 0) > 0
     
     @property
     def low_stock(self):
         return 0 < self.stock <= self.low_stock_threshold
+    
+    @property
+    def rating_stats(self):
+        """Rating summary row, or an empty unsaved one if it has not been built yet"""
+        try:
+            return self.rating_summary
+        except ObjectDoesNotExist:
+            return ProductRatingSummary(product=self)
 
 class ProductImage(models.Model):
     product = models.ForeignKey(
@@ -182,11 +219,18 @@ class ProductImage(models.Model):
         on_delete=models.CASCADE, 
         related_name='additional_images'
     )
-    image = models.ImageField(upload_to='products/')
+    image = models.ImageField(upload_to='products/', storage=media_storage)
     alt_text = models.CharField(max_length=200, blank=True)
     order = models.IntegerField(default=0)
     
+    # Filled from the file by store.signals, backfilled by `manage.py extract_image_metadata`
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    image_color = models.CharField(max_length=7, blank=True, editable=False)
+    image_placeholder = models.TextField(blank=True, editable=False)
+    
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         ordering = ['order', 'created_at']
@@ -248,6 +292,138 @@ class ProductReview(models.Model):
     def __str__(self):
         return f"{self.user.username} - {self.product.name} - {self.rating} Stars"
 
+class ProductRatingSummary(models.Model):
+    """
+    Read model of a product's reviews, kept up to date incrementally by the
+    ProductReview signals so listings never aggregate reviews per row.
+    """
+    STAR_FIELDS = {
+        1: 'one_star',
+        2: 'two_star',
+        3: 'three_star',
+        4: 'four_star',
+        5: 'five_star',
+    }
+    
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='rating_summary'
+    )
+    average_rating = models.FloatField(default=0)
+    review_count = models.IntegerField(default=0)
+    rating_total = models.IntegerField(default=0)
+    
+    # Histogram
+    one_star = models.IntegerField(default=0)
+    two_star = models.IntegerField(default=0)
+    three_star = models.IntegerField(default=0)
+    four_star = models.IntegerField(default=0)
+    five_star = models.IntegerField(default=0)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'product_rating_summaries'
+        indexes = [
+            models.Index(fields=['average_rating']),
+        ]
+    
+    def __str__(self):
+        return f"{self.product_id}: {self.average_rating:.2f} ({self.review_count} reviews)"
+    
+    @property
+    def histogram(self):
+        return {str(stars): getattr(self, field) for stars, field in self.STAR_FIELDS.items()}
+    
+    @classmethod
+    def apply_review(cls, product_id, rating, delta):
+        """Add (delta=1) or remove (delta=-1) one review of ``rating`` stars"""
+        star_field = cls.STAR_FIELDS[rating]
+        with transaction.atomic():
+            updated = cls.objects.filter(product_id=product_id).update(
+                review_count=F('review_count') + delta,
+                rating_total=F('rating_total') + delta * rating,
+                **{star_field: F(star_field) + delta}
+            )
+            if not updated:
+                # Summary missing (e.g. bulk-created product): rebuild it from the
+                # reviews. Nothing to do on removal, which also covers cascades
+                # where the product and its summary are being deleted.
+                if delta > 0:
+                    cls.rebuild(product_ids=[product_id])
+                return
+            # Separate statement: MySQL evaluates SET clauses left to right
+            cls.objects.filter(product_id=product_id).update(
+                average_rating=Case(
+                    When(review_count__gt=0, then=Cast('rating_total', FloatField()) / F('review_count')),
+                    default=Value(0.0),
+                    output_field=FloatField()
+                )
+            )
+    
+    @classmethod
+    def rebuild(cls, product_ids=None):
+        """Recompute summaries from the reviews table in one grouped query"""
+        products = Product.objects.all()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        
+        star_counts = {
+            field: Count('id', filter=Q(rating=stars))
+            for stars, field in cls.STAR_FIELDS.items()
+        }
+        reviews = ProductReview.objects.filter(product__in=products).values('product_id').annotate(
+            review_count=Count('id'),
+            rating_total=Sum('rating'),
+            **star_counts
+        )
+        rows = {row.pop('product_id'): row for row in reviews}
+        
+        summaries = []
+        for product_id in products.values_list('id', flat=True):
+            row = rows.get(product_id, {})
+            summary = cls(product_id=product_id, **row)
+            if summary.review_count:
+                summary.average_rating = summary.rating_total / summary.review_count
+            summaries.append(summary)
+        
+        with transaction.atomic():
+            cls.objects.filter(product__in=products).delete()
+            cls.objects.bulk_create(summaries, batch_size=500)
+        return len(summaries)
+
+
+class ProductSalesRank(models.Model):
+    """Paid units per sliding window, written by `manage.py update_sales_ranks`"""
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='sales'
+    )
+    units_7d = models.IntegerField(default=0)
+    units_30d = models.IntegerField(default=0)
+    units_90d = models.IntegerField(default=0)
+    score = models.FloatField(default=0)
+    rank = models.PositiveIntegerField()
+    computed_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'product_sales_ranks'
+        ordering = ['rank']
+    
+    def __str__(self):
+        return f"#{self.rank} {self.product_id} ({self.units_30d} in 30 days)"
+
+def sum_cart_items(items):
+    """Totals of CartItems whose products are already loaded"""
+    return {
+        'total_price': sum(item.total_price for item in items),
+        'total_quantity': sum(item.quantity for item in items),
+        'item_count': len(items),
+    }
 
 class Cart(models.Model):
     user = models.ForeignKey(
@@ -270,17 +446,38 @@ class Cart(models.Model):
             return f"Cart for {self.user.username}"
         return f"Cart (Session: {self.session_key})"
     
+    def get_totals(self):
+        """
+        Price, quantity and line count of the cart: summed from the prefetched
+        items (loaded with their products) when a view has them, otherwise one
+        aggregate query, remembered on the instance.
+        """
+        items = getattr(self, '_prefetched_objects_cache', {}).get('items')
+        if items is not None:
+            return sum_cart_items(items)
+        if getattr(self, '_totals', None) is None:
+            totals = self.items.aggregate(
+                total_price=Sum(
+                    F('quantity') * F('product__price'),
+                    output_field=models.DecimalField(max_digits=12, decimal_places=2)
+                ),
+                total_quantity=Sum('quantity'),
+                item_count=Count('id'),
+            )
+            self._totals = {key: value or 0 for key, value in totals.items()}
+        return self._totals
+    
     @property
     def total_price(self):
-        return sum(item.total_price for item in self.items.all())
+        return self.get_totals()['total_price']
     
     @property
     def total_quantity(self):
-        return sum(item.quantity for item in self.items.all())
+        return self.get_totals()['total_quantity']
     
     @property
     def is_empty(self):
-        return self.items.count() == 0
+        return self.get_totals()['item_count'] == 0
 
 class CartItem(models.Model):
     cart = models.ForeignKey(
@@ -389,6 +586,9 @@ class Order(models.Model):
             models.Index(fields=['status']),
             models.Index(fields=['payment_status']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['user', 'created_at']),
+            models.Index(fields=['payment_status', 'paid_at']),
+            models.Index(fields=['updated_at']),
         ]
     
     def __str__(self):
@@ -400,9 +600,8 @@ class Order(models.Model):
         super().save(*args, **kwargs)
     
     def generate_order_number(self):
-        import random
-        import string
-        return f"ORD{self.created_at.strftime('%Y%m%d')}{''.join(random.choices(string.digits, k=6))}"
+        from .order_numbers import allocate_order_number
+        return allocate_order_number()
     
     @property
     def can_be_cancelled(self):
@@ -410,6 +609,12 @@ class Order(models.Model):
     
     @property
     def items_count(self):
+        """Line count: from prefetched items or a ``line_count`` annotation when a view has them"""
+        items = getattr(self, '_prefetched_objects_cache', {}).get('items')
+        if items is not None:
+            return len(items)
+        if getattr(self, 'line_count', None) is not None:
+            return self.line_count
         return self.items.count()
 
 class OrderItem(models.Model):
@@ -447,6 +652,158 @@ class OrderItem(models.Model):
             self.product_sku = self.product.sku
         super().save(*args, **kwargs)
 
+class OrderNumberCounter(models.Model):
+    """Last order number sequence handed out for a day (see store.order_numbers)"""
+    day = models.DateField(unique=True)
+    last = models.PositiveBigIntegerField(default=0)
+    
+    class Meta:
+        db_table = 'order_number_counters'
+    
+    def __str__(self):
+        return f"{self.day}: {self.last}"
+
+class StockReservation(models.Model):
+    """
+    A hold on stock for an order awaiting payment (see store.inventory).
+    Product.stock stays on-hand stock; active holds are subtracted to get
+    what is available.
+    """
+    STATUS_CHOICES = [
+        ('held', 'Held'),
+        ('confirmed', 'Confirmed'),
+        ('released', 'Released'),
+    ]
+    
+    order = models.ForeignKey(
+        Order, 
+        on_delete=models.CASCADE, 
+        related_name='reservations'
+    )
+    product = models.ForeignKey(
+        Product, 
+        on_delete=models.CASCADE,
+        related_name='reservations'
+    )
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='held')
+    expires_at = models.DateTimeField()
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'stock_reservations'
+        ordering = ['id']
+        indexes = [
+            # Active holds per product, and the expiry sweep
+            models.Index(fields=['product', 'status', 'expires_at']),
+            models.Index(fields=['status', 'expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} for order {self.order_id} ({self.status})"
+
+class StockAdjustment(models.Model):
+    """One change made to a product's stock outside checkout, e.g. a cancelled order's items going back"""
+    REASON_CHOICES = [
+        ('cancelled', 'Order cancelled'),
+        ('refunded', 'Order refunded'),
+    ]
+    
+    product = models.ForeignKey(
+        Product, 
+        on_delete=models.CASCADE,
+        related_name='stock_adjustments'
+    )
+    order = models.ForeignKey(
+        Order, 
+        on_delete=models.SET_NULL,
+        null=True, 
+        blank=True,
+        related_name='stock_adjustments'
+    )
+    quantity = models.IntegerField(help_text="Units added to stock (negative when removed)")
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'stock_adjustments'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['order', 'reason']),
+            models.Index(fields=['product', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity:+d} x {self.product_id} ({self.reason})"
+
+class DailyOrderSales(models.Model):
+    """Orders and their amounts per day, status and payment method, written by store.reports"""
+    day = models.DateField()
+    status = models.CharField(max_length=20)
+    payment_method = models.CharField(max_length=20)
+    orders = models.PositiveIntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    shipping = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    tax = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        db_table = 'daily_order_sales'
+        ordering = ['day']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'status', 'payment_method'], name='daily_order_sales_key'),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.status}/{self.payment_method}: {self.orders} orders"
+
+class DailyProductSales(models.Model):
+    """Units and revenue per day, product, status and payment method, written by store.reports"""
+    day = models.DateField()
+    product = models.ForeignKey(
+        Product, 
+        on_delete=models.CASCADE,
+        related_name='daily_sales'
+    )
+    # The product's category and brand when the day was rolled up
+    category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, related_name='+')
+    brand = models.ForeignKey(Brand, on_delete=models.SET_NULL, null=True, related_name='+')
+    status = models.CharField(max_length=20)
+    payment_method = models.CharField(max_length=20)
+    orders = models.PositiveIntegerField(default=0)
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        db_table = 'daily_product_sales'
+        ordering = ['day']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['day', 'product', 'status', 'payment_method'], name='daily_product_sales_key'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'category']),
+            models.Index(fields=['day', 'brand']),
+        ]
+    
+    def __str__(self):
+        return f"{self.day} {self.product_id}: {self.units} units"
+
+class ReportWatermark(models.Model):
+    """How far a rollup has read: orders updated since ``value`` still need rolling up"""
+    name = models.CharField(max_length=50, unique=True)
+    value = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        db_table = 'report_watermarks'
+    
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
 class Wishlist(models.Model):
     user = models.ForeignKey(
         User, 
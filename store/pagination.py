@@ -0,0 +1,175 @@
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def encode_value(value):
+    # Full precision: DjangoJSONEncoder drops microseconds, which breaks seeks on timestamps
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f'Cannot encode {type(value).__name__} in a cursor')
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over whatever ordering the view's queryset already has,
+    with ``id`` appended as a tie-breaker. Each page is a ``WHERE (keys) > (last
+    row)`` seek, so page N costs the same as page 1 and no COUNT(*) is run.
+
+    ``?count=true`` adds a total, cached briefly per filtered queryset.
+    Requests that still send ``?page=`` get classic page-number pagination.
+    Ordering fields must be non-null.
+    """
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    count_cache_timeout = 60
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.fallback = None
+        if request.query_params.get('page'):
+            self.fallback = PageNumberPagination()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        self.ordering = self.get_ordering(queryset)
+        cursor = self.decode_cursor(request, queryset)
+        reverse = bool(cursor and cursor['r'])
+
+        self.count = self.get_count(queryset) if self.count_requested(request) else None
+
+        queryset = queryset.order_by(*[
+            ('-' if descending != reverse else '') + field for field, descending in self.ordering
+        ])
+        if cursor:
+            queryset = queryset.filter(self.keyset_filter(cursor['v'], reverse))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = rows
+        return rows
+
+    def get_ordering(self, queryset):
+        ordering = list(queryset.query.order_by) or list(queryset.model._meta.ordering)
+        fields = []
+        for field in ordering:
+            if not isinstance(field, str):
+                raise TypeError('KeysetPagination only supports ordering by field name')
+            fields.append((field.lstrip('-'), field.startswith('-')))
+        if not any(field in ('id', 'pk') for field, descending in fields):
+            fields.append(('id', fields[-1][1] if fields else False))
+        return fields
+
+    def keyset_filter(self, values, reverse):
+        """(a, b, id) after (x, y, z)  ->  a > x OR (a = x AND b > y) OR (a = x AND b = y AND id > z)"""
+        condition = Q()
+        for position, (field, descending) in enumerate(self.ordering):
+            lookup = 'lt' if descending != reverse else 'gt'
+            clause = Q(**{f'{field}__{lookup}': values[position]})
+            for previous in range(position):
+                clause &= Q(**{self.ordering[previous][0]: values[previous]})
+            condition |= clause
+        return condition
+
+    def row_values(self, row):
+        values = []
+        for field, descending in self.ordering:
+            value = row
+            for attr in field.split('__'):
+                value = getattr(value, attr)
+            values.append(value)
+        return values
+
+    def encode_cursor(self, row, reverse):
+        payload = json.dumps({'v': self.row_values(row), 'r': int(reverse)}, default=encode_value)
+        cursor = base64.urlsafe_b64encode(payload.encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def ordering_field(self, queryset, name):
+        """Model field (or annotation output field) behind an ordering key"""
+        if name in queryset.query.annotations:
+            return queryset.query.annotations[name].output_field
+        model = queryset.model
+        for part in name.split('__'):
+            field = model._meta.get_field(part)
+            model = field.related_model
+        return field
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            values = cursor['v']
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            # Cursors come back from clients: type every value like its column,
+            # so a tampered one is a 404 rather than a database error
+            for position, (field, descending) in enumerate(self.ordering):
+                value = values[position]
+                if not isinstance(value, (str, int, float)):
+                    raise ValueError
+                values[position] = self.ordering_field(queryset, field).to_python(value)
+            cursor['r'] = bool(cursor.get('r'))
+        except (TypeError, ValueError, KeyError, ArithmeticError, ValidationError, FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+        return cursor
+
+    def count_requested(self, request):
+        return request.query_params.get(self.count_query_param, '').lower() in ('1', 'true', 'yes')
+
+    def get_count(self, queryset):
+        queryset = queryset.order_by()
+        key = 'store:count:' + hashlib.sha1(str(queryset.query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            response = {'count': self.count, **response}
+        return Response(response)
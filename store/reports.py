@@ -0,0 +1,185 @@
+"""
+Daily sales rollups behind /api/reports/.
+
+DailyOrderSales and DailyProductSales hold one row per day (by order
+``created_at``) and dimension. ``refresh_rollups()`` finds the days touched by
+orders updated since the last watermark and rebuilds just those days from
+``orders`` and ``order_items``, so an order moving from pending to paid or
+cancelled leaves its old bucket as well as entering the new one. Reports then
+only read the rollups.
+
+Order updates made with ``QuerySet.update()`` must set ``updated_at`` to be
+picked up; deleted orders are only dropped by a full rebuild.
+"""
+from contextlib import nullcontext
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import Brand, Category, DailyOrderSales, DailyProductSales, Order, OrderItem, Product, ReportWatermark
+
+WATERMARK = 'daily_sales'
+
+# Re-read a little before the watermark: an order saved just before the last
+# run may have committed just after it
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Days rebuilt per transaction
+DAYS_PER_BATCH = 31
+
+ORDER_METRICS = ('orders', 'subtotal', 'shipping', 'tax', 'discount', 'total')
+PRODUCT_METRICS = ('orders', 'units', 'revenue')
+
+# group_by -> (rollup, column grouped on)
+DIMENSIONS = {
+    'day': (DailyOrderSales, 'day'),
+    'status': (DailyOrderSales, 'status'),
+    'payment_method': (DailyOrderSales, 'payment_method'),
+    'product': (DailyProductSales, 'product_id'),
+    'category': (DailyProductSales, 'category_id'),
+    'brand': (DailyProductSales, 'brand_id'),
+}
+
+# Revenue questions usually leave these out; ?status= overrides
+EXCLUDED_STATUSES = ('cancelled', 'refunded')
+
+
+def day_range(days):
+    """Orders created on any of ``days``, as created_at ranges an index can use"""
+    condition = Q()
+    for day in days:
+        start = timezone.make_aware(datetime.combine(day, time.min))
+        condition |= Q(created_at__gte=start, created_at__lt=start + timedelta(days=1))
+    return condition
+
+
+def money(expression):
+    return Sum(expression, output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def rebuild_days(days):
+    """Replace the rollup rows of ``days`` with fresh aggregates, one statement per table"""
+    orders = Order.objects.filter(day_range(days))
+    order_rows = orders.annotate(day=TruncDate('created_at')).values('day', 'status', 'payment_method').annotate(
+        order_count=Count('id'),
+        subtotal_sum=money('subtotal'),
+        shipping_sum=money('shipping_cost'),
+        tax_sum=money('tax_amount'),
+        discount_sum=money('discount_amount'),
+        total_sum=money('total_amount'),
+    ).order_by()
+    product_rows = OrderItem.objects.filter(order__in=orders).annotate(
+        day=TruncDate('order__created_at')
+    ).values(
+        'day', 'product_id', 'product__category_id', 'product__brand_id', 'order__status', 'order__payment_method'
+    ).annotate(
+        order_count=Count('order_id', distinct=True),
+        unit_sum=Sum('quantity'),
+        revenue_sum=money(F('price') * F('quantity')),
+    ).order_by()
+
+    with transaction.atomic():
+        DailyOrderSales.objects.filter(day__in=days).delete()
+        DailyProductSales.objects.filter(day__in=days).delete()
+        DailyOrderSales.objects.bulk_create([
+            DailyOrderSales(
+                day=row['day'], status=row['status'], payment_method=row['payment_method'],
+                orders=row['order_count'], subtotal=row['subtotal_sum'], shipping=row['shipping_sum'],
+                tax=row['tax_sum'], discount=row['discount_sum'], total=row['total_sum'],
+            )
+            for row in order_rows
+        ], batch_size=500)
+        DailyProductSales.objects.bulk_create([
+            DailyProductSales(
+                day=row['day'], product_id=row['product_id'],
+                category_id=row['product__category_id'], brand_id=row['product__brand_id'],
+                status=row['order__status'], payment_method=row['order__payment_method'],
+                orders=row['order_count'], units=row['unit_sum'], revenue=row['revenue_sum'],
+            )
+            for row in product_rows
+        ], batch_size=500)
+
+
+def refresh_rollups(full=False):
+    """
+    Roll up every day with orders changed since the watermark (every day at
+    all when ``full``), then move the watermark. Returns the days rebuilt.
+    """
+    started = timezone.now()
+    watermark, created = ReportWatermark.objects.get_or_create(name=WATERMARK)
+    orders = Order.objects.all()
+    if not full and watermark.value is not None:
+        orders = orders.filter(updated_at__gte=watermark.value - WATERMARK_OVERLAP)
+    days = list(orders.dates('created_at', 'day'))
+
+    # A full rebuild swaps every row in one transaction so reports never see it half done
+    with transaction.atomic() if full else nullcontext():
+        if full:
+            DailyOrderSales.objects.all().delete()
+            DailyProductSales.objects.all().delete()
+        for index in range(0, len(days), DAYS_PER_BATCH):
+            rebuild_days(days[index:index + DAYS_PER_BATCH])
+
+    ReportWatermark.objects.filter(pk=watermark.pk).update(value=started)
+    return days
+
+
+def label_lookup(group_by, keys):
+    """Display names for the grouped keys, from one query"""
+    if group_by == 'product':
+        return {
+            product_id: f'{name} ({sku})'
+            for product_id, name, sku in Product.objects.filter(id__in=keys).values_list('id', 'name', 'sku')
+        }
+    if group_by in ('category', 'brand'):
+        model = Category if group_by == 'category' else Brand
+        return dict(model.objects.filter(id__in=keys).values_list('id', 'name'))
+    if group_by in ('status', 'payment_method'):
+        field = 'STATUS_CHOICES' if group_by == 'status' else 'PAYMENT_METHOD_CHOICES'
+        return dict(getattr(Order, field))
+    return {}
+
+
+def sales_report(start, end, group_by='day', statuses=None, limit=None):
+    """
+    Totals and per-``group_by`` rows for orders created from ``start`` to
+    ``end`` inclusive, read from the rollups only. ``statuses`` limits the
+    order statuses counted (default: all but cancelled and refunded).
+    """
+    model, column = DIMENSIONS[group_by]
+    metrics = ORDER_METRICS if model is DailyOrderSales else PRODUCT_METRICS
+
+    def scoped(rollup):
+        rows = rollup.objects.filter(day__gte=start, day__lte=end)
+        if statuses:
+            return rows.filter(status__in=statuses)
+        return rows.exclude(status__in=EXCLUDED_STATUSES)
+
+    totals = scoped(DailyOrderSales).aggregate(**{f'{metric}_sum': Sum(metric) for metric in ORDER_METRICS})
+    rows = (
+        scoped(model).values(column)
+        .annotate(**{f'{metric}_sum': Sum(metric) for metric in metrics})
+        .order_by(column if group_by == 'day' else f'-{metrics[-1]}_sum', column)
+    )
+    rows = list(rows[:limit] if limit else rows)
+    labels = label_lookup(group_by, [row[column] for row in rows])
+
+    watermark = ReportWatermark.objects.filter(name=WATERMARK).values_list('value', flat=True).first()
+    return {
+        'start': start,
+        'end': end,
+        'group_by': group_by,
+        'as_of': watermark,
+        'totals': {metric: totals[f'{metric}_sum'] or 0 for metric in ORDER_METRICS},
+        'results': [
+            {
+                'key': row[column],
+                'label': labels.get(row[column], row[column]),
+                **{metric: row[f'{metric}_sum'] or 0 for metric in metrics},
+            }
+            for row in rows
+        ],
+    }
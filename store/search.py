@@ -0,0 +1,243 @@
+"""
+In-process full-text search over the product catalog.
+
+Products are tokenized into an inverted index over name, SKU, short
+description and description, and ranked with BM25 (field-weighted term
+frequencies). SKU exact and prefix matches are boosted above text matches.
+
+The index is built from the database on first use and kept per process.
+Product writes bump a version key in the ``CATALOG_CACHE`` alias, which every
+worker shares (see store.catalog); each worker notices the new version on its
+next search and re-reads only the products whose updated_at moved past its
+watermark.
+"""
+import bisect
+import math
+import re
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from .catalog import bump_version, get_version
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+# Field weights for the combined term frequency (BM25F-style)
+FIELD_WEIGHTS = (
+    ('name', 3.0),
+    ('sku', 2.0),
+    ('short_description', 1.5),
+    ('description', 1.0),
+)
+
+SKU_EXACT_BOOST = 100.0
+SKU_PREFIX_BOOST = 10.0
+
+# The last query term is matched as a prefix (search-as-you-type); cap the
+# number of vocabulary terms it may expand to
+MAX_PREFIX_EXPANSIONS = 50
+
+# Rows written inside a long transaction can commit with an updated_at a
+# little older than the watermark; re-read that much history on refresh
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class ProductSearchIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {product_id: weighted tf}
+        self.doc_terms = {}                # product_id -> terms, for removal
+        self.doc_length = {}
+        self.total_length = 0.0
+        self.skus = {}                     # product_id -> normalized SKU
+        self._sorted_skus = None
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.doc_length)
+
+    @staticmethod
+    def normalize_sku(value):
+        return re.sub(r'[^A-Z0-9]', '', value.upper())
+
+    def add(self, product_id, name='', sku='', short_description='', description=''):
+        self.remove(product_id)
+
+        fields = {
+            'name': name,
+            'sku': sku,
+            'short_description': short_description,
+            'description': description,
+        }
+        frequencies = defaultdict(float)
+        length = 0.0
+        for field, weight in FIELD_WEIGHTS:
+            for term in tokenize(fields[field]):
+                frequencies[term] += weight
+                length += weight
+
+        for term, frequency in frequencies.items():
+            if term not in self.postings:
+                self._vocabulary = None
+            self.postings[term][product_id] = frequency
+        self.doc_terms[product_id] = tuple(frequencies)
+        self.doc_length[product_id] = length
+        self.total_length += length
+        self.skus[product_id] = self.normalize_sku(sku or '')
+        self._sorted_skus = None
+
+    def remove(self, product_id):
+        terms = self.doc_terms.pop(product_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self.postings[term]
+        self.total_length -= self.doc_length.pop(product_id)
+        self.skus.pop(product_id, None)
+        self._sorted_skus = None
+
+    @property
+    def vocabulary(self):
+        # Terms whose postings emptied stay listed until the next rebuild;
+        # expand_prefix() skips them
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        return self._vocabulary
+
+    @property
+    def sorted_skus(self):
+        if self._sorted_skus is None:
+            self._sorted_skus = sorted((sku, product_id) for product_id, sku in self.skus.items() if sku)
+        return self._sorted_skus
+
+    def expand_prefix(self, prefix):
+        vocabulary = self.vocabulary
+        start = bisect.bisect_left(vocabulary, prefix)
+        expansions = []
+        for term in vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            if term in self.postings:
+                expansions.append(term)
+        return expansions
+
+    def search(self, query, limit=None):
+        """Return ``[(product_id, score), ...]`` best first"""
+        scores = defaultdict(float)
+        documents = len(self.doc_length)
+        if not documents:
+            return []
+        average_length = self.total_length / documents
+
+        terms = tokenize(query)
+        for position, term in enumerate(terms):
+            candidates = [term]
+            if position == len(terms) - 1:
+                candidates = self.expand_prefix(term) or candidates
+            for candidate in candidates:
+                postings = self.postings.get(candidate)
+                if not postings:
+                    continue
+                idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                # Prefix expansions rank below the whole word the user typed
+                weight = 1.0 if candidate == term else 0.5
+                for product_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_length[product_id] / average_length)
+                    scores[product_id] += weight * idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        sku = self.normalize_sku(query)
+        if sku:
+            sorted_skus = self.sorted_skus
+            start = bisect.bisect_left(sorted_skus, (sku,))
+            for candidate, product_id in sorted_skus[start:]:
+                if not candidate.startswith(sku):
+                    break
+                scores[product_id] += SKU_EXACT_BOOST if candidate == sku else SKU_PREFIX_BOOST
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit else ranked
+
+
+class ProductSearch:
+    """Process-wide index, kept in step with the products table"""
+
+    version_key = 'store:search:version'
+
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.watermark = None
+        self._lock = threading.RLock()
+
+    def rows(self, queryset):
+        return queryset.values_list(
+            'id', 'name', 'sku', 'short_description', 'description', 'active', 'updated_at'
+        ).iterator(chunk_size=2000)
+
+    def build(self):
+        from .models import Product
+
+        version = get_version(self.version_key)
+        index = ProductSearchIndex()
+        watermark = None
+        for product_id, name, sku, short_description, description, active, updated_at in self.rows(
+            Product.objects.filter(active=True)
+        ):
+            index.add(product_id, name, sku, short_description, description)
+            watermark = max(watermark, updated_at) if watermark else updated_at
+        self.index, self.version, self.watermark = index, version, watermark
+
+    def refresh(self):
+        """Re-read only the products written since the watermark"""
+        from .models import Product
+
+        version = get_version(self.version_key)
+        changed = Product.objects.all()
+        if self.watermark:
+            changed = changed.filter(updated_at__gte=self.watermark - REFRESH_OVERLAP)
+        for product_id, name, sku, short_description, description, active, updated_at in self.rows(changed):
+            if active:
+                self.index.add(product_id, name, sku, short_description, description)
+            else:
+                self.index.remove(product_id)
+            self.watermark = max(self.watermark, updated_at) if self.watermark else updated_at
+        self.version = version
+
+    def ensure_current(self):
+        with self._lock:
+            if self.index is None:
+                self.build()
+            elif self.version != get_version(self.version_key):
+                self.refresh()
+
+    def search(self, query, limit=None):
+        self.ensure_current()
+        with self._lock:
+            return self.index.search(query, limit=limit)
+
+    def invalidate(self):
+        """Saved products are picked up by the next refresh()"""
+        bump_version(self.version_key)
+
+    def discard(self, product_id):
+        """
+        Deleted rows cannot be seen by refresh(). Other workers keep the stale
+        entry until their next build; it is harmless because search results
+        are always re-filtered through the products queryset.
+        """
+        with self._lock:
+            if self.index is not None:
+                self.index.remove(product_id)
+        self.invalidate()
+
+
+product_search = ProductSearch()
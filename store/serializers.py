@@ -1,43 +1,150 @@
 from rest_framework import serializers
 from .models import Category, Brand, Product, ProductImage, ProductAttribute, ProductReview, Cart, CartItem, Order, OrderItem, Wishlist, ShippingAddress
+from .catalog import category_tree
+from .images import derivative_urls
+from .exports import FORMATS as EXPORT_FORMATS
+from .reports import DIMENSIONS as REPORT_DIMENSIONS
 
-class CategorySerializer(serializers.ModelSerializer):
+
+def requested_paths(request, param):
+    """Dotted paths from a comma-separated GET param, or None when it is absent"""
+    if request is None or request.method != 'GET':
+        return None
+    value = request.query_params.get(param)
+    if value is None:
+        return None
+    return {part.strip() for part in value.split(',') if part.strip()}
+
+def path_selected(selection, path):
+    """True if ``path`` is, contains or lies under an entry of ``selection`` (None selects all)"""
+    if selection is None:
+        return True
+    return any(
+        entry == path or entry.startswith(path + '.') or path.startswith(entry + '.')
+        for entry in selection
+    )
+
+def field_requested(request, path, expandable=False):
+    """Whether a response will render ``path``; views use it to skip joins and prefetches"""
+    if not path_selected(requested_paths(request, 'fields'), path):
+        return False
+    return not expandable or path_selected(requested_paths(request, 'expand'), path)
+
+class SparseFieldsMixin:
+    """
+    ``?fields=id,name,items.quantity`` limits a GET response to the listed
+    (dotted) fields. ``?expand=brand,items.product`` picks which of
+    ``Meta.expandable_fields`` are rendered; without ``expand`` they all are.
+    Unselected fields are dropped before serialization, so their nested
+    serializers and method fields never run.
+    """
+    
+    @property
+    def field_path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            if node.field_name:
+                names.append(node.field_name)
+            node = node.parent
+        return '.'.join(reversed(names))
+    
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get('request')
+        selected = requested_paths(request, 'fields')
+        expand = requested_paths(request, 'expand')
+        if selected is None and expand is None:
+            return fields
+        
+        prefix = self.field_path
+        expandable = getattr(self.Meta, 'expandable_fields', ())
+        for name in list(fields):
+            path = f'{prefix}.{name}' if prefix else name
+            if not path_selected(selected, path):
+                del fields[name]
+            elif name in expandable and not path_selected(expand, path):
+                del fields[name]
+        return fields
+
+class ImageVariantsField(serializers.Field):
+    """``{format: {width: url}}`` of an image's derivatives, ready for srcset"""
+    
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+    
+    def to_representation(self, value):
+        if not value:
+            return None
+        # None until the derivatives are written; clients then use the original
+        urls = derivative_urls(value.name)
+        request = self.context.get('request')
+        if urls is not None and request is not None:
+            urls = {
+                fmt: {width: request.build_absolute_uri(url) for width, url in widths.items()}
+                for fmt, widths in urls.items()
+            }
+        return urls
+
+class CategoryNodeSerializer(serializers.ModelSerializer):
+    """Flat category fields, used to build the cached category tree"""
+    image_variants = ImageVariantsField(source='image')
+    
+    class Meta:
+        model = Category
+        exclude = ('active_product_count',)
+
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    image_variants = ImageVariantsField(source='image')
     children = serializers.SerializerMethodField()
     product_count = serializers.SerializerMethodField()
+    subtree_product_count = serializers.SerializerMethodField()
     
     class Meta:
         model = Category
-        fields = '__all__'
+        exclude = ('active_product_count',)
+    
+    def get_node(self, obj):
+        return category_tree.get().get(obj.id)
     
     def get_children(self, obj):
-        if obj.children.exists():
-            return CategorySerializer(obj.children.all(), many=True).data
-        return []
+        node = self.get_node(obj)
+        return node['children'] if node else []
     
     def get_product_count(self, obj):
-        return obj.products.filter(active=True).count()
+        return obj.active_product_count
+    
+    def get_subtree_product_count(self, obj):
+        node = self.get_node(obj)
+        if node:
+            return node['subtree_product_count']
+        return self.get_product_count(obj)
 
-class BrandSerializer(serializers.ModelSerializer):
-    product_count = serializers.SerializerMethodField()
+class BrandSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    product_count = serializers.IntegerField(source='active_product_count', read_only=True)
+    logo_variants = ImageVariantsField(source='logo')
     
     class Meta:
         model = Brand
-        fields = '__all__'
-    
-    def get_product_count(self, obj):
-        return obj.products.filter(active=True).count()
+        exclude = ('active_product_count',)
 
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    image_variants = ImageVariantsField(source='image')
+    
     class Meta:
         model = ProductImage
-        fields = ('id', 'image', 'alt_text', 'order')
+        fields = (
+            'id', 'image', 'image_variants', 'image_width', 'image_height',
+            'image_color', 'image_placeholder', 'alt_text', 'order'
+        )
 
-class ProductAttributeSerializer(serializers.ModelSerializer):
+class ProductAttributeSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ProductAttribute
         fields = ('name', 'value')
 
-class ProductReviewSerializer(serializers.ModelSerializer):
+class ProductReviewSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     user = serializers.StringRelatedField()
     
     class Meta:
@@ -45,29 +152,22 @@ class ProductReviewSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = ('user', 'verified_purchase', 'helpful', 'not_helpful')
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     main_image = serializers.ImageField(read_only=True)
+    main_image_variants = ImageVariantsField(source='main_image')
     discount_percentage = serializers.ReadOnlyField()
-    average_rating = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
+    average_rating = serializers.FloatField(source='rating_stats.average_rating', read_only=True)
+    review_count = serializers.IntegerField(source='rating_stats.review_count', read_only=True)
     
     class Meta:
         model = Product
         fields = (
-            'id', 'name', 'slug', 'sku', 'main_image', 'price', 
+            'id', 'name', 'slug', 'sku', 'main_image', 'main_image_variants',
+            'main_image_width', 'main_image_height', 'main_image_color', 'main_image_placeholder', 'price', 
             'compare_price', 'discount_percentage', 'in_stock',
             'featured', 'best_seller', 'new_arrival', 'on_sale',
             'average_rating', 'review_count', 'short_description'
         )
-    
-    def get_average_rating(self, obj):
-        reviews = obj.reviews.all()
-        if reviews:
-            return sum(review.rating for review in reviews) / len(reviews)
-        return 0
-    
-    def get_review_count(self, obj):
-        return obj.reviews.count()
 
 class ProductDetailSerializer(ProductListSerializer):
     category = CategorySerializer(read_only=True)
@@ -75,17 +175,21 @@ class ProductDetailSerializer(ProductListSerializer):
     additional_images = ProductImageSerializer(many=True, read_only=True)
     attributes = ProductAttributeSerializer(many=True, read_only=True)
     reviews = ProductReviewSerializer(many=True, read_only=True)
+    rating_histogram = serializers.DictField(source='rating_stats.histogram', read_only=True)
     
     class Meta(ProductListSerializer.Meta):
         fields = ProductListSerializer.Meta.fields + (
             'description', 'category', 'brand', 'additional_images', 
-            'attributes', 'reviews', 'stock', 'weight', 'dimensions',
+            'attributes', 'reviews', 'rating_histogram', 'stock', 'weight', 'dimensions',
             'created_at', 'updated_at'
         )
+        expandable_fields = (
+            'category', 'brand', 'additional_images', 'attributes', 'reviews', 'rating_histogram'
+        )
 
 # ... (add after existing serializers) ...
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = ProductListSerializer(read_only=True)
     total_price = serializers.ReadOnlyField()
     unit_price = serializers.ReadOnlyField()
@@ -93,8 +197,9 @@ class CartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = '__all__'
+        expandable_fields = ('product',)
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     total_price = serializers.ReadOnlyField()
     total_quantity = serializers.ReadOnlyField()
@@ -104,15 +209,41 @@ class CartSerializer(serializers.ModelSerializer):
         model = Cart
         fields = '__all__'
 
-class OrderItemSerializer(serializers.ModelSerializer):
-    product = ProductListSerializer(read_only=True)
+class CartOperationSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField(required=True)
+    quantity = serializers.IntegerField(min_value=0, required=True)
+
+class CartBulkUpdateSerializer(serializers.Serializer):
+    MAX_ITEMS = 100
+    
+    items = CartOperationSerializer(many=True, allow_empty=False, max_length=MAX_ITEMS)
+    # 'set' makes each quantity the line's quantity (0 removes the line); 'add' adds to it
+    mode = serializers.ChoiceField(choices=['set', 'add'], default='set')
+
+class OrderProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    """
+    Compact link back to the catalog for an order line. Name, SKU and price
+    come from the line's own snapshot, so nothing here needs ratings.
+    """
+    main_image = serializers.ImageField(read_only=True)
+    main_image_variants = ImageVariantsField(source='main_image')
+    
+    class Meta:
+        model = Product
+        fields = ('id', 'name', 'slug', 'main_image', 'main_image_variants', 'main_image_placeholder', 'active', 'in_stock')
+        # Columns the order views load for it
+        load_fields = ('id', 'name', 'slug', 'main_image', 'main_image_placeholder', 'active', 'stock')
+
+class OrderItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    product = OrderProductSerializer(read_only=True)
     total_price = serializers.ReadOnlyField()
     
     class Meta:
         model = OrderItem
         fields = '__all__'
+        expandable_fields = ('product',)
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     user = serializers.StringRelatedField()
     items_count = serializers.ReadOnlyField()
@@ -122,14 +253,50 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = '__all__'
         read_only_fields = ('order_number', 'created_at', 'updated_at')
+        expandable_fields = ('items',)
+
+class ProductFilterQuerySerializer(serializers.Serializer):
+    """Typed storefront filters of /api/products/ and its facets; the rest are matched as text"""
+    min_price = serializers.DecimalField(max_digits=None, decimal_places=None, min_value=0, required=False)
+    max_price = serializers.DecimalField(max_digits=None, decimal_places=None, min_value=0, required=False)
+    brand = serializers.IntegerField(required=False)
+
+class DateRangeQuerySerializer(serializers.Serializer):
+    """Optional ``start``/``end`` dates of a staff report or export"""
+    start = serializers.DateField(required=False)
+    end = serializers.DateField(required=False)
+    
+    def validate(self, attrs):
+        if attrs.get('start') and attrs.get('end') and attrs['start'] > attrs['end']:
+            raise serializers.ValidationError("start must not be after end")
+        return attrs
+
+class SalesReportQuerySerializer(DateRangeQuerySerializer):
+    """Query parameters of /api/reports/"""
+    group_by = serializers.ChoiceField(choices=list(REPORT_DIMENSIONS), default='day')
+    # Comma-separated order statuses; all but cancelled and refunded when omitted
+    status = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, required=False)
+    
+    def validate_status(self, value):
+        statuses = [part.strip() for part in value.split(',') if part.strip()]
+        unknown = set(statuses) - {choice for choice, label in Order.STATUS_CHOICES}
+        if unknown:
+            raise serializers.ValidationError(f"Unknown status: {', '.join(sorted(unknown))}")
+        return statuses
+
+class ExportQuerySerializer(DateRangeQuerySerializer):
+    """Query parameters of /api/exports/<dataset>/ (``format`` is taken by DRF)"""
+    output = serializers.ChoiceField(choices=list(EXPORT_FORMATS), default='csv')
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     product = ProductListSerializer(read_only=True)
     
     class Meta:
         model = Wishlist
         fields = '__all__'
         read_only_fields = ('user',)
+        expandable_fields = ('product',)
 
 class ShippingAddressSerializer(serializers.ModelSerializer):
     full_address = serializers.ReadOnlyField()
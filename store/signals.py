@@ -0,0 +1,208 @@
+import logging
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .catalog import category_tree, touch_catalog
+from .images import ensure_derivatives, image_metadata
+from .storage import release_blob
+from .search import product_search
+from .models import (
+    Brand, Category, Product, ProductAttribute, ProductImage, ProductRatingSummary, ProductReview
+)
+
+logger = logging.getLogger(__name__)
+
+
+def shift_active_product_counts(category_id, brand_id, delta):
+    Category.objects.filter(pk=category_id).update(
+        active_product_count=F('active_product_count') + delta
+    )
+    if brand_id:
+        Brand.objects.filter(pk=brand_id).update(
+            active_product_count=F('active_product_count') + delta
+        )
+
+
+@receiver(pre_save, sender=Product)
+def remember_previous_placement(sender, instance, raw=False, **kwargs):
+    """Keep the stored category/brand/active so post_save can move the counters"""
+    instance._previous_placement = None
+    if instance.pk and not raw:
+        instance._previous_placement = Product.objects.filter(
+            pk=instance.pk
+        ).values_list('category_id', 'brand_id', 'active').first()
+
+
+@receiver(post_save, sender=Product)
+def update_active_product_counts(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_placement', None)
+    current = (instance.category_id, instance.brand_id, instance.active)
+    if previous == current:
+        return
+    if previous and previous[2]:
+        shift_active_product_counts(previous[0], previous[1], -1)
+    if instance.active:
+        shift_active_product_counts(instance.category_id, instance.brand_id, 1)
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_active_product_counts(sender, instance, **kwargs):
+    if instance.active:
+        shift_active_product_counts(instance.category_id, instance.brand_id, -1)
+
+
+@receiver(post_save, sender=Product)
+def create_rating_summary(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ProductRatingSummary.objects.get_or_create(product=instance)
+
+
+@receiver(pre_save, sender=ProductReview)
+def remember_previous_rating(sender, instance, raw=False, **kwargs):
+    """Keep the stored product/rating so post_save can move the review between buckets"""
+    instance._previous_rating = None
+    if instance.pk and not raw:
+        instance._previous_rating = ProductReview.objects.filter(
+            pk=instance.pk
+        ).values_list('product_id', 'rating').first()
+
+
+@receiver(post_save, sender=ProductReview)
+def update_rating_summary(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rating', None)
+    if previous == (instance.product_id, instance.rating):
+        return
+    if previous:
+        ProductRatingSummary.apply_review(previous[0], previous[1], -1)
+    ProductRatingSummary.apply_review(instance.product_id, instance.rating, 1)
+
+
+@receiver(post_delete, sender=ProductReview)
+def remove_from_rating_summary(sender, instance, **kwargs):
+    ProductRatingSummary.apply_review(instance.product_id, instance.rating, -1)
+
+
+IMAGE_FIELD_NAMES = {Product: 'main_image', ProductImage: 'image', Brand: 'logo', Category: 'image'}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+def build_image_derivatives(sender, instance, raw=False, **kwargs):
+    """Responsive sizes for a new upload, built off the request; existing sets are skipped cheaply"""
+    if raw:
+        return
+    name = getattr(instance, IMAGE_FIELD_NAMES[sender]).name
+    if name:
+        transaction.on_commit(lambda: ensure_derivatives(name))
+
+
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=ProductImage)
+@receiver(pre_save, sender=Brand)
+@receiver(pre_save, sender=Category)
+def remember_previous_image(sender, instance, raw=False, **kwargs):
+    field = IMAGE_FIELD_NAMES[sender]
+    instance._previous_image = None
+    if instance.pk and not raw:
+        instance._previous_image = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+@receiver(pre_save, sender=Product)
+@receiver(pre_save, sender=ProductImage)
+@receiver(pre_save, sender=Brand)
+def extract_image_metadata(sender, instance, raw=False, **kwargs):
+    """
+    Dimensions, colour and placeholder of a new or replaced image, read once
+    here. Saves that keep the same file never decode it again, even if that
+    first read failed; `manage.py extract_image_metadata` backfills those.
+    """
+    if raw:
+        return
+    field = IMAGE_FIELD_NAMES[sender]
+    field_file = getattr(instance, field)
+    if field_file.name == instance._previous_image:
+        return
+    
+    metadata = {'width': None, 'height': None, 'color': '', 'placeholder': ''}
+    if field_file:
+        # A fresh upload is still the in-memory file; a stored one is opened and closed here
+        committed = field_file._committed
+        try:
+            field_file.open('rb')
+            metadata = image_metadata(field_file)
+        except Exception as e:
+            logger.error(f"Failed to read image metadata for {field_file.name}: {str(e)}")
+        finally:
+            if committed:
+                field_file.close()
+    for key, value in metadata.items():
+        setattr(instance, f'{field}_{key}', value)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+def release_replaced_image(sender, instance, raw=False, **kwargs):
+    previous = getattr(instance, '_previous_image', None)
+    if previous and previous != getattr(instance, IMAGE_FIELD_NAMES[sender]).name:
+        # Checked after commit, when no row of this transaction can still point at it
+        transaction.on_commit(lambda: release_blob(previous))
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+def release_deleted_image(sender, instance, **kwargs):
+    name = getattr(instance, IMAGE_FIELD_NAMES[sender]).name
+    if name:
+        transaction.on_commit(lambda: release_blob(name))
+
+
+# Cache invalidation is connected last so it runs after the counters above move
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_category_tree(sender, **kwargs):
+    # After commit, so no worker rebuilds the new version from old rows
+    transaction.on_commit(category_tree.invalidate)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductAttribute)
+@receiver(post_delete, sender=ProductAttribute)
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def invalidate_catalog_etags(sender, **kwargs):
+    transaction.on_commit(touch_catalog)
+
+
+@receiver(post_save, sender=Product)
+def reindex_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(product_search.invalidate)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: product_search.discard(product_id))
@@ -0,0 +1,75 @@
+"""
+Content-addressed storage for catalog images.
+
+An upload is stored as ``<upload_to>/<sha256 of its bytes><ext>``, so a
+re-uploaded picture reuses the blob that is already on disk instead of
+getting a ``_AbC123`` suffix. Several rows can then point at one blob; a blob
+(and its derivatives) is deleted only once no catalog image references it.
+"""
+import hashlib
+import posixpath
+
+from django.apps import apps
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+
+from .images import IMAGE_FIELDS, delete_derivatives
+
+
+def content_digest(content):
+    """sha256 of a File, read chunk by chunk so large uploads never sit in memory"""
+    sha = hashlib.sha256()
+    for chunk in content.chunks():
+        sha.update(chunk)
+    content.seek(0)
+    return sha.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def __init__(self, **kwargs):
+        # Two uploads racing on one new blob write identical bytes
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+    def addressed_name(self, name, digest):
+        directory, filename = posixpath.split(name)
+        extension = posixpath.splitext(filename)[1].lower()
+        return posixpath.join(directory, digest + extension)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.addressed_name(name, content_digest(content))
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # The name is the content, so an existing file is never a conflict
+        if max_length is not None and len(name) > max_length:
+            raise SuspiciousFileOperation(
+                f'Storage can not find an available filename for "{name}" within {max_length} characters.'
+            )
+        return name
+
+
+media_storage = ContentAddressedStorage()
+
+
+def is_referenced(name):
+    return any(
+        apps.get_model(label)._default_manager.filter(**{field: name}).exists()
+        for label, field in IMAGE_FIELDS
+    )
+
+
+def release_blob(name, storage=media_storage):
+    """Delete a blob and its derivatives if no catalog image points at it any more"""
+    if not name or is_referenced(name):
+        return False
+    storage.delete(name)
+    delete_derivatives(name)
+    return True
@@ -1,3 +1,1464 @@
-from django.test import TestCase
+import base64
+import csv
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from io import BytesIO, StringIO
 
-# Create your tests here.
+from django.apps import apps
+from django.contrib.sessions.models import Session
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.db.models import F, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from mpesa.models import MpesaTransaction
+from mpesa.services import MpesaCallbackHandler
+from users.models import User
+from . import images
+from .catalog import category_tree
+from .carts import CART_TOKEN_COOKIE, CART_TOKEN_HEADER, GuestCart
+from .exports import export_lines
+from .inventory import reserve, restore_orders_stock, take_stock
+from .reports import refresh_rollups
+from .search import SKU_EXACT_BOOST, SKU_PREFIX_BOOST, ProductSearch, ProductSearchIndex
+from .models import (
+    Brand, Cart, CartItem, Category, Order, OrderItem, OrderNumberCounter, Product, ProductAttribute, ProductImage,
+    ProductRatingSummary, ProductReview, StockAdjustment, StockReservation
+)
+from .order_numbers import OrderNumberAllocator
+
+
+def checkout_payload(payment_method='mpesa'):
+    address = {'line1': '1 Moi Avenue', 'city': 'Nairobi'}
+    return {
+        'subtotal': '0', 'total_amount': '0', 'payment_method': payment_method,
+        'shipping_address': address, 'billing_address': address,
+        'customer_email': 'buyer@example.com', 'customer_phone': '0700000000',
+    }
+
+
+def stk_callback(checkout_request_id, result_code):
+    return {'Body': {'stkCallback': {
+        'CheckoutRequestID': checkout_request_id, 'ResultCode': result_code, 'ResultDesc': 'Done',
+        'CallbackMetadata': {'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'QWE123RTY'}]},
+    }}}
+
+
+class RatingSummaryTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Scanners', slug='scanners')
+        self.product = Product.objects.create(
+            name='Flatbed Scanner', slug='flatbed', sku='SC-1', description='Scanner',
+            price=Decimal('15000.00'), category=category, main_image='products/scanner.jpg', stock=3,
+        )
+        self.users = [
+            User.objects.create_user(username=f'reviewer{number}', email=f'reviewer{number}@example.com', password='secret')
+            for number in range(3)
+        ]
+
+    def review(self, user, rating):
+        return ProductReview.objects.create(
+            product=self.product, user=user, rating=rating, title='Review', comment='Works'
+        )
+
+    def summary(self):
+        return ProductRatingSummary.objects.get(product=self.product)
+
+    def test_reviews_keep_the_summary_current(self):
+        self.review(self.users[0], 5)
+        second = self.review(self.users[1], 4)
+        self.review(self.users[2], 3)
+        summary = self.summary()
+        self.assertEqual((summary.review_count, summary.rating_total, summary.average_rating), (3, 12, 4.0))
+        self.assertEqual(summary.histogram, {'1': 0, '2': 0, '3': 1, '4': 1, '5': 1})
+
+        # A changed rating moves between buckets; a deleted one drops out
+        second.rating = 1
+        second.save()
+        self.assertEqual(self.summary().histogram, {'1': 1, '2': 0, '3': 1, '4': 0, '5': 1})
+        second.delete()
+        summary = self.summary()
+        self.assertEqual((summary.review_count, summary.average_rating), (2, 4.0))
+        self.assertEqual(summary.histogram, {'1': 0, '2': 0, '3': 1, '4': 0, '5': 1})
+
+        response = APIClient().get('/api/products/', {'fields': 'id,average_rating,review_count'})
+        self.assertEqual(response.data['results'], [{'id': self.product.id, 'average_rating': 4.0, 'review_count': 2}])
+
+    def test_missing_summary_is_rebuilt_from_reviews(self):
+        self.review(self.users[0], 2)
+        ProductRatingSummary.objects.filter(product=self.product).delete()
+        self.review(self.users[1], 4)
+        summary = self.summary()
+        self.assertEqual((summary.review_count, summary.average_rating), (2, 3.0))
+        self.assertEqual(summary.histogram, {'1': 0, '2': 1, '3': 0, '4': 1, '5': 0})
+
+
+class KeysetPaginationTests(TestCase):
+    # Orderings of /api/products/ and the full order, tie-breaker included, they must page through
+    ORDERINGS = {
+        'price': ('price', 'id'),
+        '-price': ('-price', '-id'),
+        'name': ('name', 'id'),
+        'created_at': ('created_at', 'id'),
+        'rating': ('-rating', '-id'),
+        'popularity': ('sales_rank', '-created_at', '-id'),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Cables', slug='cables')
+        placed_at = timezone.now()
+        for number in range(47):
+            # Few distinct values per key, so most rows tie and need the id tie-breaker
+            product = Product.objects.create(
+                name=f'Cable {number % 4}', slug=f'cable-{number}', sku=f'CB-{number}', description='Cable',
+                price=Decimal(100 * (number % 5)), category=category, main_image='', stock=1,
+            )
+            Product.objects.filter(pk=product.pk).update(
+                created_at=placed_at - timedelta(hours=number % 3), sales_rank=number % 6 or Product.UNRANKED
+            )
+            ProductRatingSummary.objects.filter(product=product).update(average_rating=number % 3)
+
+    def expected(self, ordering):
+        products = Product.objects.annotate(rating=F('rating_summary__average_rating'))
+        return list(products.order_by(*self.ORDERINGS[ordering]).values_list('id', flat=True))
+
+    def walk(self, url, direction='next'):
+        """Ids of every page from ``url`` on, and the link back from the last one"""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append([product['id'] for product in response.data['results']])
+            url = response.data[direction]
+        return pages, response.data['previous' if direction == 'next' else 'next']
+
+    def test_every_ordering_pages_without_duplicates_or_gaps(self):
+        for ordering in self.ORDERINGS:
+            with self.subTest(ordering=ordering):
+                pages = self.walk(f'/api/products/?ordering={ordering}&fields=id')[0]
+                self.assertEqual([len(page) for page in pages], [20, 20, 7])
+                self.assertEqual([product_id for page in pages for product_id in page], self.expected(ordering))
+
+    def test_previous_links_walk_back_to_the_first_page(self):
+        pages, previous = self.walk('/api/products/?ordering=popularity&fields=id')
+        back, following = self.walk(previous, direction='previous')
+        self.assertEqual(back, pages[-2::-1])
+        self.assertIsNotNone(following)
+
+    def test_count_is_opt_in(self):
+        self.assertNotIn('count', self.client.get('/api/products/').data)
+        self.assertEqual(self.client.get('/api/products/', {'count': 'true'}).data['count'], 47)
+
+    def test_malformed_cursor_is_not_found(self):
+        valid = self.client.get('/api/products/', {'ordering': 'price'}).data['next']
+        cursor = valid.split('cursor=')[1]
+        for bad in ('not-base64!', 'bm90IGpzb24=', cursor):
+            with self.subTest(cursor=bad):
+                # A cursor from another ordering has the wrong number of keys too
+                response = self.client.get('/api/products/', {'ordering': 'popularity', 'cursor': bad})
+                self.assertEqual(response.status_code, 404)
+
+    def test_tampered_cursor_values_are_not_found(self):
+        def cursor(payload):
+            return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+        tampered = {
+            'price': [{'v': ['abc', 1]}, {'v': [{'a': 1}, 1]}, {'v': [None, 1]}, {'v': 'xx'}, {'v': ['1', [2]]}],
+            '': [{'v': ['not-a-date', 1]}, {'v': [1, 'one']}],
+            'rating': [{'v': ['high', 1]}],
+        }
+        for ordering, payloads in tampered.items():
+            for payload in payloads:
+                with self.subTest(ordering=ordering, payload=payload):
+                    response = self.client.get('/api/products/', {'ordering': ordering, 'cursor': cursor(payload)})
+                    self.assertEqual(response.status_code, 404)
+
+        # Hand-written values of the right type still seek
+        response = self.client.get('/api/products/', {'ordering': 'price', 'cursor': cursor({'v': ['300', 0]})})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(Decimal(product['price']) >= 300 for product in response.data['results']))
+
+
+class ProductFilterTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Laptops', slug='laptops')
+        self.brand = Brand.objects.create(name='Lenovo', slug='lenovo')
+        for number, brand in enumerate((self.brand, self.brand, None)):
+            Product.objects.create(
+                name=f'Laptop {number}', slug=f'laptop-{number}', sku=f'LT-{number}', description='Laptop',
+                price=Decimal(40000 + 20000 * number), category=category, brand=brand, main_image='', stock=2,
+            )
+
+    def test_brand_and_price_filters(self):
+        params = {'brand': self.brand.id, 'min_price': '50000', 'fields': 'name'}
+        response = self.client.get('/api/products/', params)
+        self.assertEqual(response.data['results'], [{'name': 'Laptop 1'}])
+        response = self.client.get('/api/products/facets/', params)
+        self.assertEqual(response.data['total'], 1)
+        # Each facet counts across its own filter
+        self.assertEqual([row['count'] for row in response.data['facets']['brands']], [1])
+        self.assertEqual(sum(bucket['count'] for bucket in response.data['facets']['price']), 2)
+
+    def test_malformed_numbers_are_rejected(self):
+        for path in ('/api/products/', '/api/products/facets/'):
+            for params in ({'brand': 'abc'}, {'min_price': 'cheap'}, {'max_price': '-5'}):
+                with self.subTest(path=path, params=params):
+                    response = self.client.get(path, params)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(set(response.data), set(params))
+        # Empty values are ignored, as before
+        self.assertEqual(self.client.get('/api/products/', {'brand': '', 'min_price': ''}).status_code, 200)
+
+
+class ProductDetailQueryTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Speakers', slug='speakers')
+        brand = Brand.objects.create(name='JBL', slug='jbl')
+        product = Product.objects.create(
+            name='Speaker', slug='speaker', sku='SP-1', description='Speaker', brand=brand,
+            price=Decimal('8000.00'), category=category, main_image='', stock=6,
+        )
+        ProductImage.objects.create(product=product, image='', alt_text='Side')
+        ProductAttribute.objects.create(product=product, name='Power', value='20W')
+        user = User.objects.create_user(username='listener', email='listener@example.com', password='secret')
+        ProductReview.objects.create(product=product, user=user, rating=5, title='Loud', comment='Great')
+        # Warm the catalog state and category tree, which are cached between requests
+        self.client.get('/api/products/speaker/')
+
+    def test_only_rendered_relations_are_queried(self):
+        cases = {
+            'fields=id,name': 1,
+            'expand=reviews': 2,
+            'fields=id,category&expand=category': 1,
+            'fields=id,brand,attributes': 2,
+            '': 4,
+        }
+        for params, queries in cases.items():
+            with self.subTest(params=params):
+                with self.assertNumQueries(queries):
+                    response = self.client.get(f'/api/products/speaker/?{params}')
+                self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/products/speaker/?expand=reviews')
+        self.assertEqual([review['user'] for review in response.data['reviews']], ['listener (client)'])
+        self.assertNotIn('category', response.data)
+
+
+class CategoryTreeTests(TestCase):
+    def setUp(self):
+        # Commit hooks run, as in production, so the tree is rebuilt from this test's rows
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_categories()
+
+    def create_categories(self):
+        self.office = Category.objects.create(name='Office', slug='office', order=1)
+        self.home = Category.objects.create(name='Home', slug='home', order=0)
+        self.paper = Category.objects.create(name='Paper', slug='paper', parent=self.office)
+        self.ink = Category.objects.create(name='Ink', slug='ink', parent=self.office)
+        self.desks = Category.objects.create(name='Desks', slug='desks', parent=self.office, order=-1)
+        self.toner = Category.objects.create(name='Toner', slug='toner', parent=self.ink)
+        self.archive = Category.objects.create(name='Archive', slug='archive', active=False)
+        self.binders = Category.objects.create(name='Binders', slug='binders', parent=self.archive)
+        self.rings = Category.objects.create(name='Rings', slug='rings', parent=self.binders)
+        for category, count in ((self.office, 1), (self.ink, 2), (self.toner, 3), (self.paper, 1), (self.rings, 2)):
+            for number in range(count):
+                self.product(category, f'{category.slug}-{number}')
+        self.product(self.paper, 'paper-retired', active=False)
+
+    def product(self, category, slug, **fields):
+        return Product.objects.create(
+            name=slug, slug=slug, sku=slug.upper(), description='Supplies', price=Decimal('100.00'),
+            category=category, main_image='', stock=1, **fields,
+        )
+
+    def tree(self):
+        return category_tree.get()
+
+    def test_subtree_counts_roll_up_active_products(self):
+        tree = self.tree()
+        counts = {
+            node['slug']: (node['product_count'], node['subtree_product_count'])
+            for node in tree.nodes
+        }
+        self.assertEqual(counts, {
+            'home': (0, 0), 'office': (1, 7), 'desks': (0, 0), 'ink': (2, 5), 'paper': (1, 1),
+            'toner': (3, 3), 'binders': (0, 2), 'rings': (2, 2),
+        })
+
+    def test_children_keep_the_category_ordering(self):
+        tree = self.tree()
+        self.assertEqual([node['slug'] for node in tree.roots], ['home', 'office'])
+        office = tree.by_slug['office']
+        self.assertEqual([child['slug'] for child in office['children']], ['desks', 'ink', 'paper'])
+        response = self.client.get('/api/categories/office/')
+        self.assertEqual([child['slug'] for child in response.data['children']], ['desks', 'ink', 'paper'])
+
+    def test_subtrees_under_an_inactive_parent_are_kept_out_of_the_roots(self):
+        tree = self.tree()
+        self.assertNotIn('archive', tree.by_slug)
+        self.assertNotIn('binders', [node['slug'] for node in tree.roots])
+        self.assertEqual([child['slug'] for child in tree.by_slug['binders']['children']], ['rings'])
+
+    def test_saves_rebuild_the_tree_on_the_next_read(self):
+        tree = self.tree()
+        with self.assertNumQueries(0):
+            self.assertIs(self.tree(), tree)
+
+        version = category_tree.current_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product(self.toner, 'toner-new')
+        self.assertNotEqual(category_tree.current_version(), version)
+        self.assertEqual(self.tree().by_slug['office']['subtree_product_count'], 8)
+
+        version = category_tree.current_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.desks.name = 'Standing Desks'
+            self.desks.save()
+        self.assertNotEqual(category_tree.current_version(), version)
+        self.assertEqual(self.tree().by_slug['desks']['name'], 'Standing Desks')
+
+
+class ActiveProductCountTests(TestCase):
+    def setUp(self):
+        self.laptops = Category.objects.create(name='Laptops', slug='laptops')
+        self.tablets = Category.objects.create(name='Tablets', slug='tablets')
+        self.dell = Brand.objects.create(name='Dell', slug='dell')
+        self.hp = Brand.objects.create(name='HP', slug='hp')
+        self.product = self.create_product('latitude', self.laptops, self.dell)
+
+    def create_product(self, slug, category, brand, **fields):
+        return Product.objects.create(
+            name=slug, slug=slug, sku=slug.upper(), description='Computer', price=Decimal('60000.00'),
+            category=category, brand=brand, main_image='', stock=2, **fields,
+        )
+
+    def counts(self):
+        return (
+            dict(Category.objects.values_list('slug', 'active_product_count')),
+            dict(Brand.objects.values_list('slug', 'active_product_count')),
+        )
+
+    def test_moving_a_product_moves_its_count(self):
+        self.product.category = self.tablets
+        self.product.brand = self.hp
+        self.product.save()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 1}, {'dell': 0, 'hp': 1}))
+
+        self.product.brand = None
+        self.product.save()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 1}, {'dell': 0, 'hp': 0}))
+
+    def test_only_active_products_are_counted(self):
+        self.create_product('retired', self.laptops, self.dell, active=False)
+        self.assertEqual(self.counts(), ({'laptops': 1, 'tablets': 0}, {'dell': 1, 'hp': 0}))
+
+        self.product.active = False
+        self.product.save()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 0}, {'dell': 0, 'hp': 0}))
+        # Saving an inactive product again, or moving it, changes nothing
+        self.product.category = self.tablets
+        self.product.save()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 0}, {'dell': 0, 'hp': 0}))
+
+        self.product.active = True
+        self.product.save()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 1}, {'dell': 1, 'hp': 0}))
+
+    def test_deleting_a_product_drops_its_count(self):
+        retired = self.create_product('retired', self.laptops, self.hp, active=False)
+        retired.delete()
+        self.product.delete()
+        self.assertEqual(self.counts(), ({'laptops': 0, 'tablets': 0}, {'dell': 0, 'hp': 0}))
+
+    def test_backfill_migration_and_rebuild_command_recount(self):
+        self.create_product('pavilion', self.laptops, self.hp)
+        self.create_product('retired', self.tablets, self.hp, active=False)
+        expected = self.counts()
+        self.assertEqual(expected, ({'laptops': 2, 'tablets': 0}, {'dell': 1, 'hp': 1}))
+
+        migration = import_module('store.migrations.0004_active_product_count')
+        Category.objects.update(active_product_count=5)
+        Brand.objects.update(active_product_count=5)
+        migration.count_active_products(apps, None)
+        self.assertEqual(self.counts(), expected)
+
+        Category.objects.update(active_product_count=5)
+        Brand.objects.update(active_product_count=5)
+        call_command('rebuild_product_counts', stdout=StringIO())
+        self.assertEqual(self.counts(), expected)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='critic', email='critic@example.com', password='secret')
+        with self.captureOnCommitCallbacks(execute=True):
+            category = Category.objects.create(name='Projectors', slug='projectors')
+            self.product = Product.objects.create(
+                name='Projector', slug='projector', sku='PJ-1', description='Projector',
+                price=Decimal('45000.00'), category=category, main_image='', stock=5,
+            )
+
+    def get(self, url='/api/products/projector/', **headers):
+        return self.client.get(url, **headers)
+
+    def assertEtagChanges(self, write):
+        etag = self.get()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            write()
+        self.assertNotEqual(self.get()['ETag'], etag)
+
+    def test_repeat_requests_are_answered_before_any_query(self):
+        for url in ('/api/products/', '/api/products/projector/', '/api/categories/', '/api/brands/'):
+            with self.subTest(url=url):
+                response = self.get(url)
+                self.assertEqual(response.status_code, 200)
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+                with self.assertNumQueries(0):
+                    response = self.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+                    self.assertEqual(response.status_code, 304)
+
+    def test_etag_differs_per_url(self):
+        self.assertNotEqual(self.get('/api/products/')['ETag'], self.get('/api/products/?ordering=price')['ETag'])
+
+    def test_writes_change_the_etag(self):
+        def save_product():
+            self.product.price = Decimal('43000.00')
+            self.product.save()
+
+        def save_review():
+            ProductReview.objects.create(product=self.product, user=self.user, rating=4, title='Bright', comment='Good')
+
+        def reserve_stock():
+            order = Order.objects.create(
+                user=self.user, subtotal=Decimal('45000'), total_amount=Decimal('45000'), shipping_address={},
+                billing_address={}, customer_email=self.user.email, customer_phone='0700000000',
+            )
+            reserve(order, {self.product.id: 1})
+
+        writes = {
+            'product save': save_product,
+            'review save': save_review,
+            'take_stock': lambda: take_stock({self.product.id: 1}),
+            'reserve': reserve_stock,
+            'management command': lambda: call_command('rebuild_product_counts', stdout=StringIO()),
+        }
+        for name, write in writes.items():
+            with self.subTest(write=name):
+                self.assertEtagChanges(write)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Printers', slug='printers')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.laser = self.product('LJ-1020', 'Laser Printer', 'Monochrome laser printer for the office')
+            self.inkjet = self.product('IJ-200', 'Inkjet Printer', 'Colour printer, also prints photos')
+            self.toner = self.product('TN-1020', 'Toner Cartridge', 'Replacement toner for the LJ-1020 laser')
+            self.cable = self.product('CB-9', 'USB Cable', 'Connects a printer or scanner')
+
+    def product(self, sku, name, description):
+        return Product.objects.create(
+            name=name, slug=sku.lower(), sku=sku, description=description,
+            price=Decimal('1000.00'), category=self.category, main_image='', stock=3,
+        )
+
+    def ids(self, results):
+        return [product_id for product_id, score in results]
+
+    def test_bm25_ranks_name_matches_above_description_matches(self):
+        index = ProductSearchIndex()
+        for product in (self.laser, self.inkjet, self.toner, self.cable):
+            index.add(product.id, product.name, product.sku, product.short_description, product.description)
+
+        self.assertEqual(self.ids(index.search('laser')), [self.laser.id, self.toner.id])
+        self.assertEqual(self.ids(index.search('printer'))[:2], [self.inkjet.id, self.laser.id])
+        self.assertEqual(self.ids(index.search('printer'))[2:], [self.cable.id])
+        # The last term is also matched as a prefix
+        self.assertEqual(self.ids(index.search('phot')), [self.inkjet.id])
+        self.assertEqual(index.search('fax'), [])
+
+    def test_exact_sku_ranks_first(self):
+        index = ProductSearchIndex()
+        for product in (self.laser, self.toner):
+            index.add(product.id, product.name, product.sku, product.short_description, product.description)
+
+        # The toner mentions LJ-1020 in its text, but only the laser has the SKU
+        results = index.search('lj 1020')
+        self.assertEqual(self.ids(results), [self.laser.id, self.toner.id])
+        self.assertGreaterEqual(results[0][1] - results[1][1], SKU_EXACT_BOOST - SKU_PREFIX_BOOST)
+        self.assertEqual(self.ids(index.search('TN')), [self.toner.id])
+
+        response = self.client.get('/api/products/', {'search': 'tn-1020', 'fields': 'id'})
+        self.assertEqual([product['id'] for product in response.data['results']], [self.toner.id, self.laser.id])
+
+    def test_refresh_reads_renamed_products_past_the_watermark(self):
+        search = ProductSearch()
+        search.search('printer')
+        index = search.index
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.cable.name = 'Parallel Lead'
+            self.cable.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.ids(search.search('lead')), [self.cable.id])
+        self.assertIs(search.index, index)
+        self.assertEqual(search.search('usb'), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.inkjet.active = False
+            self.inkjet.save()
+        self.assertNotIn(self.inkjet.id, self.ids(search.search('printer')))
+
+    def test_discard_drops_deleted_products(self):
+        search = ProductSearch()
+        search.build()
+        laser_id = self.laser.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.laser.delete()
+        # A refresh only sees rows that still exist
+        search.refresh()
+        self.assertIn(laser_id, self.ids(search.search('laser')))
+
+        search.discard(laser_id)
+        self.assertEqual(self.ids(search.search('laser')), [self.toner.id])
+
+
+class HomeSnapshotTests(TestCase):
+    def test_sales_ranks_from_the_batch_command_reach_the_home_payload(self):
+        category = Category.objects.create(name='Routers', slug='routers')
+        product = Product.objects.create(
+            name='Router', slug='router', sku='RT-1', description='Router',
+            price=Decimal('5000.00'), category=category, main_image='', stock=20,
+        )
+        user = User.objects.create_user(username='office', email='office@example.com', password='secret')
+        self.assertEqual(self.client.get('/api/products/home/').data['best_seller'], [])
+
+        order = Order.objects.create(
+            user=user, subtotal=Decimal('5000'), total_amount=Decimal('5000'), shipping_address={},
+            billing_address={}, customer_email=user.email, customer_phone='0700000000',
+            payment_status='paid', paid_at=timezone.now(),
+        )
+        OrderItem.objects.create(order=order, product=product, quantity=3, price=product.price)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('update_sales_ranks', stdout=StringIO())
+
+        best_sellers = self.client.get('/api/products/home/').data['best_seller']
+        self.assertEqual([item['id'] for item in best_sellers], [product.id])
+
+
+class ImageMetadataTests(TestCase):
+    def test_image_is_only_read_when_the_file_changes(self):
+        category = Category.objects.create(name='Monitors', slug='monitors')
+        with self.assertLogs('store.signals', 'ERROR'):
+            product = Product.objects.create(
+                name='Monitor', slug='monitor', sku='MN-1', description='Monitor',
+                price=Decimal('18000.00'), category=category, main_image='products/missing.jpg', stock=4,
+            )
+        # Same file: nothing is decoded, so the failure is not logged again
+        with self.assertNoLogs('store.signals', 'ERROR'):
+            product.stock = 3
+            product.save()
+        product.main_image = 'products/other.jpg'
+        with self.assertLogs('store.signals', 'ERROR'):
+            product.save()
+
+
+class MediaTestCase(TestCase):
+    """Uploads go to a throwaway MEDIA_ROOT"""
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media = self.settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.media_root = media_root
+        self.category = Category.objects.create(name='Cameras', slug='cameras')
+
+    def upload(self, color, size=(600, 300), name='photo.png'):
+        buffer = BytesIO()
+        Image.new('RGB', size, color).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def create_product(self, slug, image):
+        return Product.objects.create(
+            name=slug, slug=slug, sku=slug.upper(), description='Camera', price=Decimal('30000.00'),
+            category=self.category, main_image=image, stock=2,
+        )
+
+    def wait_for_derivatives(self):
+        deadline = time.time() + 10
+        while images._building and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(images._building)
+
+
+class ImageDerivativeTests(MediaTestCase):
+    def test_derivatives_are_built_off_the_request_thread(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            product = self.create_product('dslr', self.upload((10, 120, 200)))
+        name = product.main_image.name
+        self.assertIsNone(self.client.get('/api/products/dslr/').data['main_image_variants'])
+
+        # With every build slot taken, the commit hooks still return at once
+        for _ in range(images.BUILD_THREADS):
+            images._build_slots.acquire()
+        try:
+            for callback in callbacks:
+                callback()
+            self.assertIn(name, images._building)
+            self.assertFalse(images.has_derivatives(name))
+        finally:
+            for _ in range(images.BUILD_THREADS):
+                images._build_slots.release()
+        self.wait_for_derivatives()
+
+        variants = self.client.get('/api/products/dslr/').data['main_image_variants']
+        self.assertEqual(set(variants), {'webp', 'jpeg'})
+        self.assertEqual(set(variants['jpeg']), {'150', '430', '1024'})
+        for fmt, widths in variants.items():
+            for width in widths:
+                self.assertTrue(default_storage.exists(images.derivative_name(name, int(width), fmt)))
+
+    def test_incomplete_sets_are_not_advertised(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.create_product('mirrorless', self.upload((200, 120, 10)))
+        self.wait_for_derivatives()
+        name = product.main_image.name
+        self.assertIsNotNone(images.derivative_urls(name))
+
+        images.delete_derivatives(name)
+        self.assertIsNone(images.derivative_urls(name))
+        # A narrow original is stored at its own size, not upscaled, so a set is always complete
+        images.generate_derivatives(name)
+        self.assertTrue(images.has_derivatives(name))
+        self.assertIsNotNone(images.derivative_urls(name))
+
+    def test_unreadable_uploads_are_logged_not_raised(self):
+        with self.assertLogs('store', 'ERROR') as logs:
+            with self.captureOnCommitCallbacks(execute=True):
+                product = self.create_product('broken', SimpleUploadedFile('broken.png', b'not an image'))
+            self.wait_for_derivatives()
+        self.assertIn(f'Failed to generate derivatives for {product.main_image.name}', logs.output[-1])
+        self.assertIsNone(images.derivative_urls(product.main_image.name))
+
+
+class ContentAddressedStorageTests(MediaTestCase):
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.media_root, name))
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.create_product('first', self.upload((40, 40, 40), name='front.png'))
+        second = self.create_product('second', self.upload((40, 40, 40), name='copy.PNG'))
+        third = self.create_product('third', self.upload((90, 40, 40)))
+        self.assertEqual(first.main_image.name, second.main_image.name)
+        self.assertRegex(first.main_image.name, r'^products/[0-9a-f]{64}\.png$')
+        self.assertNotEqual(third.main_image.name, first.main_image.name)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'products'))), 2)
+
+    def test_replaced_blob_is_released_after_commit_once_unreferenced(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.create_product('first', self.upload((40, 40, 40)))
+            second = self.create_product('second', self.upload((40, 40, 40)))
+        self.wait_for_derivatives()
+        shared = first.main_image.name
+        derivatives = [
+            images.derivative_name(shared, width, fmt)
+            for width in images.DERIVATIVE_WIDTHS for fmt in images.DERIVATIVE_FORMATS
+        ]
+        self.assertTrue(all(self.exists(name) for name in derivatives))
+
+        # Still used by the second product: kept
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.main_image = self.upload((10, 200, 10))
+            first.save()
+        self.assertTrue(self.exists(shared))
+        for callback in callbacks:
+            callback()
+        self.wait_for_derivatives()
+        self.assertTrue(self.exists(shared))
+
+        # Last reference gone: the blob and every derivative go after commit
+        with self.captureOnCommitCallbacks() as callbacks:
+            second.main_image = self.upload((10, 10, 200))
+            second.save()
+        self.assertTrue(self.exists(shared))
+        for callback in callbacks:
+            callback()
+        self.wait_for_derivatives()
+        self.assertFalse(self.exists(shared))
+        self.assertFalse(any(self.exists(name) for name in derivatives))
+        self.assertIsNone(images.derivative_urls(shared))
+        self.assertTrue(self.exists(first.main_image.name))
+
+    def test_deleted_rows_release_their_blob(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.create_product('single', self.upload((120, 120, 120)))
+            image = ProductImage.objects.create(product=product, image=self.upload((120, 120, 120)))
+        name = product.main_image.name
+        self.assertEqual(image.image.name, name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+        self.assertTrue(self.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.wait_for_derivatives()
+        self.assertFalse(self.exists(name))
+
+
+class MediaMiddlewareTests(SimpleTestCase):
+    BLOB = 'products/' + 'ab' * 32 + '.jpg'
+
+    def setUp(self):
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base, ignore_errors=True)
+        media_root = os.path.join(base, 'media')
+        for name, content in ((self.BLOB, b'0123456789' * 10), ('products/legacy.jpg', b'legacy')):
+            os.makedirs(os.path.dirname(os.path.join(media_root, name)), exist_ok=True)
+            with open(os.path.join(media_root, name), 'wb') as file:
+                file.write(content)
+        with open(os.path.join(base, 'secret.txt'), 'wb') as file:
+            file.write(b'secret')
+        media = self.settings(MEDIA_ROOT=media_root, MEDIA_ACCEL_REDIRECT='')
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def get(self, path, **headers):
+        response = self.client.get(path, **headers)
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_content_addressed_files_are_immutable(self):
+        response = self.get('/media/' + self.BLOB)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b'0123456789' * 10)
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.get('/media/products/legacy.jpg')
+        self.assertEqual(response['Cache-Control'], 'max-age=3600, public')
+        self.assertEqual(self.get('/media/products/legacy.jpg', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.get('/media/' + self.BLOB, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(self.body(response), b'0123456789')
+        self.assertEqual(self.get('/media/' + self.BLOB, HTTP_RANGE='bytes=200-300').status_code, 416)
+
+    def test_paths_outside_media_root_are_not_served(self):
+        for path in ('/media/../secret.txt', '/media/products/../../secret.txt', '/media/%2e%2e/secret.txt',
+                     '/media/products//legacy.jpg', '/media/missing.jpg'):
+            with self.subTest(path=path):
+                response = self.client.get(path)
+                self.assertEqual(response.status_code, 404)
+                self.assertNotIn(b'secret', response.content)
+
+    def test_accel_redirect_hands_the_file_to_nginx(self):
+        with self.settings(MEDIA_ACCEL_REDIRECT='/protected-media/'):
+            response = self.client_class().get('/media/' + self.BLOB)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.BLOB)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response.content, b'')
+
+
+class CartBulkUpdateTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Stationery', slug='stationery')
+        self.user = User.objects.create_user(username='clerk', email='clerk@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = [
+            Product.objects.create(
+                name=f'Pen {number}', slug=f'pen-{number}', sku=f'PN-{number}', description='Pen',
+                price=Decimal('50.00'), category=category, main_image='', stock=5,
+            )
+            for number in range(12)
+        ]
+        for product in self.products[:2]:
+            CartItem.objects.create(cart=self.cart, product=product, quantity=1)
+
+    def bulk_update(self, items, mode='set'):
+        return self.client.post('/api/cart/bulk_update/', {
+            'mode': mode, 'items': [{'product_id': product.id, 'quantity': quantity} for product, quantity in items],
+        }, format='json')
+
+    def lines(self):
+        return dict(self.cart.items.values_list('product__sku', 'quantity'))
+
+    def test_set_adds_updates_and_removes_lines(self):
+        pen0, pen1, pen2, pen3 = self.products[:4]
+        response = self.bulk_update([(pen0, 4), (pen1, 0), (pen2, 2), (pen3, 1), (pen3, 3)])
+        self.assertEqual(response.status_code, 200)
+        # A repeated product keeps its last quantity
+        self.assertEqual(self.lines(), {'PN-0': 4, 'PN-2': 2, 'PN-3': 3})
+        self.assertEqual(response.data['total_quantity'], 9)
+
+    def test_add_mode_adds_to_existing_quantities(self):
+        pen0, pen1, pen2 = self.products[:3]
+        response = self.bulk_update([(pen0, 2), (pen2, 1), (pen2, 1)], mode='add')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.lines(), {'PN-0': 3, 'PN-1': 1, 'PN-2': 2})
+
+    def test_one_failing_line_applies_nothing(self):
+        pen0, pen1, pen2 = self.products[:3]
+        other = Order.objects.create(
+            user=self.user, subtotal=Decimal('1'), total_amount=Decimal('1'), shipping_address={},
+            billing_address={}, customer_email=self.user.email, customer_phone='0700000000',
+        )
+        # Units held for someone else's unpaid order are not available
+        StockReservation.objects.create(
+            order=other, product=pen1, quantity=3, expires_at=timezone.now() + timedelta(minutes=5)
+        )
+        pen2.active = False
+        pen2.save()
+
+        response = self.bulk_update([(pen0, 5), (pen1, 3), (pen2, 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['items'], {pen1.id: 'Only 2 items available', pen2.id: 'Product not found'})
+        self.assertEqual(self.lines(), {'PN-0': 1, 'PN-1': 1})
+
+        response = self.client.post('/api/cart/bulk_update/', {'items': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_query_count_does_not_grow_with_items(self):
+        # Cart, savepoint, products, holds, locked lines, one delete, update and
+        # insert each, release, then the response's items with their products
+        pen0, pen1, pen2 = self.products[:3]
+        with self.assertNumQueries(10):
+            self.bulk_update([(pen0, 0), (pen1, 2), (pen2, 2)])
+        with self.assertNumQueries(10):
+            response = self.bulk_update([(pen1, 0), (pen2, 1)] + [(product, 1) for product in self.products[3:]])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.lines()), 10)
+
+
+@override_settings(GUEST_CART_CACHE='default')
+class GuestCartTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Ink', slug='ink-bottles')
+        self.ink, self.paper = [
+            Product.objects.create(
+                name=name, slug=name.lower(), sku=name.upper(), description=name,
+                price=Decimal('800.00'), category=category, main_image='', stock=stock,
+            )
+            for name, stock in (('Ink', 10), ('Paper', 2))
+        ]
+        self.client = APIClient()
+
+    def post(self, action, **data):
+        response = self.client.post(f'/api/cart/{action}/', data)
+        lines = {item['product']['sku']: item['quantity'] for item in response.data.get('items', [])}
+        return response, lines
+
+    def test_guest_cart_is_kept_in_the_cache(self):
+        response = self.client.get('/api/cart/my_cart/')
+        self.assertEqual(response.data['items'], [])
+        self.assertNotIn(CART_TOKEN_HEADER, response)
+
+        response, lines = self.post('add_item', product_id=self.ink.id, quantity=2)
+        token = response[CART_TOKEN_HEADER]
+        self.assertEqual(response.cookies[CART_TOKEN_COOKIE].value, token)
+        self.assertEqual(lines, {'INK': 2})
+
+        # The token comes back as a header (or the cookie) on later requests
+        self.client.cookies.clear()
+        self.client.credentials(HTTP_X_CART_TOKEN=token)
+        self.assertEqual(self.post('add_item', product_id=self.ink.id, quantity=1)[1], {'INK': 3})
+        self.assertEqual(self.post('add_item', product_id=self.paper.id, quantity=1)[1], {'INK': 3, 'PAPER': 1})
+        self.assertEqual(self.post('add_item', product_id=self.paper.id, quantity=5)[0].status_code, 400)
+        self.assertEqual(self.post('update_item', product_id=self.ink.id, quantity=5)[1], {'INK': 5, 'PAPER': 1})
+        self.assertEqual(self.post('remove_item', product_id=self.paper.id)[1], {'INK': 5})
+        self.assertEqual(self.post('remove_item', product_id=self.paper.id)[0].status_code, 404)
+        self.assertEqual(self.post('update_item', product_id=self.ink.id, quantity=0)[1], {})
+
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+    def test_login_merges_the_guest_cart(self):
+        user = User.objects.create_user(username='returning', email='returning@example.com', password='secret')
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=self.ink, quantity=1)
+        token = self.post('add_item', product_id=self.ink.id, quantity=2)[0][CART_TOKEN_HEADER]
+        guest = GuestCart.load(token)
+        guest.add(self.paper.id, 3)
+        guest.save()
+
+        response = self.client.post('/api/auth/token/', {'username': 'returning', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        # Quantities add up, capped at what is available
+        self.assertEqual(dict(cart.items.values_list('product__sku', 'quantity')), {'INK': 3, 'PAPER': 2})
+        self.assertEqual(GuestCart.load(token).lines, {})
+        self.assertFalse(Cart.objects.filter(user=None).exists())
+
+
+class CheckoutConcurrencyTests(TransactionTestCase):
+    """Many buyers checking out the last units of one SKU at the same moment"""
+
+    BUYERS = 20
+    STOCK = 5
+
+    def setUp(self):
+        category = Category.objects.create(name='Toner', slug='toner')
+        self.product = Product.objects.create(
+            name='TK-8305 Toner', slug='tk-8305', sku='TK-8305', description='Toner',
+            price=Decimal('4500.00'), category=category, main_image='products/tk-8305.jpg',
+            stock=self.STOCK,
+        )
+        self.users = []
+        for number in range(self.BUYERS):
+            user = User.objects.create_user(
+                username=f'buyer{number}', email=f'buyer{number}@example.com', password='secret'
+            )
+            cart = Cart.objects.create(user=user)
+            CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+            self.users.append(user)
+
+    def test_same_sku_is_never_oversold(self):
+        barrier = threading.Barrier(self.BUYERS)
+        statuses = []
+
+        def checkout(user):
+            # The test client's exception hook is process-wide, so a client could
+            # re-raise another thread's error; read status codes instead
+            client = APIClient(raise_request_exception=False)
+            client.force_authenticate(user)
+            try:
+                barrier.wait()
+                response = client.post('/api/orders/', checkout_payload(), format='json')
+                statuses.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=checkout, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sold = statuses.count(201)
+        self.product.refresh_from_db()
+        held = StockReservation.objects.filter(status='held').aggregate(held=Sum('quantity'))['held'] or 0
+        self.assertLessEqual(sold, self.STOCK)
+        # M-Pesa orders hold stock until paid rather than taking it
+        self.assertEqual(self.product.stock, self.STOCK)
+        self.assertEqual(self.product.stock - held, self.STOCK - sold)
+        self.assertEqual(Order.objects.count(), sold)
+        self.assertEqual(OrderItem.objects.filter(product=self.product).count(), sold)
+        self.assertEqual(CartItem.objects.count(), self.BUYERS - sold)
+        if connection.features.has_select_for_update:
+            # With row locks every buyer is served in turn until stock runs out.
+            # (SQLite may instead fail some checkouts with "database is locked".)
+            self.assertEqual(sold, self.STOCK)
+            self.assertEqual(statuses.count(400), self.BUYERS - self.STOCK)
+
+
+class OrderNumberTests(TransactionTestCase):
+    """Thousands of order numbers handed out at once by many workers"""
+
+    def run_threads(self, target, count):
+        results = [[] for _ in range(count)]
+        failures = []
+        barrier = threading.Barrier(count)
+
+        def run(index):
+            try:
+                barrier.wait()
+                target(results[index])
+            except DatabaseError as e:
+                # SQLite may give up with "database is locked" under this load
+                failures.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if connection.features.has_select_for_update:
+            self.assertEqual(failures, [])
+        return results, failures
+
+    def test_workers_never_hand_out_the_same_number(self):
+        def worker(numbers):
+            # A separate allocator per thread stands in for a separate process
+            allocator = OrderNumberAllocator(block_size=50)
+            for _ in range(500):
+                numbers.append(allocator.allocate())
+
+        results, failures = self.run_threads(worker, 16)
+        numbers = [number for worker_numbers in results for number in worker_numbers]
+        self.assertEqual(len(set(numbers)), len(numbers))
+        self.assertTrue(all(re.match(r'^ORD\d{14}$', number) for number in numbers))
+        for worker_numbers in results:
+            self.assertEqual(worker_numbers, sorted(worker_numbers))
+        if not failures:
+            self.assertEqual(len(numbers), 16 * 500)
+            # Every reserved block was used up, so there are no gaps
+            self.assertEqual(OrderNumberCounter.objects.get().last, len(numbers))
+
+    def test_concurrent_orders_get_unique_numbers(self):
+        user = User.objects.create_user(username='bulk', email='bulk@example.com', password='secret')
+
+        def place_orders(numbers):
+            for _ in range(150):
+                order = Order.objects.create(
+                    user=user, subtotal=Decimal('100'), total_amount=Decimal('100'),
+                    shipping_address={}, billing_address={},
+                    customer_email=user.email, customer_phone='0700000000',
+                )
+                numbers.append(order.order_number)
+
+        results, failures = self.run_threads(place_orders, 8)
+        placed = sum(len(numbers) for numbers in results)
+        self.assertEqual(Order.objects.count(), placed)
+        self.assertEqual(Order.objects.values('order_number').distinct().count(), placed)
+        if not failures:
+            self.assertEqual(placed, 8 * 150)
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Printers', slug='printers')
+        self.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = []
+        for number in range(3):
+            product = Product.objects.create(
+                name=f'Printer {number}', slug=f'printer-{number}', sku=f'PR-{number}', description='Printer',
+                price=Decimal('1000.00'), category=category, main_image='products/printer.jpg', stock=10,
+            )
+            CartItem.objects.create(cart=self.cart, product=product, quantity=number + 1)
+            self.products.append(product)
+
+    def stock(self):
+        return [product.stock for product in Product.objects.order_by('id')]
+
+    def test_checkout_creates_items_and_decrements_stock(self):
+        response = self.client.post('/api/orders/', checkout_payload('cash'), format='json')
+        self.assertEqual(response.status_code, 201)
+
+        order = Order.objects.get()
+        self.assertRegex(order.order_number, r'^ORD\d{14}$')
+        self.assertEqual(order.subtotal, Decimal('6000.00'))
+        self.assertEqual(order.tax_amount, Decimal('960.00'))
+        self.assertEqual(order.total_amount, Decimal('7160.00'))
+        self.assertEqual(
+            sorted(order.items.values_list('product_sku', 'quantity')),
+            [('PR-0', 1), ('PR-1', 2), ('PR-2', 3)]
+        )
+        self.assertEqual(self.stock(), [9, 8, 7])
+        self.assertFalse(self.cart.items.exists())
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_short_stock_rolls_back_everything(self):
+        Product.objects.filter(pk=self.products[2].pk).update(stock=2)
+        response = self.client.post('/api/orders/', checkout_payload(), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 3)
+        self.assertEqual(self.stock(), [10, 10, 2])
+
+    def test_mpesa_checkout_holds_stock_until_paid(self):
+        response = self.client.post('/api/orders/', checkout_payload(), format='json')
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get()
+        self.assertEqual(self.stock(), [10, 10, 10])
+        self.assertEqual(
+            sorted(order.reservations.values_list('product_id', 'quantity', 'status')),
+            [(product.id, number + 1, 'held') for number, product in enumerate(self.products)]
+        )
+
+        # Held units are not available to anyone else
+        response = self.client.post('/api/cart/add_item/', {'product_id': self.products[2].id, 'quantity': 8})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Only 7 items available')
+
+        MpesaTransaction.objects.create(
+            order=order, phone_number='254700000000', amount=order.total_amount, checkout_request_id='ws_CO_1'
+        )
+        self.assertTrue(MpesaCallbackHandler.handle_stk_callback(stk_callback('ws_CO_1', 0)))
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(self.stock(), [9, 8, 7])
+        self.assertEqual(set(order.reservations.values_list('status', flat=True)), {'confirmed'})
+
+        # Cancelling puts back what was taken
+        response = self.client.post(f'/api/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stock(), [10, 10, 10])
+
+    def test_failed_payment_releases_holds(self):
+        self.client.post('/api/orders/', checkout_payload(), format='json')
+        order = Order.objects.get()
+        MpesaTransaction.objects.create(
+            order=order, phone_number='254700000000', amount=order.total_amount, checkout_request_id='ws_CO_2'
+        )
+        MpesaCallbackHandler.handle_stk_callback(stk_callback('ws_CO_2', 1032))
+        self.assertEqual(set(order.reservations.values_list('status', flat=True)), {'released'})
+
+        response = self.client.post(f'/api/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stock(), [10, 10, 10])
+
+    def test_expired_holds_are_released_and_orders_cancelled(self):
+        self.client.post('/api/orders/', checkout_payload(), format='json')
+        order = Order.objects.get()
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('release_expired_reservations', stdout=StringIO())
+
+        order.refresh_from_db()
+        self.assertEqual((order.status, order.payment_status), ('cancelled', 'cancelled'))
+        self.assertEqual(set(order.reservations.values_list('status', flat=True)), {'released'})
+        self.assertEqual(self.stock(), [10, 10, 10])
+
+
+    def test_payment_after_cancellation_keeps_the_order_cancelled(self):
+        self.client.post('/api/orders/', checkout_payload(), format='json')
+        order = Order.objects.get()
+        MpesaTransaction.objects.create(
+            order=order, phone_number='254700000000', amount=order.total_amount, checkout_request_id='ws_CO_3'
+        )
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        call_command('release_expired_reservations', stdout=StringIO())
+
+        with self.assertLogs('mpesa.services', 'WARNING'):
+            self.assertTrue(MpesaCallbackHandler.handle_stk_callback(stk_callback('ws_CO_3', 0)))
+        order.refresh_from_db()
+        # Flagged as paid for a refund, without taking stock that may be sold
+        self.assertEqual((order.status, order.payment_status), ('cancelled', 'paid'))
+        self.assertEqual(set(order.reservations.values_list('status', flat=True)), {'released'})
+        self.assertEqual(self.stock(), [10, 10, 10])
+
+    def test_listings_count_held_units_as_out_of_stock(self):
+        Product.objects.filter(pk=self.products[0].pk).update(stock=1)
+        self.client.post('/api/orders/', checkout_payload(), format='json')
+
+        response = self.client.get('/api/products/', {'fields': 'sku,in_stock', 'ordering': 'name'})
+        self.assertEqual(
+            [(product['sku'], product['in_stock']) for product in response.data['results']],
+            [('PR-0', False), ('PR-1', True), ('PR-2', True)]
+        )
+        self.assertEqual(self.client.get('/api/products/facets/').data['facets']['flags']['in_stock'], 2)
+
+
+class OrderHistoryTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Paper', slug='paper')
+        self.user = User.objects.create_user(username='history', email='history@example.com', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.products = [
+            Product.objects.create(
+                name=f'Ream {number}', slug=f'ream-{number}', sku=f'RM-{number}', description='Paper',
+                price=Decimal('650.00'), category=category, main_image='products/ream.jpg', stock=50,
+            )
+            for number in range(4)
+        ]
+
+    def place_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(
+                user=self.user, subtotal=Decimal('2600'), total_amount=Decimal('2600'),
+                shipping_address={}, billing_address={},
+                customer_email=self.user.email, customer_phone='0700000000',
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=1, price=product.price,
+                          product_name=product.name, product_sku=product.sku)
+                for product in self.products
+            ])
+
+    def test_query_count_does_not_grow_with_orders(self):
+        self.place_orders(2)
+        # Orders, their items, and the items' products
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/orders/')
+        self.place_orders(8)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/orders/')
+
+        self.assertEqual(len(response.data['results']), 10)
+        first = response.data['results'][0]
+        self.assertEqual(first['items_count'], 4)
+        self.assertNotIn('average_rating', first['items'][0]['product'])
+
+    def test_items_count_is_annotated_without_items(self):
+        self.place_orders(5)
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/orders/', {'fields': 'id,order_number,items_count'})
+        self.assertEqual([order['items_count'] for order in response.data['results']], [4] * 5)
+
+
+class StockRestorationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Drums', slug='drums')
+        self.user = User.objects.create_user(username='b2b', email='b2b@example.com', password='secret')
+        self.products = [
+            Product.objects.create(
+                name=f'Drum {number}', slug=f'drum-{number}', sku=f'DR-{number}', description='Drum unit',
+                price=Decimal('9000.00'), category=category, main_image='products/drum.jpg', stock=5,
+            )
+            for number in range(5)
+        ]
+
+    def place_orders(self, count, **fields):
+        orders = []
+        for _ in range(count):
+            order = Order.objects.create(
+                user=self.user, subtotal=Decimal('1'), total_amount=Decimal('1'),
+                shipping_address={}, billing_address={},
+                customer_email=self.user.email, customer_phone='0700000000', **fields
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, quantity=2, price=product.price,
+                          product_name=product.name, product_sku=product.sku)
+                for product in self.products
+            ])
+            orders.append(order)
+        return orders
+
+    def stock(self):
+        return [product.stock for product in Product.objects.order_by('id')]
+
+    def test_restoring_is_bulk_and_logged(self):
+        orders = self.place_orders(1, payment_method='cash')
+        # Savepoint, 3 lookups, release holds, one stock UPDATE, one INSERT, release
+        with self.assertNumQueries(8):
+            restore_orders_stock(orders, 'cancelled')
+        orders = self.place_orders(10, payment_method='cash')
+        # Same statements for ten orders of five lines as for one
+        with self.assertNumQueries(8):
+            restore_orders_stock(orders, 'cancelled')
+
+        self.assertEqual(self.stock(), [5 + 2 * 11] * 5)
+        self.assertEqual(StockAdjustment.objects.count(), 11 * 5)
+        self.assertEqual(set(StockAdjustment.objects.values_list('quantity', 'reason')), {(2, 'cancelled')})
+
+    def test_refund_after_cancel_does_not_restore_twice(self):
+        orders = self.place_orders(1, payment_method='cash')
+        restore_orders_stock(orders, 'cancelled')
+        self.assertEqual(restore_orders_stock(orders, 'refunded'), {})
+        self.assertEqual(self.stock(), [7] * 5)
+
+    def test_cancel_endpoint_restores_once(self):
+        order, = self.place_orders(1, payment_method='cash')
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.post(f'/api/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], 'cancelled')
+        response = client.post(f'/api/orders/{order.id}/cancel/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stock(), [7] * 5)
+
+    def test_admin_status_changes_restore_stock(self):
+        admin = User.objects.create_superuser(username='staff', email='staff@example.com', password='secret')
+        self.client.force_login(admin)
+        first, second, shipped = self.place_orders(3, payment_method='cash')
+        Order.objects.filter(pk=shipped.pk).update(status='shipped')
+
+        response = self.client.post('/admin/store/order/', {
+            'action': 'cancel_orders', '_selected_action': [first.pk, shipped.pk],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.stock(), [7] * 5)
+        self.assertEqual(
+            dict(Order.objects.values_list('pk', 'status')),
+            {first.pk: 'cancelled', second.pk: 'pending', shipped.pk: 'shipped'}
+        )
+
+        # A refund set from the changelist gives back the shipped order's stock
+        changelist = {
+            'form-TOTAL_FORMS': '3', 'form-INITIAL_FORMS': '3', '_save': 'Save',
+        }
+        for index, order in enumerate(Order.objects.order_by('-created_at', '-id')):
+            changelist.update({
+                f'form-{index}-id': order.pk,
+                f'form-{index}-status': 'refunded' if order.pk == shipped.pk else order.status,
+                f'form-{index}-payment_status': order.payment_status,
+            })
+        response = self.client.post('/admin/store/order/', changelist)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.stock(), [9] * 5)
+        self.assertEqual(StockAdjustment.objects.filter(order=shipped, reason='refunded').count(), 5)
+
+
+class SalesReportTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Toner', slug='toner')
+        self.user = User.objects.create_user(username='shopper', email='shopper@example.com', password='secret')
+        self.staff = User.objects.create_user(
+            username='analyst', email='analyst@example.com', password='secret', is_staff=True
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        self.toner, self.drum = [
+            Product.objects.create(
+                name=name, slug=name.lower(), sku=name.upper(), description=name, price=price,
+                category=self.category, main_image='products/toner.jpg', stock=100,
+            )
+            for name, price in (('Toner', Decimal('4000.00')), ('Drum', Decimal('9000.00')))
+        ]
+        self.today = timezone.now().date()
+
+    def place_order(self, days_ago, lines, **fields):
+        subtotal = sum(product.price * quantity for product, quantity in lines)
+        order = Order.objects.create(
+            user=self.user, subtotal=subtotal, total_amount=subtotal + 200, shipping_cost=200,
+            shipping_address={}, billing_address={},
+            customer_email=self.user.email, customer_phone='0700000000', **fields
+        )
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=quantity, price=product.price,
+                      product_name=product.name, product_sku=product.sku)
+            for product, quantity in lines
+        ])
+        placed_at = timezone.now() - timedelta(days=days_ago)
+        Order.objects.filter(pk=order.pk).update(created_at=placed_at, updated_at=placed_at)
+        return order
+
+    def report(self, **params):
+        response = self.client.get('/api/reports/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_reports_are_read_from_incrementally_refreshed_rollups(self):
+        self.place_order(1, [(self.toner, 2), (self.drum, 1)], payment_method='cash')
+        paid = self.place_order(0, [(self.toner, 1)])
+        self.assertEqual(len(refresh_rollups()), 2)
+
+        # Totals, day rows, labels and the watermark: a handful of rollup reads
+        with self.assertNumQueries(3):
+            data = self.report(group_by='day')
+        self.assertEqual(data['totals']['orders'], 2)
+        self.assertEqual(data['totals']['subtotal'], Decimal('21000.00'))
+        self.assertEqual(
+            [(row['key'], row['orders']) for row in data['results']],
+            [(self.today - timedelta(days=1), 1), (self.today, 1)]
+        )
+
+        data = self.report(group_by='product')
+        self.assertEqual(
+            [(row['label'], row['units'], row['revenue']) for row in data['results']],
+            [('Toner (TONER)', 3, Decimal('12000.00')), ('Drum (DRUM)', 1, Decimal('9000.00'))]
+        )
+
+        # Only the changed order's day is rebuilt; it drops out of the default statuses
+        paid.status = 'cancelled'
+        paid.save()
+        self.assertEqual(refresh_rollups(), [self.today])
+        self.assertEqual(self.report()['totals']['orders'], 1)
+        data = self.report(group_by='status', status='cancelled,pending')
+        self.assertEqual(
+            sorted((row['key'], row['label'], row['orders']) for row in data['results']),
+            [('cancelled', 'Cancelled', 1), ('pending', 'Pending', 1)]
+        )
+
+    def test_full_rebuild_drops_deleted_orders(self):
+        order = self.place_order(3, [(self.drum, 2)])
+        refresh_rollups()
+        order.delete()
+        refresh_rollups()
+        self.assertEqual(self.report()['totals']['orders'], 1)
+        refresh_rollups(full=True)
+        self.assertEqual(self.report()['totals']['orders'], 0)
+
+    def test_staff_only_and_validated(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/reports/').status_code, 403)
+        self.client.force_authenticate(self.staff)
+        response = self.client.get('/api/reports/', {'group_by': 'colour', 'status': 'lost'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'group_by', 'status'})
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Ink', slug='ink')
+        self.product = Product.objects.create(
+            name='Ink', slug='ink', sku='INK-1', description='Ink', price=Decimal('1500.00'),
+            category=category, main_image='products/ink.jpg', stock=100,
+        )
+        self.user = User.objects.create_user(username='finance', email='finance@example.com', password='secret')
+        self.orders = []
+        for days_ago in (0, 0, 0, 2, 60):
+            order = Order.objects.create(
+                user=self.user, subtotal=Decimal('1500'), total_amount=Decimal('1700'),
+                shipping_address={}, billing_address={},
+                customer_email=self.user.email, customer_phone='0700000000',
+            )
+            OrderItem.objects.create(
+                order=order, product=self.product, quantity=1, price=self.product.price,
+                product_name=self.product.name, product_sku=self.product.sku,
+            )
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+            self.orders.append(order)
+        MpesaTransaction.objects.create(
+            order=self.orders[0], phone_number='254700000000', amount=Decimal('1700'), mpesa_receipt_number='QWE123'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_and_ndjson_downloads_for_staff_only(self):
+        self.assertEqual(self.client.get('/api/exports/orders/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+
+        rows = list(csv.DictReader(StringIO(self.download('/api/exports/orders/'))))
+        # The order from 60 days ago is outside the default 30-day range
+        self.assertEqual([int(row['id']) for row in rows], [order.id for order in self.orders[:4]])
+        self.assertEqual(rows[0]['total_amount'], '1700.00')
+        self.assertEqual(rows[0]['paid_at'], '')
+
+        today = timezone.now().date().isoformat()
+        lines = self.download('/api/exports/order_items/', output='ndjson', start=today, end=today).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['order__order_number'], self.orders[0].order_number)
+
+        lines = self.download('/api/exports/mpesa_transactions/', output='ndjson').splitlines()
+        self.assertEqual(json.loads(lines[0])['mpesa_receipt_number'], 'QWE123')
+
+        self.assertEqual(self.client.get('/api/exports/orders/', {'output': 'xlsx'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/exports/users/').status_code, 404)
+
+    def test_rows_are_read_in_batches(self):
+        start = (timezone.now() - timedelta(days=90)).date()
+        end = timezone.now().date()
+        with self.assertNumQueries(3):
+            # Five rows in batches of two: 2 + 2 + 1
+            lines = list(export_lines('orders', start, end, 'ndjson', batch_size=2))
+        self.assertEqual([json.loads(line)['id'] for line in lines], [order.id for order in self.orders])
+
+    def test_management_command(self):
+        out = StringIO()
+        call_command('export_accounting', 'orders', '--start', '2000-01-01', stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 1 + len(self.orders))
@@ -11,6 +11,8 @@ router.register(r'cart', views.CartViewSet, basename='cart')
 router.register(r'orders', views.OrderViewSet, basename='order')
 router.register(r'wishlist', views.WishlistViewSet, basename='wishlist')
 router.register(r'shipping-addresses', views.ShippingAddressViewSet, basename='shippingaddress')
+router.register(r'reports', views.SalesReportViewSet, basename='report')
+router.register(r'exports', views.ExportViewSet, basename='export')
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,13 +1,56 @@
+from datetime import timedelta
+from decimal import Decimal
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Avg, Count
+from django.db.models import Q, Count, Case, When, Value, IntegerField, Prefetch, prefetch_related_objects
+from django.db.models.functions import Coalesce
 from .models import Category, Brand, Product, ProductReview, Cart, CartItem, Order, OrderItem, Wishlist, ShippingAddress
 from .serializers import *
+from .catalog import category_tree, catalog_etag, catalog_last_modified, home_snapshot
+from .search import product_search
+from .carts import CART_TOKEN_COOKIE, CART_TOKEN_HEADER, GuestCart, guest_token, merge_guest_cart
+from .inventory import (
+    available_stock, held_quantities, held_stock, reserve, restore_orders_stock, take_stock, with_available_stock
+)
+from .exports import DATASETS as EXPORT_DATASETS, FORMATS as EXPORT_FORMATS, export_filename, export_lines
+from .order_numbers import allocate_order_number
+from .reports import sales_report
+from .pagination import KeysetPagination
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class ConditionalCatalogMixin:
+    """
+    ETag / Last-Modified for catalog reads. A matching If-None-Match or
+    If-Modified-Since is answered with 304 in dispatch(), before the queryset
+    or serializer is touched.
+    """
+    
+    @method_decorator(condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified))
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+    
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method in ('GET', 'HEAD'):
+            # Cacheable, but revalidate every time so catalog edits show up at once
+            patch_cache_control(response, no_cache=True)
+        return response
+
+class CategoryViewSet(ConditionalCatalogMixin, viewsets.ModelViewSet):
+    """
+    Reads are served from the cached category tree (store.catalog), which is
+    rebuilt from a single query whenever a category or product changes.
+    """
     queryset = Category.objects.filter(active=True)
     serializer_class = CategorySerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -20,19 +63,29 @@ class CategoryViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(parent__isnull=True)
         return queryset
     
+    def list(self, request, *args, **kwargs):
+        tree = category_tree.get()
+        nodes = tree.roots if request.query_params.get('parent') == 'null' else tree.nodes
+        page = self.paginate_queryset(nodes)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(nodes)
+    
+    def retrieve(self, request, *args, **kwargs):
+        node = category_tree.get().by_slug.get(kwargs[self.lookup_field])
+        if node is None:
+            raise Http404
+        return Response(node)
+    
     @action(detail=False)
     def featured(self, request):
-        featured_categories = self.queryset.filter(featured=True)
-        serializer = self.get_serializer(featured_categories, many=True)
-        return Response(serializer.data)
+        return Response(category_tree.get().featured)
     
     @action(detail=False)
     def main_categories(self, request):
-        main_categories = self.queryset.filter(parent__isnull=True)
-        serializer = self.get_serializer(main_categories, many=True)
-        return Response(serializer.data)
+        return Response(category_tree.get().roots)
 
-class BrandViewSet(viewsets.ModelViewSet):
+class BrandViewSet(ConditionalCatalogMixin, viewsets.ModelViewSet):
     queryset = Brand.objects.filter(active=True)
     serializer_class = BrandSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -40,49 +93,48 @@ class BrandViewSet(viewsets.ModelViewSet):
 
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ConditionalCatalogMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductListSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['brand', 'featured', 'best_seller', 'new_arrival']  # remove 'category'
     lookup_field = 'slug'
+    pagination_class = KeysetPagination
+    
+    # Best matches kept for a search; ranking beyond this is noise
+    MAX_SEARCH_RESULTS = 500
+    
+    FLAG_FILTERS = ('featured', 'best_seller', 'new_arrival', 'on_sale')
+    
+    # Lower bounds (KSh) of the price facet buckets; the last one is open-ended
+    PRICE_BUCKETS = (0, 10000, 25000, 50000, 100000, 250000, 500000)
 
     def get_queryset(self):
-        queryset = Product.objects.filter(active=True).select_related(
-            'category', 'brand'
-        ).prefetch_related(
-            'additional_images', 'attributes', 'reviews'
-        )
-
-        # 🔍 Search
-        search = self.request.query_params.get('search')
-        if search:
-            queryset = queryset.filter(
-                Q(name__icontains=search) |
-                Q(description__icontains=search) |
-                Q(sku__icontains=search) |
-                Q(short_description__icontains=search)
-            )
-
-        # 💰 Price filtering
-        min_price = self.request.query_params.get('min_price')
-        max_price = self.request.query_params.get('max_price')
-        if min_price:
-            queryset = queryset.filter(price__gte=min_price)
-        if max_price:
-            queryset = queryset.filter(price__lte=max_price)
-
-        # 🏷️ Category filter via slug
-        category_slug = self.request.query_params.get('category') or \
-                        self.request.query_params.get('category_slug')
-        if category_slug:
-            queryset = queryset.filter(category__slug=category_slug)
+        queryset = with_available_stock(Product.objects.filter(active=True).select_related('rating_summary'))
+        if self.action == 'retrieve':
+            # Only join and prefetch what ?fields= / ?expand= will render. An
+            # empty select_related() would follow every foreign key instead
+            request = self.request
+            related = [
+                name for name in ('category', 'brand')
+                if field_requested(request, name, expandable=True)
+            ]
+            prefetches = [
+                lookup for name, lookup in (
+                    ('additional_images', 'additional_images'),
+                    ('attributes', 'attributes'),
+                    ('reviews', Prefetch('reviews', queryset=ProductReview.objects.select_related('user'))),
+                )
+                if field_requested(request, name, expandable=True)
+            ]
+            if related:
+                queryset = queryset.select_related(*related)
+            if prefetches:
+                queryset = queryset.prefetch_related(*prefetches)
 
-        # 🏢 Brand filter via slug
-        brand_slug = self.request.query_params.get('brand_slug')
-        if brand_slug:
-            queryset = queryset.filter(brand__slug=brand_slug)
+        queryset = self.filter_products(queryset, self.request.query_params)
+        search_ids = self.get_search_ids()
 
         # 🔄 Ordering
         ordering = self.request.query_params.get('ordering')
@@ -99,21 +151,146 @@ class ProductViewSet(viewsets.ModelViewSet):
                 queryset = queryset.order_by('-created_at')
             elif ordering == 'created_at':
                 queryset = queryset.order_by('created_at')
+            elif ordering == 'popularity':
+                queryset = queryset.order_by('sales_rank', '-created_at')
             elif ordering == 'rating':
-                queryset = queryset.annotate(avg_rating=Avg('reviews__rating')).order_by('-avg_rating')
+                queryset = queryset.annotate(
+                    rating=Coalesce('rating_summary__average_rating', Value(0.0))
+                ).order_by('-rating')
+        elif search_ids:
+            # Relevance order
+            queryset = queryset.annotate(
+                search_rank=Case(
+                    *[When(id=product_id, then=Value(rank)) for rank, product_id in enumerate(search_ids)],
+                    output_field=IntegerField()
+                )
+            ).order_by('search_rank')
         else:
             queryset = queryset.order_by('-created_at')
 
         return queryset
 
+    def get_search_ids(self):
+        """Ranked ids for ?search= from the in-process index (see store.search)"""
+        if not hasattr(self, '_search_ids'):
+            search = self.request.query_params.get('search')
+            self._search_ids = None
+            if search:
+                self._search_ids = [
+                    product_id for product_id, score in
+                    product_search.search(search, limit=self.MAX_SEARCH_RESULTS)
+                ]
+        return self._search_ids
+
+    def filter_products(self, queryset, params, skip=()):
+        """
+        Apply the storefront filters in ``params``. ``skip`` leaves out filter
+        groups ('price', 'category', 'brand') so facets can count across them.
+        """
+        # Bad numbers are a 400, not a ValueError from the ORM
+        typed = ProductFilterQuerySerializer(data={key: value for key, value in params.items() if value})
+        typed.is_valid(raise_exception=True)
+        typed = typed.validated_data
+
+        # 🔍 Search
+        search_ids = self.get_search_ids()
+        if search_ids is not None:
+            queryset = queryset.filter(id__in=search_ids)
+
+        # 💰 Price filtering
+        if 'price' not in skip:
+            if 'min_price' in typed:
+                queryset = queryset.filter(price__gte=typed['min_price'])
+            if 'max_price' in typed:
+                queryset = queryset.filter(price__lte=typed['max_price'])
+
+        # 🏷️ Category filter via slug
+        category_slug = params.get('category') or params.get('category_slug')
+        if category_slug and 'category' not in skip:
+            queryset = queryset.filter(category__slug=category_slug)
+
+        # 🏢 Brand filter via slug or id
+        if 'brand' not in skip:
+            brand_slug = params.get('brand_slug')
+            if brand_slug:
+                queryset = queryset.filter(brand__slug=brand_slug)
+            if 'brand' in typed:
+                queryset = queryset.filter(brand_id=typed['brand'])
+
+        # 🚩 Flags
+        for flag in self.FLAG_FILTERS:
+            value = params.get(flag)
+            if value is not None and value.lower() in ('true', 'false', '1', '0'):
+                queryset = queryset.filter(**{flag: value.lower() in ('true', '1')})
+
+        return queryset
+
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return ProductDetailSerializer
         return ProductListSerializer
 
+    # 🧮 Facet counts for the filter sidebar, plus the current page
+    @action(detail=False)
+    def facets(self, request):
+        params = request.query_params
+        base = Product.objects.filter(active=True).order_by()
+
+        brands = self.filter_products(base, params, skip=('brand',)).filter(
+            brand__isnull=False
+        ).values('brand_id', 'brand__name', 'brand__slug').annotate(count=Count('id')).order_by('brand__name')
+
+        categories = self.filter_products(base, params, skip=('category',)).values(
+            'category_id', 'category__name', 'category__slug'
+        ).annotate(count=Count('id')).order_by('category__name')
+
+        bounds = self.PRICE_BUCKETS
+        price_buckets = self.filter_products(base, params, skip=('price',)).annotate(
+            bucket=Case(
+                *[When(price__lt=upper, then=Value(index)) for index, upper in enumerate(bounds[1:])],
+                default=Value(len(bounds) - 1),
+                output_field=IntegerField()
+            )
+        ).values('bucket').annotate(count=Count('id'))
+        bucket_counts = {row['bucket']: row['count'] for row in price_buckets}
+
+        flags = self.filter_products(base, params).aggregate(
+            total=Count('id'),
+            in_stock=Count('id', filter=Q(stock__gt=held_stock())),
+            **{flag: Count('id', filter=Q(**{flag: True})) for flag in self.FLAG_FILTERS}
+        )
+        total = flags.pop('total')
+
+        facets = {
+            'brands': [
+                {'id': row['brand_id'], 'name': row['brand__name'], 'slug': row['brand__slug'], 'count': row['count']}
+                for row in brands
+            ],
+            'categories': [
+                {'id': row['category_id'], 'name': row['category__name'], 'slug': row['category__slug'], 'count': row['count']}
+                for row in categories
+            ],
+            'price': [
+                {
+                    'min': lower,
+                    'max': bounds[index + 1] if index + 1 < len(bounds) else None,
+                    'count': bucket_counts.get(index, 0),
+                }
+                for index, lower in enumerate(bounds)
+            ],
+            'flags': flags,
+        }
+
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        serializer = self.get_serializer(page, many=True)
+        data = self.get_paginated_response(serializer.data).data
+        return Response({'total': total, 'facets': facets, **data})
+
     # 🌟 Featured products
     @action(detail=False)
     def featured(self, request):
+        if not request.query_params:
+            return Response(home_snapshot.get()['featured'])
         featured_products = self.get_queryset().filter(featured=True)[:12]
         serializer = self.get_serializer(featured_products, many=True)
         return Response(serializer.data)
@@ -121,13 +298,20 @@ class ProductViewSet(viewsets.ModelViewSet):
     # 🏆 Best sellers
     @action(detail=False)
     def best_sellers(self, request):
-        best_sellers = self.get_queryset().filter(best_seller=True)[:12]
+        if not request.query_params:
+            return Response(home_snapshot.get()['best_seller'])
+        best_sellers = self.get_queryset().filter(best_seller=True)
+        if not request.query_params.get('ordering'):
+            best_sellers = best_sellers.order_by('sales_rank', '-created_at')
+        best_sellers = best_sellers[:12]
         serializer = self.get_serializer(best_sellers, many=True)
         return Response(serializer.data)
 
     # 🆕 New arrivals
     @action(detail=False)
     def new_arrivals(self, request):
+        if not request.query_params:
+            return Response(home_snapshot.get()['new_arrival'])
         new_arrivals = self.get_queryset().filter(new_arrival=True)[:12]
         serializer = self.get_serializer(new_arrivals, many=True)
         return Response(serializer.data)
@@ -135,10 +319,17 @@ class ProductViewSet(viewsets.ModelViewSet):
     # 💸 On sale
     @action(detail=False)
     def on_sale(self, request):
+        if not request.query_params:
+            return Response(home_snapshot.get()['on_sale'])
         on_sale_products = self.get_queryset().filter(on_sale=True)[:12]
         serializer = self.get_serializer(on_sale_products, many=True)
         return Response(serializer.data)
     
+    # 🏠 Homepage: every rail plus featured categories and brands, from memory
+    @action(detail=False)
+    def home(self, request):
+        return Response(home_snapshot.get())
+    
     @action(detail=False, methods=['get'], url_path='slug/(?P<slug>[^/.]+)')
     def get_by_slug(self, request, slug=None):
         ...
@@ -165,23 +356,46 @@ class CartViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.AllowAny]  # 👈 Allow guests too
 
     def get_cart(self, request):
-        """Get or create cart for user or session"""
+        """The user's Cart, or for guests a cache-backed GuestCart (no session or rows created)"""
         if request.user.is_authenticated:
+            if guest_token(request):
+                merge_guest_cart(request, request.user)
             cart, created = Cart.objects.get_or_create(user=request.user)
-        else:
-            session_key = request.session.session_key
-            if not session_key:
-                request.session.create()  # create session if it doesn’t exist
-                session_key = request.session.session_key
+            return cart
+        return GuestCart.load(guest_token(request))
+
+    def cart_response(self, cart):
+        """Serialize the cart with its items and their products loaded in one query"""
+        guest = isinstance(cart, GuestCart)
+        if not guest and field_requested(self.request, 'items'):
+            prefetch_related_objects([cart], Prefetch(
+                'items', queryset=CartItem.objects.select_related('product__rating_summary')
+            ))
+        serializer = self.get_serializer(cart)
+        response = Response(serializer.data)
+
+        if guest and cart.session_key:
+            response[CART_TOKEN_HEADER] = cart.session_key
+            response.set_cookie(
+                CART_TOKEN_COOKIE, cart.session_key,
+                max_age=settings.GUEST_CART_TIMEOUT, httponly=True, samesite='Lax',
+                secure=settings.SESSION_COOKIE_SECURE
+            )
+        elif not guest and CART_TOKEN_COOKIE in self.request.COOKIES:
+            response.delete_cookie(CART_TOKEN_COOKIE, samesite='Lax')
+        return response
 
-            cart, created = Cart.objects.get_or_create(session_key=session_key, user=None)
-        return cart
+    @staticmethod
+    def parse_product_id(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
 
     @action(detail=False, methods=['get'])
     def my_cart(self, request):
         cart = self.get_cart(request)
-        serializer = self.get_serializer(cart)
-        return Response(serializer.data)
+        return self.cart_response(cart)
 
     @action(detail=False, methods=['post'])
     def add_item(self, request):
@@ -194,8 +408,14 @@ class CartViewSet(viewsets.ModelViewSet):
         except Product.DoesNotExist:
             return Response({'error': 'Product not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        if product.stock < quantity:
-            return Response({'error': f'Only {product.stock} items available'}, status=status.HTTP_400_BAD_REQUEST)
+        available = available_stock([product])[product.id]
+        if available < quantity:
+            return Response({'error': f'Only {max(available, 0)} items available'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if isinstance(cart, GuestCart):
+            cart.add(product.id, quantity)
+            cart.save()
+            return self.cart_response(cart)
 
         cart_item, created = CartItem.objects.get_or_create(
             cart=cart, product=product,
@@ -206,8 +426,7 @@ class CartViewSet(viewsets.ModelViewSet):
             cart_item.quantity += quantity
             cart_item.save()
 
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return self.cart_response(cart)
 
     @action(detail=False, methods=['post'])
     def update_item(self, request):
@@ -215,6 +434,17 @@ class CartViewSet(viewsets.ModelViewSet):
         product_id = request.data.get('product_id')
         quantity = int(request.data.get('quantity', 1))
 
+        if isinstance(cart, GuestCart):
+            product_id = self.parse_product_id(product_id)
+            if product_id not in cart.lines:
+                return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
+            if quantity <= 0:
+                del cart.lines[product_id]
+            else:
+                cart.lines[product_id] = quantity
+            cart.save()
+            return self.cart_response(cart)
+
         try:
             cart_item = CartItem.objects.get(cart=cart, product_id=product_id)
         except CartItem.DoesNotExist:
@@ -226,29 +456,119 @@ class CartViewSet(viewsets.ModelViewSet):
             cart_item.quantity = quantity
             cart_item.save()
 
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return self.cart_response(cart)
+
+    @action(detail=False, methods=['post'])
+    def bulk_update(self, request):
+        """
+        Apply a batch of product_id/quantity operations in one transaction:
+        one stock query for every product (and one for their holds), then bulk
+        create/update/delete.
+        Nothing is applied if any operation fails.
+        """
+        serializer = CartBulkUpdateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        add = serializer.validated_data['mode'] == 'add'
+
+        # Repeated products fold into one operation
+        operations = {}
+        for operation in serializer.validated_data['items']:
+            product_id, quantity = operation['product_id'], operation['quantity']
+            operations[product_id] = operations.get(product_id, 0) + quantity if add else quantity
+
+        cart = self.get_cart(request)
+        guest = isinstance(cart, GuestCart)
+        with transaction.atomic():
+            products = Product.objects.filter(id__in=operations, active=True).only('id', 'stock').in_bulk()
+            available = available_stock(products.values())
+            if guest:
+                existing = {}
+                current = {product_id: cart.lines[product_id] for product_id in operations if product_id in cart.lines}
+            else:
+                existing = {
+                    item.product_id: item
+                    for item in CartItem.objects.select_for_update().filter(cart=cart, product_id__in=operations)
+                }
+                current = {product_id: item.quantity for product_id, item in existing.items()}
+
+            errors = {}
+            changes = {}
+            for product_id, quantity in operations.items():
+                if add:
+                    quantity += current.get(product_id, 0)
+                if quantity == 0:
+                    if product_id in current:
+                        changes[product_id] = 0
+                    continue
+                product = products.get(product_id)
+                if product is None:
+                    errors[product_id] = 'Product not found'
+                elif available[product_id] < quantity:
+                    errors[product_id] = f'Only {max(available[product_id], 0)} items available'
+                elif current.get(product_id) != quantity:
+                    changes[product_id] = quantity
+
+            if errors:
+                return Response({'error': 'Cart not updated', 'items': errors}, status=status.HTTP_400_BAD_REQUEST)
+
+            if guest:
+                for product_id, quantity in changes.items():
+                    if quantity:
+                        cart.lines[product_id] = quantity
+                    else:
+                        del cart.lines[product_id]
+                cart.save()
+                return self.cart_response(cart)
+
+            now = timezone.now()
+            to_create, to_update, to_delete = [], [], []
+            for product_id, quantity in changes.items():
+                item = existing.get(product_id)
+                if not quantity:
+                    to_delete.append(item.id)
+                elif item:
+                    item.quantity = quantity
+                    item.updated_at = now
+                    to_update.append(item)
+                else:
+                    to_create.append(CartItem(cart=cart, product_id=product_id, quantity=quantity))
+
+            CartItem.objects.filter(id__in=to_delete).delete()
+            CartItem.objects.bulk_update(to_update, ['quantity', 'updated_at'])
+            CartItem.objects.bulk_create(to_create)
+
+        return self.cart_response(cart)
 
     @action(detail=False, methods=['post'])
     def remove_item(self, request):
         cart = self.get_cart(request)
         product_id = request.data.get('product_id')
 
+        if isinstance(cart, GuestCart):
+            product_id = self.parse_product_id(product_id)
+            if product_id not in cart.lines:
+                return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
+            del cart.lines[product_id]
+            cart.save()
+            return self.cart_response(cart)
+
         try:
             cart_item = CartItem.objects.get(cart=cart, product_id=product_id)
             cart_item.delete()
         except CartItem.DoesNotExist:
             return Response({'error': 'Item not found'}, status=status.HTTP_404_NOT_FOUND)
 
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        return self.cart_response(cart)
 
     @action(detail=False, methods=['post'])
     def clear(self, request):
         cart = self.get_cart(request)
-        cart.items.all().delete()
-        serializer = CartSerializer(cart)
-        return Response(serializer.data)
+        if isinstance(cart, GuestCart):
+            cart.delete()
+        else:
+            cart.items.all().delete()
+        return self.cart_response(cart)
 
 
 class OrderViewSet(viewsets.ModelViewSet):
@@ -256,103 +576,192 @@ class OrderViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['status', 'payment_status']
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user).prefetch_related('items')
+        """
+        Orders are rendered from the items' own snapshot (name, SKU, price)
+        plus a compact product reference, so a page costs the same handful of
+        queries however many orders and items it holds.
+        """
+        queryset = Order.objects.filter(user=self.request.user)
+        if field_requested(self.request, 'user'):
+            queryset = queryset.select_related('user')
+        if field_requested(self.request, 'items', expandable=True):
+            queryset = queryset.prefetch_related('items')
+            if field_requested(self.request, 'items.product', expandable=True):
+                queryset = queryset.prefetch_related(Prefetch(
+                    'items__product', queryset=Product.objects.only(*OrderProductSerializer.Meta.load_fields)
+                ))
+        elif field_requested(self.request, 'items_count'):
+            queryset = queryset.annotate(line_count=Count('items'))
+        return queryset
     
     def perform_create(self, serializer):
-        # Get user's cart
-        try:
-            cart = Cart.objects.get(user=self.request.user)
-        except Cart.DoesNotExist:
-            raise serializers.ValidationError("Cart is empty")
-        
-        if cart.is_empty:
-            raise serializers.ValidationError("Cart is empty")
+        """
+        Checkout in one transaction: the cart's products are locked in id
+        order (so concurrent checkouts queue instead of deadlocking) and
+        checked against available stock (on-hand minus active holds), the
+        items are bulk-inserted and the cart emptied with one DELETE. M-Pesa
+        orders hold the stock until the payment callback (see store.inventory);
+        other orders take it with one guarded UPDATE.
+        """
+        # Taken outside the transaction so it can come from this process's
+        # reserved block (see store.order_numbers); a failed checkout leaves a gap
+        order_number = allocate_order_number()
         
-        # Validate stock and calculate totals
-        subtotal = 0
-        order_items = []
-        
-        for cart_item in cart.items.all():
-            product = cart_item.product
+        with transaction.atomic():
+            # Get user's cart
+            cart = Cart.objects.filter(user=self.request.user).first()
+            if cart is None:
+                raise serializers.ValidationError("Cart is empty")
             
-            # Check stock
-            if product.stock < cart_item.quantity:
-                raise serializers.ValidationError(
-                    f"Not enough stock for {product.name}. Only {product.stock} available."
-                )
+            quantities = dict(cart.items.values_list('product_id', 'quantity'))
+            if not quantities:
+                raise serializers.ValidationError("Cart is empty")
             
-            # Calculate item total
-            item_total = product.price * cart_item.quantity
-            subtotal += item_total
+            products = list(Product.objects.select_for_update().filter(id__in=quantities).order_by('id'))
+            held = held_quantities(quantities)
             
-            # Prepare order item data
-            order_items.append({
-                'product': product,
-                'quantity': cart_item.quantity,
-                'price': product.price,
-                'product_name': product.name,
-                'product_sku': product.sku
-            })
-        
-        # Calculate other amounts (simplified for now)
-        shipping_cost = 200  # Fixed shipping cost for Kenya
-        tax_amount = subtotal * 0.16  # 16% VAT in Kenya
-        total_amount = subtotal + shipping_cost + tax_amount
-        
-        # Create order
-        order = serializer.save(
-            user=self.request.user,
-            subtotal=subtotal,
-            shipping_cost=shipping_cost,
-            tax_amount=tax_amount,
-            total_amount=total_amount,
-            customer_email=self.request.user.email,
-            customer_phone=self.request.user.phone or '',
-        )
-        
-        # Create order items and update product stock
-        for item_data in order_items:
-            OrderItem.objects.create(order=order, **item_data)
-            # Update product stock
-            item_data['product'].stock -= item_data['quantity']
-            item_data['product'].save()
-        
-        # Clear cart
-        cart.items.all().delete()
+            # Validate stock and calculate totals
+            subtotal = Decimal('0')
+            order_items = []
+            for product in products:
+                quantity = quantities[product.id]
+                available = product.stock - held.get(product.id, 0)
+                if available < quantity:
+                    raise serializers.ValidationError(
+                        f"Not enough stock for {product.name}. Only {max(available, 0)} available."
+                    )
+                subtotal += product.price * quantity
+                order_items.append(OrderItem(
+                    product=product,
+                    quantity=quantity,
+                    price=product.price,
+                    product_name=product.name,
+                    product_sku=product.sku,
+                ))
+            
+            # Calculate other amounts (simplified for now)
+            shipping_cost = Decimal('200')  # Fixed shipping cost for Kenya
+            tax_amount = (subtotal * Decimal('0.16')).quantize(Decimal('0.01'))  # 16% VAT in Kenya
+            total_amount = subtotal + shipping_cost + tax_amount
+            
+            # Create order
+            order = serializer.save(
+                user=self.request.user,
+                order_number=order_number,
+                subtotal=subtotal,
+                shipping_cost=shipping_cost,
+                tax_amount=tax_amount,
+                total_amount=total_amount,
+                customer_email=self.request.user.email,
+                customer_phone=self.request.user.phone or '',
+            )
+            
+            for order_item in order_items:
+                order_item.order = order
+            OrderItem.objects.bulk_create(order_items)
+            
+            # Only the products that still exist; a deleted one has no row to update
+            quantities = {product.id: quantities[product.id] for product in products}
+            if order.payment_method == 'mpesa':
+                reserve(order, quantities)
+            elif not take_stock(quantities, held=held):
+                raise serializers.ValidationError("Stock changed during checkout, please try again.")
+            
+            # Clear cart
+            cart.items.all().delete()
         
+        # The response renders the items the way get_queryset() loads them
+        prefetch_related_objects([order], 'items', Prefetch(
+            'items__product', queryset=Product.objects.only(*OrderProductSerializer.Meta.load_fields)
+        ))
         return order
     
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
         order = self.get_object()
         
-        if not order.can_be_cancelled:
-            return Response(
-                {'error': 'Order cannot be cancelled at this stage'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        
-        order.status = 'cancelled'
-        order.cancelled_at = timezone.now()
-        order.save()
-        
-        # Restore product stock
-        for order_item in order.items.all():
-            product = order_item.product
-            product.stock += order_item.quantity
-            product.save()
+        with transaction.atomic():
+            # Locked so a concurrent cancel or admin change waits, then sees this one
+            order = Order.objects.select_for_update().get(pk=order.pk)
+            if not order.can_be_cancelled:
+                return Response(
+                    {'error': 'Order cannot be cancelled at this stage'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            order.status = 'cancelled'
+            order.cancelled_at = timezone.now()
+            order.save(update_fields=['status', 'cancelled_at', 'updated_at'])
+            
+            # Release holds and restore whatever stock was taken, in bulk
+            restore_orders_stock([order], 'cancelled')
         
-        serializer = self.get_serializer(order)
+        # Reloaded the way get_queryset() renders orders
+        serializer = self.get_serializer(self.get_object())
         return Response(serializer.data)
 
+class SalesReportViewSet(viewsets.ViewSet):
+    """
+    Staff-only sales figures for a date range (default: the last 30 days),
+    totalled and grouped by ``group_by``. Read from the daily rollups kept
+    by `manage.py refresh_sales_rollups`, never from raw orders.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    
+    def list(self, request):
+        serializer = SalesReportQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = serializer.validated_data
+        end = params.get('end') or timezone.localdate()
+        start = params.get('start') or end - timedelta(days=29)
+        return Response(sales_report(
+            start, end, params['group_by'], statuses=params.get('status'), limit=params.get('limit')
+        ))
+
+class ExportViewSet(viewsets.ViewSet):
+    """
+    Staff-only CSV or NDJSON download of orders, order items or M-Pesa
+    transactions created in a date range (default: the last 30 days),
+    streamed as it is read (see store.exports).
+    """
+    permission_classes = [permissions.IsAdminUser]
+    lookup_value_regex = '[a-z_]+'
+    
+    def list(self, request):
+        return Response({'datasets': list(EXPORT_DATASETS), 'outputs': list(EXPORT_FORMATS)})
+    
+    def retrieve(self, request, pk=None):
+        if pk not in EXPORT_DATASETS:
+            raise Http404
+        serializer = ExportQuerySerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        params = serializer.validated_data
+        end = params.get('end') or timezone.localdate()
+        start = params.get('start') or end - timedelta(days=29)
+        output = params['output']
+        
+        response = StreamingHttpResponse(
+            export_lines(pk, start, end, output), content_type=f'{EXPORT_FORMATS[output]}; charset=utf-8'
+        )
+        response['Content-Disposition'] = f'attachment; filename="{export_filename(pk, start, end, output)}"'
+        # Keeps nginx from buffering the whole download before sending it on
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
 class WishlistViewSet(viewsets.ModelViewSet):
     serializer_class = WishlistSerializer
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return Wishlist.objects.filter(user=self.request.user).select_related('product')
+        queryset = Wishlist.objects.filter(user=self.request.user)
+        if field_requested(self.request, 'product', expandable=True):
+            queryset = queryset.select_related('product__rating_summary')
+        return queryset
     
     @action(detail=False, methods=['post'])
     def toggle(self, request):
@@ -1,9 +1,24 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.views import TokenObtainPairView
+from store.carts import merge_guest_cart
 from .models import User
 from .serializers import UserSerializer, RegisterSerializer
 
+class LoginView(TokenObtainPairView):
+    """JWT login that also folds the caller's guest cart into their saved cart"""
+    
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        try:
+            serializer.is_valid(raise_exception=True)
+        except TokenError as e:
+            raise InvalidToken(e.args[0])
+        merge_guest_cart(request, serializer.user)
+        return Response(serializer.validated_data, status=status.HTTP_200_OK)
+
 class RegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
     permission_classes = (permissions.AllowAny,)